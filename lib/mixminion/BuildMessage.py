@@ -6,6 +6,7 @@
    message payloads."""
 
 import operator
+import os
 import sys
 import types
 
@@ -20,10 +21,20 @@ import mixminion._minionlib
 if sys.version_info[:3] < (2,2,0):
     import mixminion._zlibutil as zlibutil
 
-__all__ = ['buildForwardPacket', 'buildEncryptedForwardPacket',
+try:
+    import multiprocessing
+except ImportError:
+    multiprocessing = None
+
+__all__ = ['buildForwardPacket', 'buildForwardPackets',
+           'buildEncryptedForwardPacket',
            'buildReplyPacket', 'buildReplyBlock', 'checkPathLength',
            'encodeMessage', 'decodePayload', 'getNPacketsToEncode' ]
 
+# When we're asked to build fewer than this many packets at once, it isn't
+# worth starting worker processes.
+MIN_PARALLEL_PACKETS = 4
+
 def getNPacketsToEncode(message, overhead, uncompressedFragmentPrefix=""):
     """Return the number of packets that would be needed to encode 'message'.
        Arguments are as for encodeMessage.
@@ -143,6 +154,89 @@ def buildForwardPacket(payload, exitType, exitInfo, path1, path2,
     return _buildPacket(payload, exitType, exitInfo, path1, path2,
                         paddingPRNG,suppressTag=suppressTag)
 
+def buildForwardPackets(payloads, exitType, exitInfo, paths,
+                        paddingPRNG=None, suppressTag=0, nWorkers=None):
+    """Construct one forward packet for each payload in a list, possibly
+       using several processes at once.  Returns a list of packets, in
+       the same order as the payloads.
+            payloads: A list of payloads, as for buildForwardPacket.
+            exitType, exitInfo, suppressTag: As for buildForwardPacket.
+            paths: A list of (path1, path2) tuples, one for each payload.
+            paddingPRNG: random number generator used to seed a separate
+                  PRNG for each packet.  If None, we use the common PRNG.
+            nWorkers: How many processes to use.  If None, we use one per
+                  CPU.  If 0 or 1, we build the packets in this process.
+
+       Each packet's padding comes from its own AESCounterPRNG, seeded
+       from paddingPRNG in order.  (The OAEP padding for the headers comes
+       from OpenSSL's RNG, so the packets are not reproducible from
+       paddingPRNG alone.)
+    """
+    assert len(payloads) == len(paths)
+    if paddingPRNG is None:
+        paddingPRNG = Crypto.getCommonPRNG()
+    jobs = []
+    for payload, (path1, path2) in zip(payloads, paths):
+        seed = paddingPRNG.getBytes(Crypto.AES_KEY_LEN)
+        jobs.append((seed, payload, exitType, exitInfo, path1, path2,
+                     suppressTag))
+
+    if nWorkers is None:
+        if canBuildInParallel():
+            nWorkers = multiprocessing.cpu_count()
+        else:
+            nWorkers = 0
+    nWorkers = min(nWorkers, len(jobs))
+    if nWorkers < 2 or len(jobs) < MIN_PARALLEL_PACKETS:
+        return map(_buildJob, jobs)
+
+    if not canBuildInParallel():
+        raise MixFatalError("Worker processes require Python 2.6 or later"
+                            " on a platform with fork()")
+    LOG.debug("Building %s packets in %s processes", len(jobs), nWorkers)
+    global _BUILD_JOBS
+    # The worker processes get a copy of _BUILD_JOBS when they fork, so we
+    # only need to send them indices into it; ServerInfo objects hold keys
+    # that can't be pickled.
+    _BUILD_JOBS = jobs
+    try:
+        # Each worker must reseed its RNGs, or every worker would make
+        # the same OAEP seeds.
+        pool = multiprocessing.Pool(nWorkers, Crypto.reseed_after_fork)
+        try:
+            result = pool.map(_buildJobByIndex, range(len(jobs)))
+        except:
+            pool.terminate()
+            raise
+        pool.close()
+        pool.join()
+        return result
+    finally:
+        _BUILD_JOBS = None
+
+def canBuildInParallel():
+    """Return true iff we can build packets in a pool of worker
+       processes."""
+    return multiprocessing is not None and hasattr(os, 'fork')
+
+# List of argument tuples for _buildJob, for worker processes started by
+# buildForwardPackets.
+_BUILD_JOBS = None
+
+def _buildJob(job):
+    """Helper for buildForwardPackets: build a single forward packet from
+       a tuple of (seed, payload, exitType, exitInfo, path1, path2,
+       suppressTag)."""
+    seed, payload, exitType, exitInfo, path1, path2, suppressTag = job
+    return buildForwardPacket(payload, exitType, exitInfo, path1, path2,
+                              Crypto.AESCounterPRNG(seed),
+                              suppressTag=suppressTag)
+
+def _buildJobByIndex(idx):
+    """Helper for buildForwardPackets: build the packet for _BUILD_JOBS[idx]
+       in a worker process."""
+    return _buildJob(_BUILD_JOBS[idx])
+
 
 def buildEncryptedForwardPacket(payload, exitType, exitInfo, path1, path2,
                                  key, paddingPRNG=None, secretRNG=None):
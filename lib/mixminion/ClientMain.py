@@ -209,6 +209,8 @@ DirectoryTimeout: 1 minute
 
 [Network]
 Timeout: 2 minutes
+## How many servers should we deliver packets to at once?
+#MaxConnections: 8
 """ % fields)
 
 class MixminionClient:
@@ -294,11 +296,12 @@ class MixminionClient:
             directory, address, pathSpec, message, forceNoServerSideFragments,
             startAt, endAt)
 
-        for routing, packets in self._sortPackets(allPackets):
-            if forceQueue:
+        batches = self._sortPackets(allPackets)
+        if forceQueue:
+            for routing, packets in batches:
                 self.queuePackets(packets, routing)
-            else:
-                self.sendPackets(packets, routing, noQueue=forceNoQueue)
+        else:
+            self.sendPacketBatches(batches, noQueue=forceNoQueue)
 
     def sendReplyMessage(self, directory, address, pathSpec, surbList, message,
                          startAt, endAt, forceQueue=0,
@@ -324,11 +327,12 @@ class MixminionClient:
         allPackets = self.generateReplyPackets(
             directory, address, pathSpec, message, surbList, startAt, endAt)
 
-        for routing, packets in self._sortPackets(allPackets):
-            if forceQueue:
+        batches = self._sortPackets(allPackets)
+        if forceQueue:
+            for routing, packets in batches:
                 self.queuePackets(packets, routing)
-            else:
-                self.sendPackets(packets, routing, noQueue=forceNoQueue)
+        else:
+            self.sendPacketBatches(batches, noQueue=forceNoQueue)
 
     def generateReplyBlock(self, address, servers, name="", expiryTime=0):
         """Generate an return a new ReplyBlock object.
@@ -391,12 +395,14 @@ class MixminionClient:
         directory.validatePath(pathSpec, address, startAt, endAt,
                                warnUnrecommended=0)
 
-        for p, (path1,path2) in zip(payloads, directory.generatePaths(
-            len(payloads), pathSpec, address, startAt, endAt)):
-
-            pkt = mixminion.BuildMessage.buildForwardPacket(
-                p, routingType, routingInfo, path1, path2,
-                self.prng, suppressTag=address.suppressTag())
+        paths = directory.generatePaths(len(payloads), pathSpec, address,
+                                        startAt, endAt)
+        if len(payloads) > 1:
+            LOG.info("Generating %s packets...", len(payloads))
+        pkts = mixminion.BuildMessage.buildForwardPackets(
+            payloads, routingType, routingInfo, paths, self.prng,
+            suppressTag=address.suppressTag())
+        for pkt, (path1,path2) in zip(pkts, paths):
             r.append( (pkt, path1[0]) )
 
         return r
@@ -482,76 +488,98 @@ class MixminionClient:
 
            XXXX return 1 if all delivered
            """
+        return self.sendPacketBatches([(routingInfo, pktList)],
+                                      noQueue=noQueue, lazyQueue=lazyQueue,
+                                      alreadyQueued=alreadyQueued,
+                                      warnIfLost=warnIfLost)
+
+    def sendPacketBatches(self, batches, noQueue=0, lazyQueue=0,
+                          alreadyQueued=0, warnIfLost=1):
+        """Given a list of (routingInfo, packet list) tuples, as returned by
+           _sortPackets, send each list of packets to its first hop via
+           MMTP.  We talk to all of the first hops at once, using up to
+           [Network]MaxConnections connections.  The other arguments are
+           as for sendPackets.  Returns the number of packets delivered.
+           """
         #XXXX write unit tests
         timeout = self.config.getTimeout()
+        maxConnections = self.config.get('Network',{}).get('MaxConnections',8)
+
+        handleLists = []
+        sentLists = []
+        mmtpBatches = []
+        for routingInfo, pktList in batches:
+            if noQueue or lazyQueue:
+                handleLists.append([])
+            else:
+                handleLists.append(self.queuePackets(pktList, routingInfo))
 
-        if noQueue or lazyQueue:
-            handles = []
-        else:
-            handles = self.queuePackets(pktList, routingInfo)
-
-        packetsSentByIndex = {}
-        def callback(idx, packetsSentByIndex=packetsSentByIndex):
-            packetsSentByIndex[idx] = 1
+            packetsSentByIndex = {}
+            def callback(idx, packetsSentByIndex=packetsSentByIndex):
+                packetsSentByIndex[idx] = 1
+            sentLists.append(packetsSentByIndex)
+            mmtpBatches.append((routingInfo, pktList, callback))
 
         try:
-            # May raise TimeoutError
             LOG.info("Connecting...")
-            mixminion.MMTPClient.sendPackets(routingInfo,
-                                             pktList,
-                                             timeout,
-                                             callback=callback)
-
+            errors = mixminion.MMTPClient.sendPacketsToMany(
+                mmtpBatches, timeout, maxConnections)
         except:
             exc = sys.exc_info()
-        else:
-            exc = None
-        nGood = len(packetsSentByIndex)
-        nBad = len(pktList)-nGood
+            errors = [ exc[1] ] * len(batches)
 
+        nGoodTotal = 0
         clientLock()
         try:
-            if nGood:
-                LOG.info("... %s sent", nGood)
-                LOG.trace("Removing %s successful packets from queue", nGood)
-            for idx in packetsSentByIndex.keys():
-                if handles and handles[idx]:
-                    self.queue.removePacket(handles[idx])
-                elif hasattr(pktList[idx], 'remove'):
-                    pktList[idx].remove()
-            if nGood:
+            for (routingInfo, pktList), handles, packetsSentByIndex, err in \
+                    zip(batches, handleLists, sentLists, errors):
+                nGood = len(packetsSentByIndex)
+                nBad = len(pktList)-nGood
+                nGoodTotal += nGood
+                if nGood:
+                    LOG.info("... %s sent to %s", nGood,
+                             displayServerByRouting(routingInfo))
+                    LOG.trace("Removing %s successful packets from queue",
+                              nGood)
+                for idx in packetsSentByIndex.keys():
+                    if handles and handles[idx]:
+                        self.queue.removePacket(handles[idx])
+                    elif hasattr(pktList[idx], 'remove'):
+                        pktList[idx].remove()
+
+                if nBad and noQueue:
+                    if warnIfLost:
+                        LOG.error("Error with queueing disabled: %s/%s lost",
+                                  nBad, nGood+nBad)
+                    elif alreadyQueued:
+                        LOG.info("Error while delivering packets; %s/%s left in queue",
+                                 nBad,nGood+nBad)
+                elif nBad and lazyQueue:
+                    LOG.info("Error while delivering packets; %s/%s left in queue",
+                             nBad,nGood+nBad)
+                    badPackets = [ pktList[idx] for idx in xrange(len(pktList))
+                                   if not packetsSentByIndex.has_key(idx) ]
+
+                    self.queuePackets(badPackets, routingInfo)
+                elif nBad:
+                    assert not (noQueue or lazyQueue)
+                    LOG.info("Error while delivering packets; leaving %s/%s in queue",
+                             nBad, nBad+nGood)
+                if err is not None and not nBad:
+                    LOG.info("Got error after all packets were delivered.")
+                if err is not None:
+                    LOG.info("Error was: %s", err)
+
+            if nGoodTotal:
                 try:
                     self.queue.cleanQueue()
                 except:
                     e2 = sys.exc_info()
                     LOG.error("Error while cleaning queue: %s",e2[1])
-
-            if nBad and noQueue:
-                if warnIfLost:
-                    LOG.error("Error with queueing disabled: %s/%s lost",
-                              nBad, nGood+nBad)
-                elif alreadyQueued:
-                    LOG.info("Error while delivering packets; %s/%s left in queue",
-                             nBad,nGood+nBad)
-            elif nBad and lazyQueue:
-                LOG.info("Error while delivering packets; %s/%s left in queue",
-                         nBad,nGood+nBad)
-                badPackets = [ pktList[idx] for idx in xrange(len(pktList))
-                               if not packetsSentByIndex.has_key(idx) ]
-
-                self.queuePackets(badPackets, routingInfo)
-            elif nBad:
-                assert not (noQueue or lazyQueue)
-                LOG.info("Error while delivering packets; leaving %s/%s in queue",
-                         nBad, nBad+nGood)
-            if exc and not nBad:
-                LOG.info("Got error after all packets were delivered.")
-            if exc:
-                LOG.info("Error was: %s", exc[1])
         finally:
             clientUnlock()
 
-        return nGood
+        return nGoodTotal
 
     def flushQueue(self, maxPackets=None, handles=None):
         """Try to send packets in the queue to their destinations.  Do not try
@@ -595,16 +623,15 @@ class MixminionClient:
 
         nPackets = len(packets)
         nSent = 0
-        for routing, packets in self._sortPackets(packets):
+        batches = self._sortPackets(packets)
+        for routing, packets in batches:
             LOG.info("Sending %s packets to %s...",
                      len(packets), displayServerByRouting(routing))
-            try:
-                ok = self.sendPackets(packets, routing, noQueue=1,
-                                      warnIfLost=0, alreadyQueued=1)
-                nSent += ok
-            except MixError, e:
-                LOG.error("Can't deliver packets to %s: %s; leaving in queue",
-                          displayServerByRouting(routing), str(e))
+        try:
+            nSent = self.sendPacketBatches(batches, noQueue=1,
+                                           warnIfLost=0, alreadyQueued=1)
+        except MixError, e:
+            LOG.error("Can't deliver packets: %s; leaving in queue", str(e))
 
         if nSent == nPackets:
             LOG.info("Queue flushed")
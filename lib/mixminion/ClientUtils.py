@@ -698,8 +698,14 @@ class ClientQueue:
                 fname_new = os.path.join(directory, "msg_"+handle)
                 os.rename(fname_old, fname_new)
 
-        self.store = mixminion.Filestore.ObjectMetadataStore(
-            directory, create=1)
+        # Other processes may be using the same store; don't read its
+        # metadata log while one of them is writing to it.
+        mixminion.ClientMain.clientLock()
+        try:
+            self.store = mixminion.Filestore.ObjectMetadataStore(
+                directory, create=1)
+        finally:
+            mixminion.ClientMain.clientUnlock()
 
         self.metadataLoaded = 0
 
@@ -710,6 +716,7 @@ class ClientQueue:
             now = time.time()
         mixminion.ClientMain.clientLock()
         try:
+            self.store.refreshMetadata()
             fmt = ("PACKET-0", packet, routing, previousMidnight(now))
             meta = ("V0", routing, previousMidnight(now))
             return self.store.queueObjectAndMetadata(fmt,meta)
@@ -721,6 +728,7 @@ class ClientQueue:
            queue."""
         mixminion.ClientMain.clientLock()
         try:
+            self.store.refreshMetadata()
             return self.store.getAllMessages()
         finally:
             mixminion.ClientMain.clientUnlock()
@@ -821,7 +829,12 @@ class ClientQueue:
 
     def removePacket(self, handle):
         """Remove the packet named with the handle 'handle'."""
-        self.store.removeMessage(handle)
+        mixminion.ClientMain.clientLock()
+        try:
+            self.store.refreshMetadata()
+            self.store.removeMessage(handle)
+        finally:
+            mixminion.ClientMain.clientUnlock()
 
     def inspectQueue(self):
         """Return a dict from routinginfo to a tuple of: (n,t), where
@@ -850,14 +863,17 @@ class ClientQueue:
 
     def cleanQueue(self):
         """Remove all packets older than maxAge seconds from this queue."""
-        self.store.cleanQueue()
-        self.store.cleanMetadata()
+        mixminion.ClientMain.clientLock()
+        try:
+            self.store.refreshMetadata()
+            self.store.cleanQueue()
+            self.store.cleanMetadata()
+        finally:
+            mixminion.ClientMain.clientUnlock()
 
     def loadMetadata(self):
-        """Ensure that we've loaded metadata for this queue from disk."""
-        if self.metadataLoaded:
-            return
-
+        """Ensure that we've loaded metadata for this queue from disk, and
+           that we've seen any changes made by other processes."""
         # Helper function: create metadata from a file without it.
         def fixupHandle(h,self=self):
             packet, routing, when = self.getPacket(h)
@@ -865,7 +881,9 @@ class ClientQueue:
 
         mixminion.ClientMain.clientLock()
         try:
-            self.store.loadAllMetadata(fixupHandle)
+            self.store.refreshMetadata()
+            if not self.metadataLoaded:
+                self.store.loadAllMetadata(fixupHandle)
         finally:
             mixminion.ClientMain.clientUnlock()
 
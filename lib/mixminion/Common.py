@@ -16,7 +16,7 @@ __all__ = [ 'IntervalSet', 'Lockfile', 'LockfileLocked', 'LOG', 'LogStream',
             'previousMidnight', 'readFile', 'readPickled',
             'readPossiblyGzippedFile', 'secureDelete', 'stringContains',
             'succeedingMidnight', 'tryUnlink', 'unarmorText',
-            'waitForChildren', 'writeFile', 'writePickled' ]
+            'waitForChildren', 'wipeFiles', 'writeFile', 'writePickled' ]
 
 import binascii
 import bisect
@@ -697,24 +697,32 @@ def configureShredCommand(conf):
 _BLKSIZEMAP = {}
 # A string of max(_BLKSIZEMAP.values()) zeros
 _NILSTR = ""
-def _overwriteFile(f):
-    """Overwrite f with zeros, rounding up to the nearest block.  This is
-       used as the default implementation of secureDelete."""
+# Number of bytes to write at once when wiping files in bulk.
+_WIPE_CHUNK = 65536
+def _getBlockSize(parent):
+    """Return the block size of the filesystem holding the directory
+       'parent', and make sure that _NILSTR is at least that long."""
     global _NILSTR
-    parent = os.path.split(f)[0]
     try:
-        sz = _BLKSIZEMAP[parent]
+        return _BLKSIZEMAP[parent]
     except KeyError:
-        if hasattr(os, 'statvfs'):
-            try:
-                sz = os.statvfs(parent)[statvfs.F_BSIZE]
-            except OSError:
-                sz = 8192 # Should be a safe guess? (????)
-        else:
+        pass
+    if hasattr(os, 'statvfs'):
+        try:
+            sz = os.statvfs(parent)[statvfs.F_BSIZE]
+        except OSError:
             sz = 8192 # Should be a safe guess? (????)
-        _BLKSIZEMAP[parent] = sz
-        if sz > len(_NILSTR):
-            _NILSTR = '\x00' * sz
+    else:
+        sz = 8192 # Should be a safe guess? (????)
+    _BLKSIZEMAP[parent] = sz
+    if sz > len(_NILSTR):
+        _NILSTR = '\x00' * sz
+    return sz
+
+def _overwriteFile(f):
+    """Overwrite f with zeros, rounding up to the nearest block.  This is
+       used as the default implementation of secureDelete."""
+    sz = _getBlockSize(os.path.split(f)[0])
     nil = _NILSTR[:sz]
     try:
         fd = os.open(f, os.O_WRONLY|O_BINARY)
@@ -730,6 +738,51 @@ def _overwriteFile(f):
     finally:
         os.close(fd)
 
+def wipeFiles(fnames, throttle=None):
+    """Overwrite every file in the list 'fnames' with zeros (rounding up to
+       the nearest block), and then unlink them.  Unlike _overwriteFile,
+       we write in large chunks, and flush all the files to disk together
+       once they have all been overwritten, rather than syncing after each
+       one.  Files that no longer exist are skipped.
+
+       If 'throttle' is provided, it is called with the number of bytes
+       we are about to write before we overwrite each file; it may sleep
+       in order to limit our disk bandwidth.
+
+       Returns the total number of bytes written."""
+    global _NILSTR
+    if len(_NILSTR) < _WIPE_CHUNK:
+        _NILSTR = '\x00' * _WIPE_CHUNK
+    sync = getattr(os, 'fdatasync', None) or getattr(os, 'fsync', None)
+    total = 0
+    opened = []
+    try:
+        for f in fnames:
+            try:
+                fd = os.open(f, os.O_WRONLY|O_BINARY)
+            except OSError, e:
+                if e.errno != errno.ENOENT:
+                    raise
+                continue
+            opened.append((f, fd))
+            sz = _getBlockSize(os.path.split(f)[0])
+            n = ceilDiv(os.fstat(fd)[stat.ST_SIZE], sz) * sz
+            if throttle is not None:
+                throttle(n)
+            left = n
+            while left > 0:
+                left -= os.write(fd, _NILSTR[:min(left, _WIPE_CHUNK)])
+            total += n
+        if sync is not None:
+            for _, fd in opened:
+                sync(fd)
+    finally:
+        for _, fd in opened:
+            os.close(fd)
+    for f, _ in opened:
+        tryUnlink(f)
+    return total
+
 def secureDelete(fnames, blocking=0):
     """Given a list of filenames, removes the contents of all of those
        files, from the disk, 'securely'.  If blocking=1, does not
@@ -1324,87 +1377,113 @@ class Duration:
 
 class IntervalSet:
     """An IntervalSet is a mutable set of numeric intervals, closed below and
-       open above.  Not very optimized for now.  Supports "+" for union, "-"
-       for disjunction, and "*" for intersection."""
+       open above.  Supports "+" for union, "-" for disjunction, and "*" for
+       intersection.  Each of these takes time linear in the number of
+       intervals in its operands."""
     ## Fields:
-    # edges: an ordered list of boundary points between interior and
-    #     exterior points, of the form (x, '+') for an 'entry' and
-    #     (x, '-') for an 'exit' boundary.
-    #
-    # FFFF There must be a more efficient algorithm for this, but we're so
-    # FFFF far from the critical path here that I'm not going to look for it
-    # FFFF for quite a while.
+    # starts: a sorted list of the start points of the intervals in this
+    #     set.
+    # ends: a list of the end points of the intervals in this set, such that
+    #     the i'th interval is [starts[i], ends[i]).  Intervals never overlap
+    #     or touch: starts[i] < ends[i] < starts[i+1].
     def __init__(self, intervals=None):
         """Given a list of (start,end) tuples, construct a new IntervalSet.
            Tuples are ignored if start>=end."""
-        self.edges = []
+        self.starts = []
+        self.ends = []
         if intervals:
-            for start, end in intervals:
-                if start < end:
-                    self.edges.append((start, '+'))
-                    self.edges.append((end, '-'))
+            intervals = [ (start, end) for start, end in intervals
+                          if start < end ]
+            intervals.sort()
+            self._setFromSorted(intervals)
     def copy(self):
         """Create a new IntervalSet with the same intervals as this one."""
         r = IntervalSet()
-        r.edges = self.edges[:]
+        r.starts = self.starts[:]
+        r.ends = self.ends[:]
         return r
+
+    def _setFromSorted(self, intervals):
+        """Internal helper: make this set contain exactly the union of
+           'intervals', a list of nonempty (start,end) tuples sorted by
+           start."""
+        starts = []
+        ends = []
+        lastEnd = None
+        for start, end in intervals:
+            if lastEnd is not None and start <= lastEnd:
+                # This interval overlaps or touches the previous one.
+                if end > lastEnd:
+                    ends[-1] = lastEnd = end
+            else:
+                starts.append(start)
+                ends.append(end)
+                lastEnd = end
+        self.starts = starts
+        self.ends = ends
+
     def __iadd__(self, other):
         """self += b : Causes this set to contain all points in itself or
            in b."""
-        self.edges += other.edges
-        self._cleanEdges()
+        intervals = zip(self.starts, self.ends)
+        intervals.extend(zip(other.starts, other.ends))
+        # Both halves are already sorted, so this sort only needs to merge
+        # them.
+        intervals.sort()
+        self._setFromSorted(intervals)
         return self
     def __isub__(self, other):
         """self -= b : Causes this set to contain all points in itself but not
            in b"""
-        for t, e in other.edges:
-            if e == '+':
-                self.edges.append((t, '-'))
-            else:
-                self.edges.append((t, '+'))
-        self._cleanEdges()
+        aS, aE, bS, bE = self.starts, self.ends, other.starts, other.ends
+        nB = len(bS)
+        self.starts = starts = []
+        self.ends = ends = []
+        j = 0
+        for i in xrange(len(aS)):
+            start, end = aS[i], aE[i]
+            # Skip the intervals of b that end before this one starts.
+            j = bisect.bisect_right(bE, start, j)
+            # Cut out the intervals of b that overlap this one.  The last of
+            # them may overlap our next interval too, so don't advance j.
+            k = j
+            while k < nB and bS[k] < end:
+                if bS[k] > start:
+                    starts.append(start)
+                    ends.append(bS[k])
+                start = bE[k]
+                k += 1
+            if start < end:
+                starts.append(start)
+                ends.append(end)
         return self
     def __imul__(self, other):
         """self *= b : Causes this set to contain all points in both itself and
            b."""
-        self.edges += other.edges
-        self._cleanEdges(2)
+        aS, aE, bS, bE = self.starts, self.ends, other.starts, other.ends
+        nA, nB = len(aS), len(bS)
+        self.starts = starts = []
+        self.ends = ends = []
+        i = j = 0
+        while i < nA and j < nB:
+            # Skip over intervals that end before the other set's current
+            # interval begins.
+            if aE[i] <= bS[j]:
+                i = bisect.bisect_right(aE, bS[j], i)
+                continue
+            if bE[j] <= aS[i]:
+                j = bisect.bisect_right(bE, aS[i], j)
+                continue
+            start = max(aS[i], bS[j])
+            end = min(aE[i], bE[j])
+            starts.append(start)
+            ends.append(end)
+            if aE[i] < bE[j]:
+                i += 1
+            else:
+                j += 1
         return self
 
-    def _cleanEdges(self, nMin=1):
-        """Internal helper method: to be called when 'edges' is in a dirty
-           state, containing entry and exit points that don't create a
-           well-defined set of intervals.  Only those points that are 'entered'
-           nMin times or more are retained.
-           """
-        edges = self.edges
-        edges.sort()
-        depth = 0
-        newEdges = [ ('X', 'X') ] #marker value; will be removed.
-        for t, e in edges:
-            # Traverse the edges in order; keep track of how many more
-            # +'s we have seen than -'s.  Whenever that number increases
-            # above nMin, add a +.  Whenever that number drops below nMin,
-            # add a - ... but if the new edge would cancel out the most
-            # recently added one, then delete the most recently added one.
-            if e == '+':
-                depth += 1
-                if depth == nMin:
-                    if newEdges[-1] == (t, '-'):
-                        del newEdges[-1]
-                    else:
-                        newEdges.append((t, '+'))
-            if e == '-':
-                if depth == nMin:
-                    if newEdges[-1] == (t, '+'):
-                        del newEdges[-1]
-                    else:
-                        newEdges.append((t, '-'))
-                depth -= 1
-        assert depth == 0
-        del newEdges[0]
-        self.edges = newEdges
-
     def __add__(self, other):
         "Return the union of this IntervalSet and other"
         r = self.copy()
@@ -1428,9 +1507,9 @@ class IntervalSet:
            a 2-tuple containing the start and end of that interval.
            Otherwise return (None,None).
         """
-        idx = bisect.bisect(self.edges, (point, '-'))
-        if idx < len(self.edges) and self.edges[idx][1] == '-':
-            return (self.edges[idx-1][0], self.edges[idx][0])
+        idx = bisect.bisect_right(self.starts, point) - 1
+        if idx >= 0 and point < self.ends[idx]:
+            return (self.starts[idx], self.ends[idx])
         else:
             return None, None
 
@@ -1440,16 +1519,16 @@ class IntervalSet:
             this set."""
         if isinstance(other, IntervalSet):
             return self*other == other
-        idx = bisect.bisect(self.edges, (other, '-'))
-        return idx < len(self.edges) and self.edges[idx][1] == '-'
+        idx = bisect.bisect_right(self.starts, other) - 1
+        return idx >= 0 and other < self.ends[idx]
 
     def isEmpty(self):
         """Return true iff this set contains no points"""
-        return len(self.edges) == 0
+        return len(self.starts) == 0
 
     def __nonzero__(self):
         """Return true iff this set contains some points"""
-        return len(self.edges) != 0
+        return len(self.starts) != 0
 
     def __repr__(self):
         s = [ "(%s,%s)"%(start,end) for start, end in self.getIntervals() ]
@@ -1458,39 +1537,34 @@ class IntervalSet:
     def getIntervals(self):
         """Returns a list of (start,end) tuples for a the intervals in this
            set."""
-        s = []
-        for i in xrange(0, len(self.edges), 2):
-            s.append((self.edges[i][0], self.edges[i+1][0]))
-        return s
+        return zip(self.starts, self.ends)
 
     def spanLength(self):
         """Return the sum of the lengths of the intervals in this set."""
         r = 0
-        for i in xrange(0, len(self.edges), 2):
-            r += self.edges[i+1][0] - self.edges[i][0]
+        for i in xrange(len(self.starts)):
+            r += self.ends[i] - self.starts[i]
         return r
 
     def _checkRep(self):
         """Helper function: raises AssertionError if this set's data is
            corrupted."""
-        assert (len(self.edges) % 2) == 0
-        for i in xrange(0, len(self.edges), 2):
-            assert self.edges[i][0] < self.edges[i+1][0]
-            assert self.edges[i][1] == '+'
-            assert self.edges[i+1][1] == '-'
-            assert i == 0 or self.edges[i-1][0] < self.edges[i][0]
+        assert len(self.starts) == len(self.ends)
+        for i in xrange(len(self.starts)):
+            assert self.starts[i] < self.ends[i]
+            assert i == 0 or self.ends[i-1] < self.starts[i]
 
     def __cmp__(self, other):
         """A == B iff A and B contain exactly the same intervals."""
-        return cmp(self.edges, other.edges)
+        return cmp((self.starts, self.ends), (other.starts, other.ends))
 
     def start(self):
         """Return the first point contained in this interval."""
-        return self.edges[0][0]
+        return self.starts[0]
 
     def end(self):
         """Return the last point contained in this interval."""
-        return self.edges[-1][0]
+        return self.ends[-1]
 
 #----------------------------------------------------------------------
 # SMTP address functionality
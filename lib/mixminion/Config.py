@@ -1002,7 +1002,8 @@ class ClientConfig(_ConfigFile):
                        'SURBPathLength' : ('ALLOW', None, None),
                        },
         'Network' : { 'ConnectionTimeout' : ('ALLOW', "interval", None),
-                      'Timeout' : ('ALLOW', "interval", None) }
+                      'Timeout' : ('ALLOW', "interval", None),
+                      'MaxConnections' : ('ALLOW', "int", "8") }
 
         }
     def __init__(self, fname=None, string=None):
@@ -1028,6 +1029,10 @@ class ClientConfig(_ConfigFile):
         t = self['Network'].get('ConnectionTimeout')
         if t is not None:
             LOG.warn("The ConnectionTimout option in your .mixminionrc is deprecated; use Timeout instead.")
+        mc = self['Network'].get('MaxConnections')
+        if mc is not None and mc < 1:
+            raise ConfigError("MaxConnections must be at least 1.")
+
         t = self.getTimeout()
         if int(t) < 5:
             LOG.warn("Very short network timeout")
@@ -200,6 +200,19 @@ def openssl_seed(count):
     """Seeds the openssl rng with 'count' bytes of real entropy."""
     _ml.openssl_seed(trng(count))
 
+def reseed_after_fork():
+    """Called in a newly forked process.  We start with copies of our
+       parent's RNG states, including OpenSSL's and any entropy the TRNG
+       has read ahead; throw away the cached state and reseed OpenSSL with
+       fresh entropy and our PID, so that we don't generate the same
+       'random' bytes as our parent or our siblings."""
+    if _theTrueRNG is not None:
+        _theTrueRNG.bytes = ""
+    thisThread = threading.currentThread()
+    if hasattr(thisThread, "minion_shared_PRNG"):
+        del thisThread.minion_shared_PRNG
+    _ml.openssl_seed(trng(40) + str(os.getpid()))
+
 def trng(count):
     """Returns (count) bytes of true random data from a true source of
        entropy (/dev/urandom).  May read ahead and cache values.
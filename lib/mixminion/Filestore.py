@@ -15,22 +15,27 @@
 import anydbm
 import binascii
 import cPickle
+import cStringIO
 import dumbdbm
 import errno
+import heapq
 import os
 import stat
+import struct
 import threading
 import time
 import types
 import whichdb
 
 from mixminion.Common import MixError, MixFatalError, secureDelete, LOG, \
-     createPrivateDir, readFile, replaceFile, tryUnlink, writePickled
-from mixminion.Crypto import getCommonPRNG
+     createPrivateDir, readFile, readPickled, replaceFile, tryUnlink, \
+     writeFile, writePickled
+from mixminion.Crypto import AES_KEY_LEN, aes_key, ctr_crypt, getCommonPRNG, \
+     sha1
 
 __all__ = [ "StringStore", "StringMetadataStore",
             "ObjectStore", "ObjectMetadataStore",
-            "MixedStore", "MixedMetadataStore",
+            "MixedStore", "MixedMetadataStore", "SegmentedStringStore",
             "DBBase", "JournaledDBBase", "BooleanJournaledDBBase",
             "CorruptedFile",
             ]
@@ -46,6 +51,172 @@ class CorruptedFile(MixError):
 # trash.
 INPUT_TIMEOUT = 6000
 
+# On windows or (old-school) mac, binary != text.
+_O_BINARY = getattr(os, 'O_BINARY', 0)
+
+# All the states a file in a BaseStore can be in.
+_STORE_STATES = [ "inp", "msg", "rmv", "crp", "inpm", "meta", "rmvm", "crpm" ]
+
+# Encrypted messages begin with this magic string, followed by a 4-byte
+# epoch number and a 16-byte salt.
+_ERASURE_MAGIC = "\x00MCE"
+_ERASURE_HEADER_FORMAT = "!4sL16s"
+_ERASURE_HEADER_LEN = struct.calcsize(_ERASURE_HEADER_FORMAT)
+# By default, how many seconds do we use each epoch key in an encrypted
+# store before starting a new one?
+ERASURE_EPOCH_LENGTH = 30*60
+
+class _EncryptingFile:
+    """Helper for _ErasureKeyring: a write-only file object that encrypts
+       everything written to it before passing it to an underlying file."""
+    def __init__(self, f, key):
+        self.f = f
+        self.key = aes_key(key)
+        self.offset = 0
+    def write(self, s):
+        self.f.write(ctr_crypt(s, self.key, self.offset))
+        self.offset += len(s)
+    def close(self):
+        self.f.close()
+
+class _ErasureKeyring:
+    """Helper for BaseStore: holds the keys for a store whose messages are
+       encrypted, so that we can delete a message by unlinking it, and only
+       need to wipe a small key file once every message that used that key
+       is gone.
+
+       Each message is encrypted with AES-CTR, under a key derived from the
+       current epoch key and a random per-message salt.  Epoch keys live in
+       files named ekey_EPOCH in the store's directory.  Until every message
+       from an epoch is removed, someone who reads the key file can recover
+       the unlinked messages from that epoch; once the last one is gone, we
+       wipe the key file, and all of them become unreadable.
+    """
+    ## Fields:
+    # dir: the directory of the store.
+    # epochLength: how many seconds we use each epoch key for new messages.
+    # keys: map from epoch number to epoch key.
+    # epochOf: map from handle to epoch number, for every encrypted file in
+    #    the store that we haven't unlinked yet.
+    # refs: map from epoch number to the number of handles in epochOf that
+    #    use that epoch.
+    # current: the epoch we use for new messages, or None.
+    # currentStart: the time at which we began using 'current'.
+    def __init__(self, location, epochLength=ERASURE_EPOCH_LENGTH):
+        """Create a new keyring for the store in 'location', and load any
+           epoch keys it has."""
+        self.dir = location
+        self.epochLength = epochLength
+        self.keys = {}
+        self.epochOf = {}
+        self.refs = {}
+        self.current = None
+        self.currentStart = None
+        for fn in os.listdir(location):
+            if not fn.startswith("ekey_"):
+                continue
+            try:
+                epoch = int(fn[5:])
+            except ValueError:
+                continue
+            key = readFile(os.path.join(location, fn), 1)
+            if len(key) != AES_KEY_LEN:
+                LOG.warn("Ignoring damaged key file %s in filestore %s",
+                         fn, location)
+                continue
+            self.keys[epoch] = key
+
+    def noteFile(self, handle, fname):
+        """Remember the epoch used by the file 'fname', whose handle is
+           'handle', if it is encrypted."""
+        try:
+            f = open(fname, 'rb')
+            try:
+                hdr = f.read(_ERASURE_HEADER_LEN)
+            finally:
+                f.close()
+        except (IOError, OSError):
+            return
+        if len(hdr) == _ERASURE_HEADER_LEN and hdr[:4] == _ERASURE_MAGIC:
+            self._addRef(handle,
+                         struct.unpack(_ERASURE_HEADER_FORMAT, hdr)[1])
+
+    def _addRef(self, handle, epoch):
+        """Helper: note that 'handle' is encrypted under 'epoch'."""
+        self.epochOf[handle] = epoch
+        self.refs[epoch] = self.refs.get(epoch, 0) + 1
+
+    def release(self, handle):
+        """Forget about the file for 'handle'.  Return true iff it was
+           encrypted."""
+        try:
+            epoch = self.epochOf[handle]
+        except KeyError:
+            return 0
+        del self.epochOf[handle]
+        self.refs[epoch] -= 1
+        if not self.refs[epoch]:
+            del self.refs[epoch]
+        return 1
+
+    def wrapNewFile(self, f, handle, now=None):
+        """Given a newly created file 'f' for 'handle', write an encryption
+           header to it, and return a file object that will encrypt anything
+           written to it."""
+        if now is None:
+            now = time.time()
+        if self.current is None or now >= self.currentStart+self.epochLength:
+            self._newEpoch(now)
+        salt = getCommonPRNG().getBytes(16)
+        f.write(struct.pack(_ERASURE_HEADER_FORMAT, _ERASURE_MAGIC,
+                            self.current, salt))
+        self._addRef(handle, self.current)
+        return _EncryptingFile(f, self._messageKey(self.current, salt))
+
+    def _newEpoch(self, now):
+        """Helper: generate and save a key for a new epoch, and begin
+           using it."""
+        epoch = max(self.keys.keys()+[0]) + 1
+        key = getCommonPRNG().getBytes(AES_KEY_LEN)
+        # The key must be on disk before any message that uses it is.
+        writeFile(os.path.join(self.dir, "ekey_%s"%epoch), key, mode=0600,
+                  binary=1, fsync=1)
+        self.keys[epoch] = key
+        self.current = epoch
+        self.currentStart = now
+
+    def _messageKey(self, epoch, salt):
+        """Helper: return the key for a message with the given epoch and
+           salt.  Raises KeyError if we have no key for the epoch."""
+        return sha1(self.keys[epoch]+salt)[:AES_KEY_LEN]
+
+    def decrypt(self, data):
+        """Given the contents of a file in the store, return its plaintext.
+           Raises KeyError if the file is encrypted and we no longer have
+           its key."""
+        if len(data) < _ERASURE_HEADER_LEN or data[:4] != _ERASURE_MAGIC:
+            return data
+        _, epoch, salt = struct.unpack(_ERASURE_HEADER_FORMAT,
+                                       data[:_ERASURE_HEADER_LEN])
+        return ctr_crypt(data[_ERASURE_HEADER_LEN:],
+                         self._messageKey(epoch, salt))
+
+    def removeDeadKeys(self, now=None):
+        """Forget the key for every epoch other than the current one that
+           no longer has any files, and return a list of the key files that
+           must now be wiped."""
+        if now is None:
+            now = time.time()
+        if (self.current is not None and
+            now >= self.currentStart+self.epochLength):
+            # Don't let a quiet store keep its last key forever.
+            self.current = None
+        dead = [ e for e in self.keys.keys()
+                 if e != self.current and not self.refs.has_key(e) ]
+        for e in dead:
+            del self.keys[e]
+        return [ os.path.join(self.dir, "ekey_%s"%e) for e in dead ]
+
 class BaseStore:
     """A BaseStore is an unordered collection of files with secure insert,
        move, and delete operations.
@@ -69,11 +240,23 @@ class BaseStore:
        chosen from 'A-Za-z0-9+-'.  [Collision probability is negligible, and
        collisions are detected.])
 
-       If metadata is present, is has a names with the analogous
+       Older versions stored metadata in files with the analogous names
              rmvm_HANDLE
              meta_HANDLE
              inpm_HANDLE
              crpm_HANDLE
+       (See BaseMetadataStore for how metadata is stored now.)
+
+       Optionally, a store can encrypt its messages under short-lived keys
+       (see setErasureMode and _ErasureKeyring).  Then removing a message
+       only requires unlinking it, and wiping a tiny key file from time to
+       time, instead of overwriting every message.
+
+       So that we don't need to scan the directory every time we want a
+       list of messages, we keep a catalog of which handles are in which
+       state.  It is built when the store is opened, and kept up to date
+       as we change the state of files.  If anything other than this
+       object changes the directory, call resyncCatalog.
 
        Threading notes:  Although BaseStore itself is threadsafe, you'll want
        to synchronize around any multistep operations that you want to
@@ -85,12 +268,15 @@ class BaseStore:
        """
 
     # Fields:   dir--the location of the file store.
-    #           n_entries: the number of complete messages in the queue.
-    #                 <0 if we haven't counted yet.
+    #           _catalog: A map from each state in _STORE_STATES to a dict
+    #                 whose keys are the handles of the files in that state.
     #           _lock: A lock that must be held while modifying or accessing
     #                 the queue object.  Filesystem operations are allowed
     #                 without holding the lock, but they must not be visible
     #                 to users of the queue.
+    #           _keyring: An _ErasureKeyring if this store has (or may
+    #                 soon have) encrypted messages; otherwise None.
+    #           _encryptNew: True iff we should encrypt new messages.
     def __init__(self, location, create=0, scrub=0):
         """Creates a file store object for a given directory, 'location'.  If
            'create' is true, creates the directory if necessary.  If 'scrub'
@@ -109,11 +295,43 @@ class BaseStore:
 
         createPrivateDir(location, nocreate=(not create))
 
+        self.resyncCatalog()
+
+        self._keyring = None
+        self._encryptNew = 0
+        for fn in os.listdir(location):
+            if fn.startswith("ekey_"):
+                self._loadKeyring()
+                break
+
         if scrub:
             self.cleanQueue()
 
-        # Count messages on first time through.
-        self.n_entries = -1
+    def _loadKeyring(self, epochLength=ERASURE_EPOCH_LENGTH):
+        """Helper: load our epoch keys, and find out which of our files are
+           encrypted under which of them."""
+        keyring = _ErasureKeyring(self.dir, epochLength)
+        for state in "inp", "msg", "rmv":
+            for h in self._catalog[state].keys():
+                keyring.noteFile(h, os.path.join(self.dir, state+"_"+h))
+        self._keyring = keyring
+
+    def setErasureMode(self, encrypt, epochLength=ERASURE_EPOCH_LENGTH):
+        """If 'encrypt' is true, encrypt every new message in this store
+           under a key that we throw away once all the messages using it
+           are gone, so that removed messages can simply be unlinked.  A
+           new key is used every 'epochLength' seconds.  If 'encrypt' is
+           false, store new messages in the clear.  Either way, encrypted
+           messages already in the store stay readable."""
+        try:
+            self._lock.acquire()
+            if encrypt and self._keyring is None:
+                self._keyring = _ErasureKeyring(self.dir, epochLength)
+            elif self._keyring is not None:
+                self._keyring.epochLength = epochLength
+            self._encryptNew = encrypt
+        finally:
+            self._lock.release()
 
     def lock(self):
         """Prevent access to this filestore from other threads."""
@@ -123,19 +341,32 @@ class BaseStore:
         """Release the lock on this filestore."""
         self._lock.release()
 
+    def resyncCatalog(self):
+        """Rebuild our catalog of handles by scanning the directory."""
+        catalog = {}
+        for state in _STORE_STATES:
+            catalog[state] = {}
+        for fn in os.listdir(self.dir):
+            idx = fn.find("_")
+            if idx < 0:
+                continue
+            states = catalog.get(fn[:idx])
+            if states is not None:
+                states[fn[idx+1:]] = 1
+        try:
+            self._lock.acquire()
+            self._catalog = catalog
+        finally:
+            self._lock.release()
+
     def count(self, recount=0):
-        """Returns the number of complete messages in the filestore."""
+        """Returns the number of complete messages in the filestore.  If
+           'recount' is true, rescan the directory first."""
         try:
             self._lock.acquire()
-            if self.n_entries >= 0 and not recount:
-                return self.n_entries
-            else:
-                res = 0
-                for fn in os.listdir(self.dir):
-                    if fn.startswith("msg_"):
-                        res += 1
-                self.n_entries = res
-                return res
+            if recount:
+                self.resyncCatalog()
+            return len(self._catalog["msg"])
         finally:
             self._lock.release()
 
@@ -153,7 +384,7 @@ class BaseStore:
         """Returns handles for all messages currently in the filestore.
            Note: this ordering is not guaranteed to be random."""
         self._lock.acquire()
-        hs = [fn[4:] for fn in os.listdir(self.dir) if fn.startswith("msg_")]
+        hs = self._catalog["msg"].keys()
         self._lock.release()
         return hs
 
@@ -168,6 +399,9 @@ class BaseStore:
     def _preserveCorrupted(self, handle):
         """Given a handle, change the message state to 'crp'."""
         self._doRemove(handle, "crp")
+        if self._keyring is not None:
+            # Don't keep an epoch key around for a file nobody will read.
+            self._keyring.release(handle)
 
     def removeMessage(self, handle):
         """Given a handle, removes the corresponding message from the
@@ -178,19 +412,18 @@ class BaseStore:
         """Removes all messages from this filestore."""
         try:
             self._lock.acquire()
-            for m in os.listdir(self.dir):
-                if m[:4] in ('inp_', 'msg_'):
-                    self._changeState(m[4:], m[:3], "rmv")
-                elif m[:4] in ('inpm_', 'meta_'):
-                    self._changeState(m[5:], m[:4], "rmvm")
-            self.n_entries = 0
+            for s1, s2 in (("inp", "rmv"), ("msg", "rmv"),
+                           ("inpm", "rmvm"), ("meta", "rmvm")):
+                for h in self._catalog[s1].keys():
+                    self._changeState(h, s1, s2)
             self.cleanQueue(secureDeleteFn)
         finally:
             self._lock.release()
 
     def getMessagePath(self, handle):
         """Given a handle for an existing message, return the name of the
-           file that contains that message."""
+           file that contains that message.  (If the message is encrypted,
+           so is the file.)"""
         # We don't need to lock here: the handle is still valid, or it isn't.
         return os.path.join(self.dir, "msg_"+handle)
 
@@ -198,8 +431,25 @@ class BaseStore:
         """Given a handle for an existing message, returns a file descriptor
            open to read that message."""
         # We don't need to lock here; the handle is still valid, or it isn't.
+        if self._keyring is not None:
+            return cStringIO.StringIO(self._readMessage(handle))
         return open(os.path.join(self.dir, "msg_"+handle), 'rb')
 
+    def _readMessage(self, handle):
+        """Helper: return the contents of the message 'handle', decrypting
+           them if necessary.  Raises CorruptedFile if the message is
+           encrypted under a key we no longer have."""
+        data = readFile(os.path.join(self.dir, "msg_"+handle), 1)
+        if self._keyring is None:
+            return data
+        try:
+            return self._keyring.decrypt(data)
+        except KeyError:
+            LOG.error("Missing key for encrypted message %s in filestore %s",
+                      handle, self.dir)
+            self._preserveCorrupted(handle)
+            raise CorruptedFile()
+
     def openNewMessage(self):
         """Returns (file, handle) tuple to create a new message.  Once
            you're done writing, you must call finishMessage to
@@ -207,6 +457,13 @@ class BaseStore:
         while 1:
             f, handle = getCommonPRNG().openNewFile(self.dir, "inp_", 1,
                                                        "msg_")
+            try:
+                self._lock.acquire()
+                self._catalog["inp"][handle] = 1
+                if self._encryptNew:
+                    f = self._keyring.wrapNewFile(f, handle)
+            finally:
+                self._lock.release()
             return f, handle
         raise AssertionError # unreached; appease pychecker
 
@@ -242,22 +499,38 @@ class BaseStore:
            Returns 1 if a clean is already in progress; otherwise
            returns 0.
         """
-        # We don't need to hold the lock here; we synchronize via the
-        # filesystem.
+        # We only hold the lock while we decide what to remove; the
+        # removal itself is synchronized via the filesystem.
 
         rmv = []
+        # Encrypted files don't need to be overwritten; we just unlink them,
+        # and wipe their keys once nothing else uses them.
+        unlink = []
         allowedTime = int(time.time()) - INPUT_TIMEOUT
-        for m in os.listdir(self.dir):
-            if m.startswith("rmv_") or m.startswith("rmvm_"):
-                rmv.append(os.path.join(self.dir, m))
-            elif m.startswith("inp_"):
+        try:
+            self._lock.acquire()
+            for h in self._catalog["inp"].keys():
                 try:
-                    s = os.stat(m)
-                    if s[stat.ST_MTIME] < allowedTime:
-                        self._changeState(m[4:], "inp", "rmv")
-                        rmv.append(os.path.join(self.dir, m))
+                    s = os.stat(os.path.join(self.dir, "inp_"+h))
                 except OSError:
-                    pass
+                    continue
+                if s[stat.ST_MTIME] < allowedTime:
+                    self._changeState(h, "inp", "rmv")
+            for state in "rmv", "rmvm":
+                for h in self._catalog[state].keys():
+                    fn = os.path.join(self.dir, state+"_"+h)
+                    if (state == "rmv" and self._keyring is not None and
+                        self._keyring.release(h)):
+                        unlink.append(fn)
+                    else:
+                        rmv.append(fn)
+                self._catalog[state] = {}
+            if self._keyring is not None:
+                rmv.extend(self._keyring.removeDeadKeys())
+        finally:
+            self._lock.release()
+        for fn in unlink:
+            tryUnlink(fn)
         if secureDeleteFn:
             secureDeleteFn(rmv)
         else:
@@ -276,15 +549,14 @@ class BaseStore:
                 LOG.error("Error while trying to change %s from %s to %s: %s",
                           handle, s1, s2, e)
                 LOG.error("Directory %s contains: %s", self.dir, contents)
-                self.count(1)
+                self.resyncCatalog()
                 return
 
-            if self.n_entries < 0:
-                return
-            if s1 == 'msg' and s2 != 'msg':
-                self.n_entries -= 1
-            elif s1 != 'msg' and s2 == 'msg':
-                self.n_entries += 1
+            try:
+                del self._catalog[s1][handle]
+            except KeyError:
+                pass
+            self._catalog[s2][handle] = 1
         finally:
             self._lock.release()
 
@@ -298,7 +570,7 @@ class StringStoreMixin:
            message."""
         try:
             self._lock.acquire()
-            return readFile(os.path.join(self.dir, "msg_"+handle), 1)
+            return self._readMessage(handle)
         finally:
             self._lock.release()
 
@@ -323,11 +595,9 @@ class ObjectStoreMixin:
            """
         try:
             self._lock.acquire()
-            f = open(os.path.join(self.dir, "msg_"+handle), 'rb')
+            data = self._readMessage(handle)
             try:
-                res = cPickle.load(f)
-                f.close()
-                return res
+                return cPickle.loads(data)
             except (cPickle.UnpicklingError, EOFError, IOError), e:
                 LOG.error("Found damaged object %s in filestore %s: %s",
                           handle, self.dir, str(e))
@@ -344,6 +614,19 @@ class ObjectStoreMixin:
         self.finishMessage(f, handle) # handles locking
         return handle
 
+# Name of the file in a BaseMetadataStore's directory that holds the
+# metadata log.  (It has no '_', so the catalog ignores it.)
+METADATA_LOG = "metadata.log"
+# Format for the header of each record in a metadata log: the length of the
+# handle, the length of the pickled metadata (0 for a deletion), and a CRC32
+# of the handle and the pickle.
+_METADATA_REC_FORMAT = "!BLL"
+_METADATA_REC_LEN = struct.calcsize(_METADATA_REC_FORMAT)
+# We compact the metadata log once it holds more than this many records, and
+# more than METADATA_LOG_SLACK times as many records as live entries.
+METADATA_LOG_MIN_COMPACT = 1024
+METADATA_LOG_SLACK = 4
+
 class BaseMetadataStore(BaseStore):
     """A BaseMetadataStore is a BaseStore that stores a metadata
        object for every object in the store.  We assume metadata to be
@@ -351,96 +634,288 @@ class BaseMetadataStore(BaseStore):
        Metadata is not always wiped before removal.
 
        The representation of a store with metadata is the same as that
-       of a simple store, except that:
-           1) The meta_, rmvm_, and inpm_ tags are used.
-           2) For every file in msg_ state, there is a corresponding meta_
-              file.
+       of a simple store, except that the metadata for all the messages
+       lives in a single append-only log file, METADATA_LOG.  Every
+       record in the log either sets the metadata for a handle to a new
+       pickled object, or deletes it; later records override earlier
+       ones.  Each record carries a checksum, so that a record torn by a
+       crash is detected and discarded when the store is next opened.
+       When the log has grown much larger than its live contents, we
+       rewrite it into a new file and rename it into place.
+
+       Several client processes can share one store, taking turns under
+       the client lock.  After taking the lock, they call refreshMetadata
+       to notice whether another process has appended to the log or
+       replaced it, and to reload it if so.  Stores used by only one
+       process never need to.
+
+       (Older versions kept every message's metadata in a separate
+       meta_HANDLE file; we fold any such files into the log when the
+       store is opened.)
     """
     ##Fields:
-    # _metadata_cache: map from handle to cached metadata object.  This is
-    #    a write-through cache.
+    # _metadata_cache: map from handle to metadata object.  This holds
+    #    the current contents of the metadata log.
+    # _metadataLog: a file object open to append to the metadata log.
+    # _metadataLogRecords: the number of records in the metadata log.
+    # _metadataLogSize: the number of bytes we expect the metadata log to
+    #    hold, if nobody else has written to it.
+    # _metadataLogIno: the inode number of the metadata log we have open.
     def __init__(self, location, create=0, scrub=0):
         """Create a new BaseMetadataStore to store files in 'location'. The
            'create' and 'scrub' arguments are as for BaseStore(...)."""
-        BaseStore.__init__(self, location=location, create=create, scrub=scrub)
+        BaseStore.__init__(self, location=location, create=create)
         self._metadata_cache = {}
+        self._metadataLog = None
+        self._metadataLogRecords = 0
+        self._metadataLogSize = 0
+        self._metadataLogIno = None
+        self._loadMetadataLog()
         if scrub:
+            self.cleanQueue()
             self.cleanMetadata()
 
-    def cleanMetadata(self,secureDeleteFn=None):
-        """Find all orphaned metadata files and remove them."""
-        hSet = {}
-        for h in self.getAllMessages():
-            hSet[h] = 1
-        rmv = []
-        for h in [fn[5:] for fn in os.listdir(self.dir)
-                  if fn.startswith("meta_")]:
-            if not hSet.get(h):
-                rmv.append("meta_"+h)
-        if rmv:
-            LOG.warn("Removing %s orphaned metadata files from %s",
-                     len(rmv), self.dir)
-            if secureDeleteFn:
-                secureDeleteFn(rmv)
+    def _loadMetadataLog(self):
+        """Helper: read the metadata log from disk, discarding any damaged
+           tail; fold in any metadata stored in the old one-file-per-handle
+           format; and open the log for appending."""
+        fname = os.path.join(self.dir, METADATA_LOG)
+        # If we crashed while compacting, we may have a link to the old
+        # log that still needs to be wiped, and a finished new log that
+        # never got renamed into place.
+        if os.path.exists(fname+".old"):
+            if os.path.exists(fname) and os.path.samefile(fname, fname+".old"):
+                # We never replaced the log; just drop the extra link.
+                tryUnlink(fname+".old")
             else:
-                secureDelete(rmv, blocking=1)
+                secureDelete([fname+".old"], blocking=1)
+        if os.path.exists(fname+".tmp"):
+            if os.path.exists(fname):
+                tryUnlink(fname+".tmp")
+            else:
+                replaceFile(fname+".tmp", fname)
+
+        pickles = {}
+        nRecords = 0
+        pos = 0
+        if os.path.exists(fname):
+            data = readFile(fname, 1)
+            pos = 0
+            while pos + _METADATA_REC_LEN <= len(data):
+                hlen, dlen, crc = struct.unpack(_METADATA_REC_FORMAT,
+                                     data[pos:pos+_METADATA_REC_LEN])
+                end = pos + _METADATA_REC_LEN + hlen + dlen
+                body = data[pos+_METADATA_REC_LEN:end]
+                if end > len(data) or \
+                       binascii.crc32(body) & 0xFFFFFFFFL != crc:
+                    break
+                if dlen:
+                    pickles[body[:hlen]] = body[hlen:]
+                else:
+                    try:
+                        del pickles[body[:hlen]]
+                    except KeyError:
+                        pass
+                nRecords += 1
+                pos = end
+            if pos < len(data):
+                LOG.warn("Discarding %s damaged bytes at the end of %s",
+                         len(data)-pos, fname)
+                f = open(fname, 'r+b')
+                f.truncate(pos)
+                f.close()
+
+        corrupt = []
+        cache = {}
+        for h, p in pickles.items():
+            try:
+                cache[h] = cPickle.loads(p)
+            except (cPickle.UnpicklingError, EOFError, ValueError), e:
+                LOG.error("Found damaged metadata for %s in filestore %s: %s",
+                          h, self.dir, str(e))
+                corrupt.append(h)
+
+        # Fold in any metadata from older versions.  The log always wins:
+        # a meta_ file can only be newer if we never finished migrating it.
+        oldMeta = self._catalog["meta"].keys()
+        migrated = []
+        for h in oldMeta:
+            if cache.has_key(h):
+                continue
+            try:
+                cache[h] = readPickled(os.path.join(self.dir, "meta_"+h))
+                migrated.append(h)
+            except (OSError, IOError, cPickle.UnpicklingError, EOFError), e:
+                LOG.error("Found damaged metadata for %s in filestore %s: %s",
+                          h, self.dir, str(e))
+                corrupt.append(h)
+
+        try:
+            self._lock.acquire()
+            self._metadata_cache = cache
+            self._metadataLogRecords = nRecords
+            self._metadataLogSize = pos
+            self._openMetadataLog()
+            if migrated:
+                LOG.info("Moving metadata for %s messages in %s into %s",
+                         len(migrated), self.dir, METADATA_LOG)
+                for h in migrated:
+                    self._appendMetadata(h, cache[h])
+                self._metadataLog.flush()
+                os.fsync(self._metadataLog.fileno())
+            # Now that the log is on disk, the old files can go.
+            for h in oldMeta:
+                self._changeState(h, "meta", "rmvm")
+            for h in self._catalog["inpm"].keys():
+                self._changeState(h, "inpm", "rmvm")
+            for h in corrupt:
+                if self._catalog["msg"].has_key(h):
+                    self._preserveCorrupted(h)
+            self._maybeCompactMetadata()
+        finally:
+            self._lock.release()
+
+    def _openMetadataLog(self):
+        """Helper: open the metadata log for appending, and remember which
+           file we opened.
+
+           Callers must hold self._lock."""
+        fname = os.path.join(self.dir, METADATA_LOG)
+        self._metadataLog = open(fname, 'ab')
+        self._metadataLogIno = os.fstat(self._metadataLog.fileno())[
+            stat.ST_INO]
+
+    def refreshMetadata(self):
+        """If another process has appended to the metadata log or replaced
+           it since we last read or wrote it, close our copy and load the
+           log (and our catalog of messages) again.  Only needed when
+           several processes share this store; callers must make sure that
+           none of the others is using it at the same time."""
+        fname = os.path.join(self.dir, METADATA_LOG)
+        try:
+            self._lock.acquire()
+            try:
+                st = os.stat(fname)
+            except OSError:
+                st = None
+            if st is not None and \
+                   st[stat.ST_INO] == self._metadataLogIno and \
+                   st[stat.ST_SIZE] == self._metadataLogSize:
+                return
+            LOG.debug("Metadata log in %s changed on disk; reloading",
+                      self.dir)
+            if self._metadataLog is not None:
+                self._metadataLog.close()
+                self._metadataLog = None
+            self.resyncCatalog()
+            self._loadMetadataLog()
+        finally:
+            self._lock.release()
+
+    def _appendMetadata(self, handle, object, delete=0):
+        """Helper: add a record to the metadata log, setting the metadata for
+           'handle' to 'object' (or removing it if 'delete' is true).
+
+           Callers must hold self._lock."""
+        if delete:
+            body = handle
+            dlen = 0
+        else:
+            p = cPickle.dumps(object, 1)
+            body = handle+p
+            dlen = len(p)
+        self._metadataLog.write(
+            struct.pack(_METADATA_REC_FORMAT, len(handle), dlen,
+                        binascii.crc32(body) & 0xFFFFFFFFL) + body)
+        self._metadataLog.flush()
+        self._metadataLogRecords += 1
+        self._metadataLogSize += _METADATA_REC_LEN + len(body)
+
+    def _maybeCompactMetadata(self):
+        """Helper: compact the metadata log if it has grown too large
+           relative to its contents.
+
+           Callers must hold self._lock."""
+        if self._metadataLogRecords > max(METADATA_LOG_MIN_COMPACT,
+                              METADATA_LOG_SLACK*len(self._metadata_cache)):
+            self._compactMetadata()
+
+    def _compactMetadata(self):
+        """Helper: rewrite the metadata log to hold only one record for each
+           live handle.  We write the new log to a temporary file, then move
+           it over the old one, so the log on disk is never incomplete.
+
+           Callers must hold self._lock."""
+        fname = os.path.join(self.dir, METADATA_LOG)
+        self._metadataLog.close()
+        self._metadataLog = open(fname+".tmp", 'wb')
+        self._metadataLogRecords = 0
+        self._metadataLogSize = 0
+        for h, object in self._metadata_cache.items():
+            self._appendMetadata(h, object)
+        os.fsync(self._metadataLog.fileno())
+        self._metadataLog.close()
+        # Keep a link to the old log, so we can wipe it once it's replaced.
+        haveOld = 0
+        if hasattr(os, 'link'):
+            try:
+                os.link(fname, fname+".old")
+                haveOld = 1
+            except OSError:
+                pass
+        replaceFile(fname+".tmp", fname)
+        if haveOld:
+            secureDelete([fname+".old"])
+        self._openMetadataLog()
+
+    def cleanMetadata(self,secureDeleteFn=None):
+        """Find all orphaned metadata and remove it.  (secureDeleteFn is
+           ignored; it is here for backward compatibility.)"""
+        try:
+            self._lock.acquire()
+            hSet = self._catalog["msg"]
+            nRemoved = 0
+            for h in self._metadata_cache.keys():
+                if hSet.has_key(h):
+                    continue
+                del self._metadata_cache[h]
+                nRemoved += 1
+            if nRemoved:
+                LOG.warn("Removing %s orphaned metadata entries from %s",
+                         nRemoved, self.dir)
+                self._compactMetadata()
+        finally:
+            self._lock.release()
 
     def loadAllMetadata(self, newDataFn):
-        """For all objects in the store, load their metadata into the internal
-           cache.  If any object is missing its metadata, create metadata for
-           it by invoking newDataFn(handle)."""
+        """For all objects in the store, make sure their metadata is in the
+           internal cache.  If any object is missing its metadata, create
+           metadata for it by invoking newDataFn(handle)."""
         try:
             self._lock.acquire()
-            self._metadata_cache = {}
             for h in self.getAllMessages():
-                try:
-                    self.getMetadata(h)
-                except KeyError:
+                if not self._metadata_cache.has_key(h):
                     LOG.warn("Missing metadata for file %s",h)
                     self.setMetadata(h, newDataFn(h))
-                except CorruptedFile:
-                    continue
         finally:
             self._lock.release()
 
     def getMetadata(self, handle):
-        """Return the metadata associated with a given handle.  If the
-           metadata is damaged, may raise CorruptedFile."""
-        fname = os.path.join(self.dir, "meta_"+handle)
-        if not os.path.exists(fname):
-            raise KeyError(handle)
+        """Return the metadata associated with a given handle.  Raises
+           KeyError if there is none."""
         try:
             self._lock.acquire()
-            try:
-                return self._metadata_cache[handle]
-            except KeyError:
-                pass
-            f = open(fname, 'rb')
-            try:
-                res = cPickle.load(f)
-            except cPickle.UnpicklingError, e:
-                LOG.error("Found damaged metadata for %s in filestore %s: %s",
-                          handle, self.dir, str(e))
-                self._preserveCorrupted(handle)
-                raise CorruptedFile()
-            f.close()
-            self._metadata_cache[handle] = res
-            return res
+            return self._metadata_cache[handle]
         finally:
             self._lock.release()
 
     def setMetadata(self, handle, object):
         """Change the metadata associated with a given handle."""
-        # On windows or (old-school) mac, binary != text.
-        O_BINARY = getattr(os, 'O_BINARY', 0)
-        flags = os.O_WRONLY|os.O_CREAT|os.O_TRUNC|O_BINARY
         try:
             self._lock.acquire()
-            fname = os.path.join(self.dir, "inpm_"+handle)
-            f = os.fdopen(os.open(fname, flags, 0600), "wb")
-            cPickle.dump(object, f, 1)
-            self.finishMessage(f, handle, _ismeta=1)
+            self._appendMetadata(handle, object)
             self._metadata_cache[handle] = object
+            self._maybeCompactMetadata()
             return handle
         finally:
             self._lock.release()
@@ -448,16 +923,41 @@ class BaseMetadataStore(BaseStore):
     def _doRemove(self, handle, newState):
         try:
             self._lock.acquire()
-            # Remove the message before the metadata, so we don't have
-            # a message without metadata.
             BaseStore._doRemove(self, handle, newState)
-            if os.path.exists(os.path.join(self.dir, "meta_"+handle)):
-                self._changeState(handle, "meta", newState+"m")
-
-            try:
+            if self._metadata_cache.has_key(handle):
                 del self._metadata_cache[handle]
-            except KeyError:
-                pass
+                self._appendMetadata(handle, None, delete=1)
+                self._maybeCompactMetadata()
+        finally:
+            self._lock.release()
+
+    def removeAll(self, secureDeleteFn=None):
+        """Removes all messages and metadata from this filestore."""
+        try:
+            self._lock.acquire()
+            self._metadata_cache = {}
+            self._compactMetadata()
+            BaseStore.removeAll(self, secureDeleteFn)
+        finally:
+            self._lock.release()
+
+    def sync(self):
+        """Make sure that the metadata log is flushed to disk."""
+        try:
+            self._lock.acquire()
+            self._metadataLog.flush()
+            os.fsync(self._metadataLog.fileno())
+        finally:
+            self._lock.release()
+
+    def close(self):
+        """Release the metadata log.  The store must not be used after this
+           is called."""
+        try:
+            self._lock.acquire()
+            if self._metadataLog is not None:
+                self._metadataLog.close()
+                self._metadataLog = None
         finally:
             self._lock.release()
 
@@ -524,6 +1024,273 @@ class MixedMetadataStore(BaseMetadataStore, StringMetadataStoreMixin,
         StringMetadataStoreMixin.__init__(self)
         ObjectMetadataStoreMixin.__init__(self)
 
+class SegmentedStringStore:
+    """A SegmentedStringStore is an unordered collection of strings, all
+       no longer than a fixed record length, with the same queueMessage,
+       messageContents, removeMessage, and getAllMessages operations as a
+       StringStore.
+
+       Instead of keeping each string in its own file, we keep them in
+       fixed-size slots within a set of preallocated segment files, and
+       keep a small index of which slots are in use.  Storing or removing
+       a string therefore costs a couple of writes to files that are
+       already open, rather than a create, a rename, and an unlink -- which
+       matters a great deal for a busy server's packet queues.
+
+       Implementation: the store is a directory containing:
+             seg_NNNN   (A segment file with SLOTS_PER_SEGMENT slots of
+                         recordLen bytes each.)
+             index      (An array of INDEX_ENTRY_LEN-byte entries, one
+                         for each slot in each segment.)
+       Each index entry holds a flag byte (1 if the slot is in use), the
+       8-character handle of the string in the slot, and the string's
+       length.  To store a string, we write it to a free slot, then mark
+       the slot as used in the index.  To remove a string, we mark its
+       slot free in the index, then overwrite the slot with zeros.
+
+       Like BaseStore, this class is threadsafe; use lock() and unlock()
+       to make multistep operations atomic.
+       """
+    ## Fields:
+    # dir -- the location of the store.
+    # recordLen -- the largest string we can store.
+    # _segments -- a list of file descriptors, open for reading and
+    #     writing, for each of our segment files in order.
+    # _indexFD -- a file descriptor open for reading and writing the index.
+    # _slots -- a map from handle to the index of the slot holding it.
+    # _free -- a heap of the indices of all unused slots.  We always use
+    #     the lowest-numbered free slot, so that cleanQueue can release
+    #     segments at the end of the store once they are empty.
+    # _lock -- a lock to protect all of the above.
+
+    # Number of slots to allocate in each segment file.
+    SLOTS_PER_SEGMENT = 256
+    # Format and length of an index entry.
+    INDEX_ENTRY_FORMAT = "!B8sL3x"
+    INDEX_ENTRY_LEN = 16
+
+    def __init__(self, location, recordLen, create=0):
+        """Open a SegmentedStringStore in the directory 'location', to hold
+           strings of up to 'recordLen' bytes.  If 'create' is true,
+           creates the directory if necessary."""
+        self._lock = threading.RLock()
+        self.dir = location
+        self.recordLen = recordLen
+
+        if not os.path.isabs(location):
+            LOG.warn("Directory path %s isn't absolute.", location)
+        if os.path.exists(location) and not os.path.isdir(location):
+            raise MixFatalError("%s is not a directory" % location)
+        createPrivateDir(location, nocreate=(not create))
+
+        self._segments = []
+        while 1:
+            fn = os.path.join(self.dir, "seg_%04d"%len(self._segments))
+            if not os.path.exists(fn):
+                break
+            self._segments.append(os.open(fn, os.O_RDWR|_O_BINARY, 0600))
+        self._indexFD = os.open(os.path.join(self.dir, "index"),
+                                os.O_RDWR|os.O_CREAT|_O_BINARY, 0600)
+
+        self._slots = {}
+        self._free = []
+        nSlots = len(self._segments)*self.SLOTS_PER_SEGMENT
+        index = _readAll(self._indexFD, 0, nSlots*self.INDEX_ENTRY_LEN)
+        for i in xrange(nSlots):
+            entry = index[i*self.INDEX_ENTRY_LEN:(i+1)*self.INDEX_ENTRY_LEN]
+            if len(entry) == self.INDEX_ENTRY_LEN:
+                used, handle, _ = struct.unpack(self.INDEX_ENTRY_FORMAT, entry)
+            else:
+                used = 0
+            if used and not self._slots.has_key(handle):
+                self._slots[handle] = i
+            else:
+                self._free.append(i)
+
+    def lock(self):
+        """Prevent access to this filestore from other threads."""
+        self._lock.acquire()
+
+    def unlock(self):
+        """Release the lock on this filestore."""
+        self._lock.release()
+
+    def count(self, recount=0):
+        """Returns the number of strings in the filestore."""
+        return len(self._slots)
+
+    def getAllMessages(self):
+        """Returns handles for all strings currently in the filestore.
+           Note: this ordering is not guaranteed to be random."""
+        try:
+            self._lock.acquire()
+            return self._slots.keys()
+        finally:
+            self._lock.release()
+
+    def pickRandom(self, count=None):
+        """Returns a list of 'count' handles to strings in this filestore,
+           as for BaseStore.pickRandom."""
+        return getCommonPRNG().shuffle(self.getAllMessages(), count)
+
+    def messageExists(self, handle):
+        """Return true iff this filestore contains a string with the handle
+           'handle'."""
+        return self._slots.has_key(handle)
+
+    def _getSlot(self, handle):
+        """Helper: return the (file descriptor, offset) of the slot holding
+           the string 'handle'.  Raise IOError if there is no such string."""
+        try:
+            idx = self._slots[handle]
+        except KeyError:
+            raise IOError(errno.ENOENT, "No such message", handle)
+        seg, slot = divmod(idx, self.SLOTS_PER_SEGMENT)
+        return self._segments[seg], slot*self.recordLen
+
+    def _writeIndex(self, idx, used, handle, length):
+        """Helper: write the index entry for slot 'idx'."""
+        os.lseek(self._indexFD, idx*self.INDEX_ENTRY_LEN, 0)
+        os.write(self._indexFD, struct.pack(self.INDEX_ENTRY_FORMAT,
+                                            used, handle, length))
+
+    def _addSegment(self):
+        """Helper: create and preallocate a new segment file, and mark its
+           slots as free."""
+        fn = os.path.join(self.dir, "seg_%04d"%len(self._segments))
+        LOG.debug("Adding segment %s", fn)
+        fd = os.open(fn, os.O_RDWR|os.O_CREAT|os.O_TRUNC|_O_BINARY, 0600)
+        zeros = "\x00"*self.recordLen
+        for _ in xrange(self.SLOTS_PER_SEGMENT):
+            os.write(fd, zeros)
+        first = len(self._segments)*self.SLOTS_PER_SEGMENT
+        self._segments.append(fd)
+        for idx in xrange(first, first+self.SLOTS_PER_SEGMENT):
+            heapq.heappush(self._free, idx)
+
+    def queueMessage(self, contents):
+        """Stores 'contents' in the filestore, and returns a handle to it."""
+        if len(contents) > self.recordLen:
+            raise MixError("String too long for store (%s > %s bytes)" %(
+                len(contents), self.recordLen))
+        try:
+            self._lock.acquire()
+            while 1:
+                handle = binascii.b2a_base64(
+                    getCommonPRNG().getBytes(6)).strip().replace("/","-")
+                if not self._slots.has_key(handle):
+                    break
+            if not self._free:
+                self._addSegment()
+            idx = heapq.heappop(self._free)
+            self._slots[handle] = idx
+            fd, offset = self._getSlot(handle)
+            os.lseek(fd, offset, 0)
+            os.write(fd, contents)
+            self._writeIndex(idx, 1, handle, len(contents))
+            return handle
+        finally:
+            self._lock.release()
+
+    def messageContents(self, handle):
+        """Given a handle, returns the contents of the corresponding
+           string."""
+        try:
+            self._lock.acquire()
+            fd, offset = self._getSlot(handle)
+            os.lseek(self._indexFD,
+                     self._slots[handle]*self.INDEX_ENTRY_LEN, 0)
+            _, _, length = struct.unpack(self.INDEX_ENTRY_FORMAT,
+                                  os.read(self._indexFD, self.INDEX_ENTRY_LEN))
+            return _readAll(fd, offset, length)
+        finally:
+            self._lock.release()
+
+    def removeMessage(self, handle):
+        """Given a handle, removes the corresponding string from the
+           filestore, overwriting its slot."""
+        try:
+            self._lock.acquire()
+            fd, offset = self._getSlot(handle)
+            idx = self._slots[handle]
+            self._writeIndex(idx, 0, "\x00"*8, 0)
+            os.lseek(fd, offset, 0)
+            os.write(fd, "\x00"*self.recordLen)
+            del self._slots[handle]
+            heapq.heappush(self._free, idx)
+        finally:
+            self._lock.release()
+
+    def removeAll(self, secureDeleteFn=None):
+        """Removes all strings from this filestore."""
+        try:
+            self._lock.acquire()
+            for h in self._slots.keys():
+                self.removeMessage(h)
+            self.cleanQueue(secureDeleteFn)
+        finally:
+            self._lock.release()
+
+    def cleanQueue(self, secureDeleteFn=None):
+        """Release any segment files at the end of the store that hold
+           no strings.  (Removed strings are already overwritten, so
+           secureDeleteFn is not needed.)"""
+        try:
+            self._lock.acquire()
+            used = {}
+            for idx in self._slots.values():
+                used[idx / self.SLOTS_PER_SEGMENT] = 1
+            nSegs = len(self._segments)
+            while nSegs and not used.has_key(nSegs-1):
+                nSegs -= 1
+            if nSegs == len(self._segments):
+                return
+            LOG.debug("Removing %s empty segments from %s",
+                      len(self._segments)-nSegs, self.dir)
+            for seg in xrange(nSegs, len(self._segments)):
+                os.close(self._segments[seg])
+                os.unlink(os.path.join(self.dir, "seg_%04d"%seg))
+            del self._segments[nSegs:]
+            nSlots = nSegs*self.SLOTS_PER_SEGMENT
+            os.ftruncate(self._indexFD, nSlots*self.INDEX_ENTRY_LEN)
+            self._free = [ idx for idx in self._free if idx < nSlots ]
+            heapq.heapify(self._free)
+        finally:
+            self._lock.release()
+
+    def sync(self):
+        """Flush all pending changes to disk."""
+        try:
+            self._lock.acquire()
+            for fd in self._segments + [self._indexFD]:
+                os.fsync(fd)
+        finally:
+            self._lock.release()
+
+    def close(self):
+        """Release resources associated with this store."""
+        try:
+            self._lock.acquire()
+            for fd in self._segments + [self._indexFD]:
+                os.close(fd)
+            self._segments = []
+            self._indexFD = None
+        finally:
+            self._lock.release()
+
+def _readAll(fd, offset, length):
+    """Helper: read and return up to 'length' bytes from the file
+       descriptor 'fd', starting at 'offset'."""
+    os.lseek(fd, offset, 0)
+    chunks = []
+    while length > 0:
+        s = os.read(fd, length)
+        if not s:
+            break
+        chunks.append(s)
+        length -= len(s)
+    return "".join(chunks)
+
 # ======================================================================
 # Database wrappers
 
@@ -12,7 +12,8 @@
    easy-to-verify reference implementation of the protocol.)
    """
 
-__all__ = [ "MMTPClientConnection", "sendPackets", "DeliverableMessage" ]
+__all__ = [ "MMTPClientConnection", "sendPackets", "sendPacketsToMany",
+            "DeliverableMessage" ]
 
 import socket
 import sys
@@ -56,8 +57,12 @@ class MMTPClientConnection(mixminion.TLSConnection.TLSConnection):
     # Which MMTP versions do we understand?
     PROTOCOL_VERSIONS = ['0.3']
     # If we've written WRITEAHEAD packets without receiving any acks, we wait
-    # for an ack before sending any more.
+    # for an ack before sending any more.  This is only where we start: as
+    # acks arrive, we adjust the window between MIN_WRITEAHEAD and
+    # MAX_WRITEAHEAD packets, depending on how long the acks take.
     WRITEAHEAD = 6
+    MIN_WRITEAHEAD = 2
+    MAX_WRITEAHEAD = 64
     # Length of a single transmission unit (control string, packet, checksum)
     MESSAGE_LEN = 6 + (1<<15) + 20
     # Length of a single acknowledgment (control string, digest)
@@ -77,18 +82,31 @@ class MMTPClientConnection(mixminion.TLSConnection.TLSConnection):
     # nPacketsAcked: total number of acks received from the TLS connection
     # expectedAcks: list of acceptAck,rejectAck tuples for the packets
     #   that we've sent but haven't gotten acks for.
+    # sendTimes: list of the times at which we queued each packet in
+    #   expectedAcks for writing.
+    # window: the number of packets we currently allow to be sent but not
+    #   yet acknowledged.  (A float; we use its integer part.)
+    # rtt: a smoothed average of how long we've waited for each ack, or
+    #   None if we haven't gotten any acks.
+    # minRTT: the shortest time we've waited for an ack, or None.
     # _isConnected: flag: true if the TLS connection been completed,
     #   and no errors have been encountered.
     # _isFailed: flag: has this connection encountered any errors?
     # _isAlive: flag: if we put another packet on this connection, will the
     #   packet maybe get delivered?
+    # keepAlive: flag: if true, we leave the connection open once all our
+    #   packets are acknowledged, so that more packets can be sent on it
+    #   later.  Otherwise, we close it as soon as we're done.
+    # idleSince: None if we have packets to send or are waiting for acks;
+    #   otherwise, the time at which we finished sending our last packet.
 
     ####
     # External interface
     ####
     def __init__(self, targetFamily, targetAddr, targetPort, targetKeyID,
-                 serverName=None, context=None, certCache=None):
-        """Initialize a new MMTPClientConnection."""
+                 serverName=None, context=None, certCache=None, keepAlive=0):
+        """Initialize a new MMTPClientConnection.  If 'keepAlive' is true,
+           leave the connection open once all of its packets are sent."""
         assert targetFamily in (mixminion.NetUtils.AF_INET,
                                 mixminion.NetUtils.AF_INET6)
         if context is None:
@@ -125,10 +143,15 @@ class MMTPClientConnection(mixminion.TLSConnection.TLSConnection):
         self.packets = []
         self.pendingPackets = []
         self.expectedAcks = []
+        self.sendTimes = []
+        self.window = float(self.WRITEAHEAD)
+        self.rtt = self.minRTT = None
         self.nPacketsSent = self.nPacketsAcked = self.nPacketsTotal =0
         self._isConnected = 0
         self._isFailed = 0
         self._isAlive = 1
+        self.keepAlive = keepAlive
+        self.idleSince = None
         EventStats.log.attemptedConnect()
         LOG.debug("Opening client connection to %s",self.address)
         self.beginConnecting()
@@ -143,6 +166,22 @@ class MMTPClientConnection(mixminion.TLSConnection.TLSConnection):
         # If we're connected, maybe start sending the packet we just added.
         self._updateRWState()
 
+    def isIdle(self):
+        """Return true iff this connection is open, but has no packets to
+           send or acknowledgments to wait for."""
+        return self._isAlive and self.idleSince is not None
+
+    def closeIdle(self):
+        """Shut down this connection, which must be idle.  (Don't let the
+           shutdown time out immediately just because we've been quiet.)"""
+        assert self.isIdle()
+        LOG.debug("Closing idle connection to %s", self.address)
+        self._isConnected = 0
+        self._isAlive = 0
+        self.idleSince = None
+        self.lastActivity = time.time()
+        self.startShutdown()
+
     ####
     # Implementation
     ####
@@ -151,6 +190,7 @@ class MMTPClientConnection(mixminion.TLSConnection.TLSConnection):
         # There _is_ a next available packet, right?
         assert self.packets and self._isConnected
         pkt = self.packets.pop(0)
+        self.idleSince = None
 
         if pkt.isJunk():
             control = "JUNK\r\n"
@@ -175,30 +215,75 @@ class MMTPClientConnection(mixminion.TLSConnection.TLSConnection):
         rejectedAck = "REJECTED\r\n" + sha1(m+"REJECTED")
         assert len(acceptedAck) == len(rejectedAck) == self.ACK_LEN
         self.expectedAcks.append( (acceptedAck, rejectedAck) )
+        self.sendTimes.append(time.time())
         self.pendingPackets.append(pkt)
         self.beginWriting(data)
         self.nPacketsSent += 1
 
     def _updateRWState(self):
         """Helper: if we have any queued packets that haven't been sent yet,
-           and we aren't waiting for WRITEAHEAD acks, and we're connected,
+           and we aren't waiting for a full window of acks, and we're
+           connected,
            start sending the pending packets.
         """
         if not self._isConnected: return
 
-        while self.nPacketsSent < self.nPacketsAcked + self.WRITEAHEAD:
+        while self.nPacketsSent < self.nPacketsAcked + int(self.window):
             if not self.packets:
                 break
             LOG.trace("Queueing new packet for %s",self.address)
             self._startSendingNextPacket()
 
         if self.nPacketsAcked == self.nPacketsSent:
-            LOG.debug("Successfully relayed all packets to %s",self.address)
+            if self.idleSince is not None:
+                # We already know we're done.
+                return
+            LOG.debug("Successfully relayed all packets to %s %s",
+                      self.address, self.getWindowStatus())
+            if self.keepAlive:
+                # Stay connected, and wait for more packets.
+                self.idleSince = time.time()
+                self.allPacketsSent()
+                return
             self.allPacketsSent()
             self._isConnected = 0
             self._isAlive = 0
             self.startShutdown()
 
+    def _noteAckTime(self, rtt):
+        """Helper: we just received an ack 'rtt' seconds after we queued its
+           packet.  Adjust the window.
+
+           We compare the average ack time with the shortest we've seen,
+           which is about what an ack takes when nothing is queued ahead of
+           it.  If acks are taking about that long, and we have packets
+           waiting for room in the window, the link isn't full: grow the
+           window by about one packet per round trip.  If acks are taking
+           much longer, we're only filling buffers along the way: shrink
+           it.
+        """
+        if self.minRTT is None or rtt < self.minRTT:
+            self.minRTT = rtt
+        if self.rtt is None:
+            self.rtt = rtt
+        else:
+            self.rtt = (7*self.rtt + rtt) / 8.0
+
+        if self.rtt > 2*self.minRTT:
+            self.window = max(self.MIN_WRITEAHEAD,
+                              self.window - 1.0/self.window)
+        elif self.rtt < 1.5*self.minRTT and self.packets:
+            self.window = min(self.MAX_WRITEAHEAD,
+                              self.window + 1.0/self.window)
+
+    def getWindowStatus(self):
+        """Return a string describing this connection's current window and
+           ack times."""
+        if self.rtt is None:
+            return "(window %d)" % int(self.window)
+        return "(window %d, rtt %.3fs, min %.3fs)" % (
+            int(self.window), self.rtt, self.minRTT)
+
     def _failPendingPackets(self):
         "Helper: tell all unacknowledged packets to fail."
         self._isConnected = 0
@@ -297,6 +382,7 @@ class MMTPClientConnection(mixminion.TLSConnection.TLSConnection):
                 return
             ack = self.getInbuf(self.ACK_LEN, clear=1)
             good, bad = self.expectedAcks.pop(0)
+            self._noteAckTime(time.time() - self.sendTimes.pop(0))
             if ack == good:
                 LOG.debug("Packet delivered to %s",self.address)
                 self.nPacketsAcked += 1
@@ -335,6 +421,14 @@ class MMTPClientConnection(mixminion.TLSConnection.TLSConnection):
     def onClosed(self): pass
     def doneWriting(self): pass
     def receivedShutdown(self):
+        if self.isIdle():
+            # The other side is allowed to close a connection we weren't
+            # using.
+            LOG.debug("%s closed our idle connection", self.address)
+            self._isConnected = 0
+            self._isAlive = 0
+            self.idleSince = None
+            return
         LOG.warn("Received unexpected shutdown from %s", self.address)
         self._failPendingPackets()
     def shutdownFinished(self): pass
@@ -394,6 +488,76 @@ def sendPackets(routing, packetList, timeout=300, callback=None):
        callback -- None, or a function to call with a index into packetList
            after each successful packet delivery.
     """
+    err = sendPacketsToMany([(routing, packetList, callback)], timeout, 1)[0]
+    if err is not None:
+        raise err
+
+def sendPacketsToMany(batches, timeout=300, maxConnections=8):
+    """Sends packets to several servers at once.  'batches' is a list of
+       (routing, packetList, callback) tuples, each as the arguments to
+       sendPackets.  We open connections to up to 'maxConnections' servers
+       at a time, and run them all from a single select loop, so that
+       delivering to many servers takes about as long as delivering to the
+       slowest one.
+
+       Returns a list holding one entry for each batch: None if every
+       packet in the batch was delivered, or a MixProtocolError describing
+       what went wrong.
+    """
+    import select
+    results = [None] * len(batches)
+    # Indices of the batches we haven't started yet, last one first.
+    waiting = range(len(batches))
+    waiting.reverse()
+    # Map from fd to (batch index, connection, deliverables, server name)
+    active = {}
+    # Map from fd to the latest wantRead, wantWrite tuple for each connection
+    state = {}
+    while waiting or active:
+        while waiting and len(active) < maxConnections:
+            idx = waiting.pop()
+            routing, packetList, callback = batches[idx]
+            try:
+                con, deliverables, serverName = _openConnection(
+                    routing, packetList, callback)
+            except MixProtocolError, e:
+                results[idx] = e
+                continue
+            fd = con.fileno()
+            active[fd] = (idx, con, deliverables, serverName)
+            state[fd] = con.getStatus()[:2]
+        if not active:
+            break
+
+        rfds, wfds, xfds = [], [], []
+        for fd, (wr, ww) in state.items():
+            if wr: rfds.append(fd)
+            if ww: wfds.append(fd)
+            if ww==2: xfds.append(fd)
+
+        rfds,wfds,xfds=select.select(rfds,wfds,xfds,3)
+        now = time.time()
+        for fd in active.keys():
+            idx, con, deliverables, serverName = active[fd]
+            wr,ww,isopen,_=con.process(fd in rfds, fd in wfds, 0)
+            if isopen:
+                if con.tryTimeout(now-timeout):
+                    isopen = 0
+            if isopen:
+                state[fd] = wr, ww
+            else:
+                del active[fd]
+                del state[fd]
+                results[idx] = _checkDelivery(con, deliverables, serverName)
+
+    return results
+
+def _openConnection(routing, packetList, callback):
+    """Helper for sendPacketsToMany: open a new MMTPClientConnection to the
+       server at 'routing', and queue all the packets in 'packetList' on it.
+       Returns a tuple of the connection, a list of DeliverableString
+       objects for the packets, and the name of the server.  Raises
+       MixProtocolError if we can't start connecting."""
     # Find out where we're connecting to.
     serverName = mixminion.ServerInfo.displayServerByRouting(routing)
     if isinstance(routing, IPV4Info):
@@ -430,40 +594,23 @@ def sendPackets(routing, packetList, timeout=300, callback=None):
         deliverables.append(pkt)
         con.addPacket(pkt)
 
-    # Use select to run the connection until it's done.
-    import select
-    fd = con.fileno()
-    wr,ww,isopen = con.getStatus()
-    while isopen:
-        if wr:
-            rfds = [fd]
-        else:
-            rfds = []
-        if ww:
-            wfds = [fd]
-        else:
-            wfds = []
-        if ww==2:
-            xfds = [fd]
-        else:
-            xfds = []
-
-        rfds,wfds,xfds=select.select(rfds,wfds,xfds,3)
-        now = time.time()
-        wr,ww,isopen,_=con.process(fd in rfds, fd in wfds, 0)
-        if isopen:
-            if con.tryTimeout(now-timeout):
-                isopen = 0
+    return con, deliverables, serverName
 
-    # If anything wasn't delivered, raise MixProtocolError.
+def _checkDelivery(con, deliverables, serverName):
+    """Helper for sendPacketsToMany: once the connection 'con' is closed,
+       return None if all of 'deliverables' were delivered, and a
+       MixProtocolError otherwise."""
+    # If anything wasn't delivered, it's an error.
     for d in deliverables:
         if d._failed:
-            raise MixProtocolError("Error occurred while delivering packets to %s"%
-                                   serverName)
+            return MixProtocolError(
+                "Error occurred while delivering packets to %s"%serverName)
 
-    # If the connection failed, raise MixProtocolError.
+    # If the connection failed, it's an error.
     if con._isFailed:
-        raise MixProtocolError("Error occurred on connection to %s"%serverName)
+        return MixProtocolError("Error occurred on connection to %s"%serverName)
+
+    return None
 
 def pingServer(routing, timeout=60):
     """Try to connect to a server and send a junk packet.
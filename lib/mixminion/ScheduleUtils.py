@@ -6,6 +6,7 @@
    Simple implementation of a block-until-it's-time-to-do-something scheduler.
    """
 
+import heapq
 import time
 import threading
 
@@ -132,43 +133,84 @@ class RecurringComplexBackgroundEvent(RecurringBackgroundEvent):
             self.lock.release()
 
 class Scheduler:
-    """Base class: used to run a bunch of events periodically."""
+    """Base class: used to run a bunch of events periodically.
+
+       We keep the events whose next times we know in a heap, so that we
+       can always tell exactly when the next event is due without looking
+       at all of them."""
     ##Fields:
-    # scheduledEvents: a list of ScheduledEvent objects.
-    # schedLock: a threading.RLock object to protect the list scheduledEvents
+    # scheduledEvents: a heap of (time, seq, ScheduledEvent) tuples, one for
+    #   each event whose next time is known.  (An event's time can change
+    #   behind our back; we notice when it gets to the top of the heap.)
+    # unknownEvents: a list of ScheduledEvent objects whose next time is
+    #   currently unknown (None).
+    # nextSeq: a counter used to break ties between events scheduled for
+    #   the same time, in the order they were scheduled.
+    # schedLock: a threading.RLock object to protect the fields above
     #   (but not the events themselves).
     #XXXX008 needs more tests
     def __init__(self):
         """Create a new scheduler."""
         self.scheduledEvents = []
+        self.unknownEvents = []
+        self.nextSeq = 0
         self.schedLock = threading.RLock()
 
+    def _addEvent(self, event):
+        """Helper: file 'event' according to its next time.  Caller must
+           hold schedLock."""
+        when = event.getNextTime()
+        if when == -1:
+            return
+        elif when is None:
+            self.unknownEvents.append(event)
+        else:
+            heapq.heappush(self.scheduledEvents, (when, self.nextSeq, event))
+            self.nextSeq += 1
+
+    def _checkUnknownEvents(self):
+        """Helper: move every event whose next time has become known onto
+           the heap.  Caller must hold schedLock."""
+        if not self.unknownEvents:
+            return
+        events = self.unknownEvents
+        self.unknownEvents = []
+        for e in events:
+            self._addEvent(e)
+
+    def _getFirst(self):
+        """Helper: return the (time, seq, event) tuple at the top of the
+           heap, after making sure its time is still accurate; or None if
+           the heap is empty.  Caller must hold schedLock."""
+        heap = self.scheduledEvents
+        while heap:
+            when, _, event = heap[0]
+            if event.getNextTime() == when:
+                return heap[0]
+            heapq.heappop(heap)
+            self._addEvent(event)
+        return None
+
     def firstEventTime(self):
-        """Return the time at which an event will first occur."""
+        """Return the time at which an event will first occur, or -1 if
+           there is no such event."""
         self.schedLock.acquire()
         try:
-            if not self.scheduledEvents:
+            self._checkUnknownEvents()
+            first = self._getFirst()
+            if first is None:
                 return -1
-            first = 0
-            for e in self.scheduledEvents:
-                t = e.getNextTime()
-                if t in (-1,None): continue
-                if not first or t < first:
-                    first = t
-            return first
+            return first[0]
         finally:
             self.schedLock.release()
 
     def scheduleEvent(self, event):
         """Add a ScheduledEvent to this scheduler"""
-        when = event.getNextTime()
-        if when == -1:
-            return
         self.schedLock.acquire()
         try:
-            self.scheduledEvents.append(event)
+            self._addEvent(event)
         finally:
-            self.schedLock.acquire()
+            self.schedLock.release()
 
     #XXXX008 -- these are only used for testing.
     def scheduleOnce(self, when, name, cb):
@@ -184,14 +226,27 @@ class Scheduler:
         """Run all events that need to get called at the time 'now'."""
         if now is None:
             now = time.time()
+        runnable = []
         self.schedLock.acquire()
         try:
-            events = [(e.getNextTime(),e) for e in self.scheduledEvents]
-            self.scheduledEvents = [e for t,e in events if t != -1]
-            runnable = [(t,e) for t,e in events
-                        if t not in (-1,None) and t <= now]
+            self._checkUnknownEvents()
+            while 1:
+                first = self._getFirst()
+                if first is None or first[0] > now:
+                    break
+                heapq.heappop(self.scheduledEvents)
+                runnable.append(first[2])
         finally:
             self.schedLock.release()
-        runnable.sort()
-        for _,e in runnable:
-            e()
+        # Run each event at most once, even if it reschedules itself for
+        # a time that has already passed.
+        try:
+            for e in runnable:
+                e()
+        finally:
+            self.schedLock.acquire()
+            try:
+                for e in runnable:
+                    self._addEvent(e)
+            finally:
+                self.schedLock.release()
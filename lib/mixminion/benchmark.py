@@ -543,6 +543,7 @@ def serverQueueTiming():
 class DummyLog:
     def seenHash(self,h): return 0
     def logHash(self,h): pass
+    def logHashes(self,hs): return [0]*len(hs)
 
 def serverProcessTiming():
     print "#================= SERVER PROCESS ====================="
@@ -564,6 +565,9 @@ def serverProcessTiming():
     print "Server process (swap, no log)", timeit(
         lambda sp=sp, m_swap=m_swap: sp.processPacket(m_swap), 100)
 
+    print "Server process (batch of 10, no swap, no log)", timeit(
+        lambda sp=sp, m=[m_noswap]*10: sp.processPackets(m), 10)
+
 def encodingTiming():
     print "#=============== END-TO-END ENCODING =================="
     shortP = "hello world"
@@ -5,13 +5,20 @@
    Persistent memory for the hashed secrets we've seen.  Used by
    PacketHandler to prevent replay attacks."""
 
+import array
+import binascii
+import bisect
+import mmap
 import os
+import stat
+import struct
 import threading
 import mixminion.Filestore
-from mixminion.Common import MixFatalError, LOG, secureDelete
+from mixminion.Common import MixFatalError, LOG, ceilDiv, createPrivateDir, \
+     readFile, replaceFile, secureDelete
 from mixminion.Packet import DIGEST_LEN
 
-__all__ = [ 'HashLog', 'getHashLog', 'deleteHashLog' ]
+__all__ = [ 'HashLog', 'SegmentHashLog', 'getHashLog', 'deleteHashLog' ]
 
 # FFFF Mechanism to force a different default db module.
 
@@ -37,7 +44,7 @@ def getHashLog(filename, keyid):
             LOG.trace("getHashLog() returning open hashlog at %s",filename)
         except KeyError:
             LOG.trace("getHashLog() opening hashlog at %s",filename)
-            hl = HashLog(filename, keyid)
+            hl = SegmentHashLog(filename, keyid)
             _OPEN_HASHLOGS[filename] = (keyid, hl)
         return hl
     finally:
@@ -57,7 +64,7 @@ def deleteHashLog(filename):
         remove = []
         parent,name = os.path.split(filename)
         prefix1 = name+"."
-        prefix2 = name+"."
+        prefix2 = name+"_jrnl"
         if os.path.exists(parent):
             for fn in os.listdir(parent):
                 if fn.startswith(prefix1) or fn.startswith(prefix2):
@@ -67,7 +74,28 @@ def deleteHashLog(filename):
     finally:
         _HASHLOG_DICT_LOCK.release()
 
-class HashLog(mixminion.Filestore.BooleanJournaledDBBase):
+class _HashLogBase:
+    """Mixin: operations shared by all hash log implementations.  Users
+       must provide _lock, seenHash, and logHash."""
+    def logHashes(self, hashes):
+        """Given a list of digests, log every one that we haven't seen
+           before.  Return a list of booleans, in the same order as hashes,
+           that are true for every digest we had already seen -- including
+           digests that appear earlier in the same list."""
+        self._lock.acquire()
+        try:
+            seen = []
+            for hash in hashes:
+                if self.seenHash(hash):
+                    seen.append(1)
+                else:
+                    self.logHash(hash)
+                    seen.append(0)
+            return seen
+        finally:
+            self._lock.release()
+
+class HashLog(mixminion.Filestore.BooleanJournaledDBBase, _HashLogBase):
     """A HashLog is a file containing a list of message digests that we've
        already processed.
 
@@ -85,7 +113,16 @@ class HashLog(mixminion.Filestore.BooleanJournaledDBBase):
 
        HashLogs are implemented using Python's anydbm interface.  This defaults
        to using Berkeley DB, GDBM, or --if you have none of these-- a flat
-       text file."""
+       text file.  The server no longer uses them directly: getHashLog
+       returns a SegmentHashLog, which imports any existing HashLog when
+       it is first opened.
+
+       Since nearly every packet we see is new, we keep a _DigestFilter of
+       every hash in the log, so that we can answer most lookups without
+       touching the database."""
+    ## Fields:
+    # keyid -- the keyid of the key corresponding to this log.
+    # filter -- a _DigestFilter holding every hash in this log.
     def __init__(self, filename, keyid):
         mixminion.Filestore.BooleanJournaledDBBase.__init__(self,
                  filename, "digest hash", 20)
@@ -98,12 +135,50 @@ class HashLog(mixminion.Filestore.BooleanJournaledDBBase):
             self.log["KEYID"] = keyid
             self._syncLog()
 
+        self._rebuildFilter()
+
+    def _rebuildFilter(self, capacity=0):
+        """Helper: reconstruct self.filter from the contents of the
+           database and the journal, making room for at least 'capacity'
+           hashes."""
+        self._lock.acquire()
+        try:
+            hashes = self.getAllHashes()
+            LOG.trace("Building replay filter for %s hashes in %s",
+                      len(hashes), self.filename)
+            self.filter = _DigestFilter(max(capacity, len(hashes)*2))
+            for h in hashes:
+                self.filter.add(h)
+        finally:
+            self._lock.release()
+
+    def getAllHashes(self):
+        """Return a list of every hash in this log."""
+        self._lock.acquire()
+        try:
+            hashes = self.journal.keys()
+            for k in self.log.keys():
+                if len(k) == DIGEST_LEN*2:
+                    hashes.append(binascii.a2b_hex(k))
+            return hashes
+        finally:
+            self._lock.release()
+
     def seenHash(self, hash):
+        if not self.filter.mayContain(hash):
+            return 0
         return self.has_key(hash)
 
     def logHash(self, hash):
         assert len(hash) == DIGEST_LEN
-        self[hash] = 1
+        self._lock.acquire()
+        try:
+            if self.filter.isFull():
+                self._rebuildFilter(self.filter.capacity*2)
+            self.filter.add(hash)
+            self[hash] = 1
+        finally:
+            self._lock.release()
 
     def close(self):
         try:
@@ -116,3 +191,346 @@ class HashLog(mixminion.Filestore.BooleanJournaledDBBase):
         finally:
             _HASHLOG_DICT_LOCK.release()
 
+# Files left behind by the anydbm-based HashLog, relative to its filename.
+_OLD_HASHLOG_SUFFIXES = [ "", "_jrnl", ".db", ".dat", ".dir", ".bak", ".pag" ]
+
+class SegmentHashLog(_HashLogBase):
+    """A SegmentHashLog is a HashLog that keeps its digests in two flat
+       files, rather than in a dbm database:
+
+         - A sorted 'segment' file ('filename.seg'): a short header with
+           the keyid, followed by every merged digest in sorted order.
+           We map it into memory and find digests by binary search.
+         - An append-only 'tail' file ('filename.tail') of the digests
+           logged since the last merge.  We keep these in memory too.
+
+       Logging a digest is a single append to the tail; syncing the log
+       is a single fsync of the tail.  Once the tail grows large enough,
+       we merge it into a new sorted segment and truncate it.
+
+       To avoid touching more than one page of the segment for each
+       lookup, we keep the first digest of every block of the segment in
+       memory, and only search the one block that could hold our digest.
+       Since nearly every packet we see is new, we also keep a
+       _DigestFilter of every digest in the log, so that most lookups
+       never touch the segment at all.
+
+       If we find an old anydbm-based HashLog at 'filename' when we create
+       the segment, we import its digests and remove it."""
+    ## Fields:
+    # filename -- the base name for this log's files.
+    # keyid -- the keyid of the key corresponding to this log.
+    # segFileName, tailFileName -- the names of our segment and tail files.
+    # seg -- a read-only mmap of the segment file.
+    # segOffset -- the offset within the segment of the first digest.
+    # segCount -- the number of digests in the segment.
+    # fence -- a list of the first digest of each BLOCK_ENTRIES-digest
+    #     block of the segment.
+    # tail -- a dict whose keys are the digests in the tail file.
+    # tailFD -- a file descriptor open to append to the tail file.
+    # filter -- a _DigestFilter holding every digest in the segment and
+    #     the tail.
+    # _lock -- a lock to protect all of the above.
+
+    # Magic string to begin the segment file.
+    MAGIC = "MMHLOG1\n"
+    # Number of digests in each block of the segment.  (204 digests fit
+    # in a 4K page.)
+    BLOCK_ENTRIES = 204
+    # We merge the tail once it has max(MIN_MERGE, segCount/8) digests,
+    # or MAX_MERGE digests, whichever is smaller.  This bounds the amount
+    # of copying per logged digest without letting the tail get too big.
+    MIN_MERGE = 8192
+    MAX_MERGE = 131072
+
+    def __init__(self, filename, keyid):
+        """Open or create a SegmentHashLog for the files beginning with
+           'filename', for the key whose keyid is 'keyid'."""
+        self._lock = threading.RLock()
+        self.filename = filename
+        self.keyid = keyid
+        self.segFileName = filename+".seg"
+        self.tailFileName = filename+".tail"
+        self.seg = self.tailFD = None
+
+        parent = os.path.split(filename)[0]
+        createPrivateDir(parent)
+        if not os.path.exists(self.segFileName):
+            self._createSegment()
+        self._openSegment()
+        self._openTail()
+        self._rebuildFilter()
+
+    def _createSegment(self):
+        """Helper: write a new segment file holding the digests from any
+           old-style HashLog at self.filename, and remove the old files."""
+        old = [ self.filename+suffix for suffix in _OLD_HASHLOG_SUFFIXES ]
+        old = [ fn for fn in old if os.path.exists(fn) ]
+        hashes = []
+        if old:
+            LOG.info("Converting hash log at %s to new format",
+                     self.filename)
+            oldLog = HashLog(self.filename, self.keyid)
+            try:
+                hashes = oldLog.getAllHashes()
+            finally:
+                oldLog.close()
+            hashes.sort()
+
+        tmpName = self.segFileName+".tmp"
+        f = open(tmpName, 'wb')
+        try:
+            f.write(self.MAGIC)
+            f.write(struct.pack("!H", len(self.keyid)))
+            f.write(self.keyid)
+            f.write("".join(hashes))
+            f.flush()
+            os.fsync(f.fileno())
+        finally:
+            f.close()
+        replaceFile(tmpName, self.segFileName)
+        if old:
+            secureDelete(old, blocking=1)
+
+    def _openSegment(self):
+        """Helper: map the segment file into memory, check its header, and
+           build self.fence."""
+        f = open(self.segFileName, 'rb')
+        try:
+            header = f.read(len(self.MAGIC)+2)
+            if len(header) != len(self.MAGIC)+2 or \
+                   not header.startswith(self.MAGIC):
+                raise MixFatalError("Bad header on hash log %s"%
+                                    self.segFileName)
+            kLen, = struct.unpack("!H", header[-2:])
+            if f.read(kLen) != self.keyid:
+                raise MixFatalError("Log KEYID does not match current KEYID")
+            size = os.fstat(f.fileno())[stat.ST_SIZE]
+            self.segOffset = len(header)+kLen
+            if (size-self.segOffset) % DIGEST_LEN:
+                raise MixFatalError("Hash log %s has been truncated"%
+                                    self.segFileName)
+            self.segCount = (size-self.segOffset) / DIGEST_LEN
+            self.seg = mmap.mmap(f.fileno(), size, access=mmap.ACCESS_READ)
+        finally:
+            f.close()
+
+        blockLen = self.BLOCK_ENTRIES*DIGEST_LEN
+        seg = self.seg
+        self.fence = [ seg[pos:pos+DIGEST_LEN] for pos in
+                       xrange(self.segOffset, len(seg), blockLen) ]
+
+    def _openTail(self):
+        """Helper: read the tail file into self.tail, and open it for
+           appending."""
+        self.tail = {}
+        data = ""
+        if os.path.exists(self.tailFileName):
+            data = readFile(self.tailFileName, 1)
+        # A partial digest at the end was a write interrupted by a crash;
+        # it was never synced, so we can drop it.
+        good = len(data) - (len(data) % DIGEST_LEN)
+        for pos in xrange(0, good, DIGEST_LEN):
+            h = data[pos:pos+DIGEST_LEN]
+            # This digest may already be in the segment if we crashed
+            # in the middle of a merge.
+            if not self._searchSegment(h)[0]:
+                self.tail[h] = 1
+        self.tailFD = os.open(self.tailFileName,
+                      os.O_WRONLY|os.O_CREAT|os.O_APPEND|getattr(os,'O_BINARY',0),
+                      0600)
+        if good != len(data):
+            os.ftruncate(self.tailFD, good)
+
+    def _rebuildFilter(self, capacity=0):
+        """Helper: reconstruct self.filter from the digests in the segment
+           and the tail, making room for at least 'capacity' digests."""
+        n = self.segCount + len(self.tail)
+        LOG.trace("Building replay filter for %s hashes in %s", n,
+                  self.filename)
+        filt = _DigestFilter(max(capacity, n*2))
+        seg = self.seg
+        for pos in xrange(self.segOffset, len(seg), DIGEST_LEN):
+            filt.add(seg[pos:pos+DIGEST_LEN])
+        for h in self.tail.keys():
+            filt.add(h)
+        self.filter = filt
+
+    def _searchSegment(self, hash):
+        """Helper: return a tuple of (found, idx), where found is true iff
+           'hash' is in the segment, and idx is the index of the first
+           digest in the segment that is >= 'hash'."""
+        b = bisect.bisect_right(self.fence, hash) - 1
+        if b < 0:
+            return 0, 0
+        first = b*self.BLOCK_ENTRIES
+        start = self.segOffset + first*DIGEST_LEN
+        block = self.seg[start:start+self.BLOCK_ENTRIES*DIGEST_LEN]
+        lo, hi = 0, len(block) / DIGEST_LEN
+        while lo < hi:
+            mid = (lo+hi) / 2
+            d = block[mid*DIGEST_LEN:(mid+1)*DIGEST_LEN]
+            if d < hash:
+                lo = mid+1
+            elif d > hash:
+                hi = mid
+            else:
+                return 1, first+mid
+        return 0, first+lo
+
+    def seenHash(self, hash):
+        self._lock.acquire()
+        try:
+            if not self.filter.mayContain(hash):
+                return 0
+            return self.tail.has_key(hash) or self._searchSegment(hash)[0]
+        finally:
+            self._lock.release()
+
+    def logHash(self, hash):
+        assert len(hash) == DIGEST_LEN
+        self._lock.acquire()
+        try:
+            if self.tail.has_key(hash):
+                return
+            if self.filter.isFull():
+                self._rebuildFilter(self.filter.capacity*2)
+            self.filter.add(hash)
+            self.tail[hash] = 1
+            os.write(self.tailFD, hash)
+            if len(self.tail) >= min(max(self.MIN_MERGE, self.segCount/8),
+                                     self.MAX_MERGE):
+                self._merge()
+        finally:
+            self._lock.release()
+
+    def _merge(self):
+        """Helper: write a new segment holding every digest in the old
+           segment and the tail, and truncate the tail."""
+        LOG.debug("Merging %s hashes into hash log %s", len(self.tail),
+                  self.filename)
+        newHashes = self.tail.keys()
+        newHashes.sort()
+        seg = self.seg
+        tmpName = self.segFileName+".tmp"
+        f = open(tmpName, 'wb')
+        try:
+            # Copy the old segment (header included) in runs, inserting
+            # each new digest where it belongs.
+            prev = 0
+            for h in newHashes:
+                found, idx = self._searchSegment(h)
+                if found:
+                    continue
+                pos = self.segOffset + idx*DIGEST_LEN
+                _copyRange(f, seg, prev, pos)
+                f.write(h)
+                prev = pos
+            _copyRange(f, seg, prev, len(seg))
+            f.flush()
+            os.fsync(f.fileno())
+        finally:
+            f.close()
+        # Once the new segment is in place, everything in the tail is
+        # safe to drop.  If we crash before we truncate the tail, we'll
+        # notice the duplicates when we next open the log.
+        self.seg.close()
+        self.seg = None
+        replaceFile(tmpName, self.segFileName)
+        self._openSegment()
+        os.ftruncate(self.tailFD, 0)
+        os.fsync(self.tailFD)
+        self.tail = {}
+
+    def sync(self):
+        """Flush all pending changes to disk."""
+        self._lock.acquire()
+        try:
+            if self.tailFD is not None:
+                os.fsync(self.tailFD)
+        finally:
+            self._lock.release()
+
+    def close(self):
+        """Release resources associated with this log."""
+        try:
+            _HASHLOG_DICT_LOCK.acquire()
+            self._lock.acquire()
+            try:
+                if self.tailFD is not None:
+                    os.fsync(self.tailFD)
+                    os.close(self.tailFD)
+                    self.tailFD = None
+                if self.seg is not None:
+                    self.seg.close()
+                    self.seg = None
+            finally:
+                self._lock.release()
+            try:
+                del _OPEN_HASHLOGS[self.filename]
+            except KeyError:
+                pass
+        finally:
+            _HASHLOG_DICT_LOCK.release()
+
+def _copyRange(f, seg, start, end, chunkSize=1<<20):
+    """Helper: write seg[start:end] to the file 'f', without copying more
+       than chunkSize bytes into memory at a time."""
+    while start < end:
+        f.write(seg[start:min(start+chunkSize, end)])
+        start += chunkSize
+
+class _DigestFilter:
+    """A Bloom filter for a set of DIGEST_LEN-byte digests.  It can tell us
+       that a digest is definitely not in the set, or that it might be.
+       With the default parameters, the false positive rate is under 1%
+       until the filter holds 'capacity' digests.
+
+       Because the digests we store are already the output of a hash
+       function, we use slices of each digest as its bit indices, rather
+       than hashing it again."""
+    ## Fields:
+    # bits -- an array of bytes holding the filter's bits.
+    # nBits -- the number of bits in the filter.
+    # capacity -- the number of digests this filter is sized for.
+    # n -- the number of digests added to this filter so far.
+
+    # Number of bits to allocate per digest.
+    BITS_PER_ENTRY = 10
+    # Smallest capacity we'll allocate.
+    MIN_CAPACITY = 1024
+
+    def __init__(self, capacity):
+        """Create a new empty _DigestFilter with room for 'capacity'
+           digests."""
+        self.capacity = max(capacity, self.MIN_CAPACITY)
+        nBytes = ceilDiv(self.capacity * self.BITS_PER_ENTRY, 8)
+        self.nBits = nBytes * 8
+        self.bits = array.array('B', [0]) * nBytes
+        self.n = 0
+
+    def _getIndices(self, digest):
+        """Helper: return a list of the bit indices for a digest."""
+        nBits = self.nBits
+        return [ idx % nBits for idx in struct.unpack("!5L", digest) ]
+
+    def add(self, digest):
+        """Add a digest to this filter."""
+        bits = self.bits
+        for idx in self._getIndices(digest):
+            bits[idx >> 3] |= (1 << (idx & 7))
+        self.n += 1
+
+    def mayContain(self, digest):
+        """Return false if 'digest' is definitely not in this filter; return
+           true if it might be."""
+        bits = self.bits
+        for idx in self._getIndices(digest):
+            if not bits[idx >> 3] & (1 << (idx & 7)):
+                return 0
+        return 1
+
+    def isFull(self):
+        """Return true iff this filter has as many digests as it was sized
+           for."""
+        return self.n >= self.capacity
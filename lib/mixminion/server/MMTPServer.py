@@ -31,7 +31,7 @@ import mixminion.ServerInfo
 import mixminion.TLSConnection
 import mixminion._minionlib as _ml
 from mixminion.Common import MixError, MixFatalError, MixProtocolError, \
-     LOG, stringContains, floorDiv, UIError
+     LOG, stringContains, UIError
 from mixminion.Crypto import sha1, getCommonPRNG
 from mixminion.Packet import PACKET_LEN, DIGEST_LEN, IPV4Info, MMTPHostInfo
 from mixminion.MMTPClient import PeerCertificateCache, MMTPClientConnection
@@ -40,7 +40,46 @@ import mixminion.server.EventStats as EventStats
 from mixminion.Filestore import CorruptedFile
 from mixminion.ThreadUtils import MessageQueue, QueueEmpty
 
-__all__ = [ 'AsyncServer', 'ListenConnection', 'MMTPServerConnection' ]
+__all__ = [ 'AsyncServer', 'ListenConnection', 'MMTPServerConnection',
+            'EpollAsyncServer', 'TokenBucket' ]
+
+class TokenBucket:
+    """A TokenBucket limits the rate at which we use some resource (here,
+       bytes of bandwidth in one direction).  It fills continuously at
+       'rate' tokens per second, up to a maximum of 'burst' tokens."""
+    ## Fields:
+    # rate: how many tokens do we add per second?
+    # burst: the largest number of tokens we're willing to hold.
+    # tokens: how many tokens are available now?
+    # lastRefill: when did we last add tokens?
+    def __init__(self, rate, burst, now=None):
+        """Create a new full TokenBucket."""
+        if now is None:
+            now = time.time()
+        self.rate = rate
+        self.burst = burst
+        self.tokens = burst
+        self.lastRefill = now
+
+    def refill(self, now=None):
+        """Add all the tokens that have accumulated since the last refill."""
+        if now is None:
+            now = time.time()
+        if now > self.lastRefill:
+            self.tokens = min(self.burst,
+                              self.tokens + (now-self.lastRefill)*self.rate)
+        self.lastRefill = now
+
+    def spend(self, n):
+        """Remove 'n' tokens from the bucket."""
+        self.tokens -= n
+
+    def getDelay(self, n):
+        """Return the number of seconds until the bucket will hold 'n'
+           tokens, or 0 if it already does."""
+        if self.tokens >= n:
+            return 0
+        return (n-self.tokens) / float(self.rate)
 
 class SelectAsyncServer:
     """AsyncServer is the core of a general-purpose asynchronous
@@ -48,31 +87,42 @@ class SelectAsyncServer:
        Connection objects that are waiting for reads and writes
        (respectively), and waits for their underlying sockets to be
        available for the desired operations.
+
+       If we have a bandwidth limit, we keep separate TokenBucket objects
+       for reading and for writing, and share each one among the
+       connections that are ready to use it with deficit round-robin:
+       every ready connection accumulates an equal share of the available
+       tokens, and gets to use them once it has at least MIN_QUANTUM
+       bytes' worth.  When there is no bandwidth available, we sleep until
+       there will be.
        """
     ## Fields:
     # self.connections: a map from fd to Connection objects.
     # self.state: a map from fd to the latest wantRead,wantWrite tuples
     #    returned by the connection objects' process or getStatus methods.
 
-    # self.bandwidthPerTick: How many bytes of bandwidth do we use per tick,
-    #    on average?
-    # self.maxBucket: How many bytes of bandwidth are we willing to use in
-    #    a single 1-tick burst?
-    # self.bucket: How many bytes are we willing to use in the next tick?
-    #
-    #   (NOTE: if no bandwidth limitation is used, the 3 fields above are
-    #   set to None.)
-
-    # How many seconds pass between the 'ticks' at which we increment
-    # our bandwidth bucket?
+    # self.readBucket, self.writeBucket: TokenBucket objects to limit the
+    #    rate at which we read and write, or None if we have no bandwidth
+    #    limit.
+    # self.deficits: a map from (fd, 'r' or 'w') to the number of bytes
+    #    that connection has been allowed to use, but hasn't used yet.
+    # self.rrOffset: a counter used to rotate the order in which we serve
+    #    ready connections.
+
+    # How often, in seconds, should our caller wake us up to do periodic
+    # housekeeping?  (Bandwidth accounting doesn't depend on this.)
     TICK_INTERVAL = 1.0
+    # The smallest number of bytes worth handing to a connection at once.
+    MIN_QUANTUM = 1024
 
     def __init__(self):
         """Create a new AsyncServer with no readers or writers."""
         self._timeout = None
         self.connections = {}
         self.state = {}
-        self.bandwidthPerTick = self.bucket = self.maxBucket = None
+        self.readBucket = self.writeBucket = None
+        self.deficits = {}
+        self.rrOffset = 0
 
     def process(self,timeout):
         """If any relevant file descriptors become available within
@@ -82,6 +132,9 @@ class SelectAsyncServer:
 
            If we receive an unblocked signal, return immediately.
            """
+        if self._waitForBandwidth(timeout):
+            return
+
         readfds = []; writefds = []; exfds = []
         for fd,(wr,ww) in self.state.items():
             if wr: readfds.append(fd)
@@ -95,10 +148,6 @@ class SelectAsyncServer:
             time.sleep(timeout)
             return
 
-        if self.bucket is not None and self.bucket <= 0:
-            time.sleep(timeout)
-            return
-
         try:
             readfds,writefds,exfds = select.select(readfds,writefds,exfds,
                                                    timeout)
@@ -110,29 +159,128 @@ class SelectAsyncServer:
 
         writefds += exfds
 
-        active = []
-
-        for fd, c in self.connections.items():
+        events = []
+        for fd in self.connections.keys():
             r = fd in readfds
             w = fd in writefds
             if not (r or w):
                 continue
-            active.append((c,r,w,fd))
+            events.append((fd,r,w,0))
+
+        self._processEvents(events, timeout)
+
+    def _waitForBandwidth(self, timeout):
+        """Helper: if we have no bandwidth to use in either direction, sleep
+           until we do (or for 'timeout' seconds, whichever is less) and
+           return true.  Otherwise return false."""
+        if self.readBucket is None:
+            return 0
+        self.readBucket.refill()
+        self.writeBucket.refill()
+        delay = min(self.readBucket.getDelay(1), self.writeBucket.getDelay(1))
+        if delay <= 0:
+            return 0
+        time.sleep(min(delay, timeout))
+        return 1
+
+    def _processEvents(self, events, timeout):
+        """Helper: given a list of (fd, readable, writable, error) tuples
+           for connections that are ready, process those connections,
+           sharing out our bandwidth among them."""
+        if not events:
+            return
+        if self.readBucket is None:
+            for fd, r, w, x in events:
+                c = self.connections.get(fd)
+                if c is None:
+                    # Removed while we were handling an earlier event.
+                    continue
+                wr,ww,isopen,_ = c.process(r,w,x,None)
+                self._connectionProcessed(c, fd, wr, ww, isopen)
+            return
 
-        if not active: return
-        if self.bucket is None:
-            cap = None
-        else:
-            cap = floorDiv(self.bucket, len(active))
-        for c,r,w,fd in active:
-            wr, ww, isopen, nbytes = c.process(r,w,0,cap)
-            if cap is not None:
-                self.bucket -= nbytes
-            if not isopen:
-                del self.connections[fd]
-                del self.state[fd]
+        # Rotate the order in which we serve connections, so that nobody
+        # is always first in line.
+        events.sort()
+        self.rrOffset = (self.rrOffset+1) % len(events)
+        events = events[self.rrOffset:] + events[:self.rrOffset]
+
+        used = 0
+        wakeDelay = None
+        for bucket, dir, idx in ((self.readBucket, 'r', 1),
+                                 (self.writeBucket, 'w', 2)):
+            ready = [ ev for ev in events if ev[idx] or ev[3] ]
+            if not ready:
                 continue
-            self.state[fd] = (wr,ww)
+            quantum = min(self.MIN_QUANTUM, bucket.burst)
+            share = max(int(bucket.tokens), 0) / len(ready)
+            for fd, r, w, x in ready:
+                c = self.connections.get(fd)
+                if c is None:
+                    continue
+                # Move this connection's share of the bucket into its
+                # deficit counter.
+                key = (fd, dir)
+                credit = self.deficits.get(key, 0) + share
+                bucket.spend(share)
+                if credit < quantum and not x:
+                    # Not enough to be worth using yet; save it up, and
+                    # note when the bucket will let us catch up.
+                    self.deficits[key] = credit
+                    d = bucket.getDelay((quantum-credit)*len(ready))
+                    if wakeDelay is None or d < wakeDelay:
+                        wakeDelay = d
+                    continue
+                cap = min(credit, bucket.burst)
+                if dir == 'r':
+                    wr,ww,isopen,n = c.process(1,0,x,cap)
+                else:
+                    wr,ww,isopen,n = c.process(0,1,x,cap)
+                used += n
+                if n < cap:
+                    # The connection didn't need all of its credit.  In
+                    # DRR, idle connections don't build up credit, so we
+                    # return the rest to the bucket.
+                    bucket.spend(n-credit)
+                    self.deficits[key] = 0
+                else:
+                    self.deficits[key] = credit-n
+                self._connectionProcessed(c, fd, wr, ww, isopen)
+
+        if wakeDelay is not None and not used:
+            # Nobody could do anything: rather than polling again right
+            # away, wait until somebody has a useful amount of bandwidth.
+            time.sleep(min(max(wakeDelay, 0.001), timeout))
+
+    def _connectionProcessed(self, c, fd, wr, ww, isopen):
+        """Helper: called after we've processed the connection 'c' on the
+           file descriptor 'fd'; updates our state to reflect its new
+           status."""
+        if not isopen:
+            if self.connections.get(fd) is c:
+                self.remove(c, fd)
+            return
+        self._setState(fd, wr, ww)
+
+    def _setState(self, fd, wr, ww):
+        """Helper: note that the connection on 'fd' now wants to read if
+           'wr', and write if 'ww'."""
+        self.state[fd] = (wr,ww)
+
+    def connectionStateChanged(self, c):
+        """Called when the connection 'c' has changed whether it wants to
+           read or write outside of process() -- for example, because we
+           gave it a new packet to send, or told it to shut down.  Updates
+           our state (and our poll object, if any) to match."""
+        wr, ww, isopen = c.getStatus()
+        if not isopen:
+            for fd, con in self.connections.items():
+                if con is c:
+                    self.remove(c, fd)
+            return
+        fd = c.fileno()
+        if self.connections.get(fd) is c:
+            self._setState(fd, wr, ww)
 
     def register(self, c):
         """Add a connection to this server."""
@@ -148,6 +296,9 @@ class SelectAsyncServer:
             fd = c.fileno()
         del self.connections[fd]
         del self.state[fd]
+        for key in (fd, 'r'), (fd, 'w'):
+            if self.deficits.has_key(key):
+                del self.deficits[key]
 
     def tryTimeout(self, now=None):
         """Timeout any connection that is too old."""
@@ -165,34 +316,28 @@ class SelectAsyncServer:
 
     def setBandwidth(self, n, maxBucket=None):
         """Set bandwidth limitations for this server
-              n -- maximum bytes-per-second to use, on average.
-              maxBucket -- maximum bytes to send in a single burst.
-                 Defaults to n*5.
+              n -- maximum bytes-per-second to use in each direction, on
+                 average.
+              maxBucket -- maximum bytes to use in each direction in a
+                 single burst.  Defaults to n*5.
 
            Setting n to None removes bandwidth limiting."""
         if n is None:
-            self.bandwidthPerTick = None
-            self.maxBucket = None
+            self.readBucket = self.writeBucket = None
         else:
-            self.bandwidthPerTick = int(n * self.TICK_INTERVAL)
             if maxBucket is None:
-                self.maxBucket = self.bandwidthPerTick*5
-            else:
-                self.maxBucket = maxBucket
+                maxBucket = n*5
+            self.readBucket = TokenBucket(n, maxBucket)
+            self.writeBucket = TokenBucket(n, maxBucket)
+        self.deficits = {}
 
     def tick(self):
-        """Tell the server that one unit of time has passed, and the bandwidth
-           limitations can be readjusted.  This method must be called once
-           every TICK_INTERVAL seconds."""
-        bwpt = self.bandwidthPerTick
-        if bwpt is None:
-            self.bucket = None
-        else:
-            bucket = (self.bucket or 0) + bwpt
-            if bucket > self.maxBucket:
-                self.bucket = self.maxBucket
-            else:
-                self.bucket = bucket
+        """Tell the server that time has passed, and the bandwidth
+           limitations can be readjusted.  (We also do this whenever we
+           process events, so calling this method is optional.)"""
+        if self.readBucket is not None:
+            self.readBucket.refill()
+            self.writeBucket.refill()
 
 class PollAsyncServer(SelectAsyncServer):
     """Subclass of SelectAsyncServer that uses 'poll' where available.  This
@@ -207,8 +352,7 @@ class PollAsyncServer(SelectAsyncServer):
                            (1,1): select.POLLIN+select.POLLOUT+select.POLLERR,
                            (1,2): select.POLLIN+select.POLLOUT+select.POLLERR }
     def process(self,timeout):
-        if self.bucket is not None and self.bucket <= 0:
-            time.sleep(timeout)
+        if self._waitForBandwidth(timeout):
             return
         try:
             # (watch out: poll takes a timeout in msec, but select takes a
@@ -219,27 +363,13 @@ class PollAsyncServer(SelectAsyncServer):
                 return
             else:
                 raise e
-        if not events:
-            return
-        if self.bucket is None:
-            cap = None
-        else:
-            cap = floorDiv(self.bucket,len(events))
-        #print events, self.connections.keys()
-        for fd, mask in events:
-            c = self.connections[fd]
-            wr,ww,isopen,n = c.process(mask&select.POLLIN, mask&select.POLLOUT,
-                                       mask&(select.POLLERR|select.POLLHUP),
-                                       cap)
-            if cap is not None:
-                self.bucket -= n
-            if not isopen:
-                #print "unregister",fd
-                self.poll.unregister(fd)
-                del self.connections[fd]
-                continue
-            #print "register",fd
-            self.poll.register(fd,self.EVENT_MASK[wr,ww])
+        self._processEvents(
+            [ (fd, mask&select.POLLIN, mask&select.POLLOUT,
+               mask&(select.POLLERR|select.POLLHUP)) for fd, mask in events ],
+            timeout)
+
+    def _setState(self, fd, wr, ww):
+        self.poll.register(fd,self.EVENT_MASK[wr,ww])
 
     def register(self,c):
         fd = c.fileno()
@@ -247,16 +377,81 @@ class PollAsyncServer(SelectAsyncServer):
         if not isopen: return
         self.connections[fd] = c
         mask = self.EVENT_MASK[(wr,ww)]
-        #print "register",fd
         self.poll.register(fd, mask)
     def remove(self,c,fd=None):
         if fd is None:
             fd = c.fileno()
-        #print "unregister",fd
         self.poll.unregister(fd)
         del self.connections[fd]
+        for key in (fd, 'r'), (fd, 'w'):
+            if self.deficits.has_key(key):
+                del self.deficits[key]
+
+class EpollAsyncServer(SelectAsyncServer):
+    """Subclass of SelectAsyncServer that uses Linux's 'epoll'.  Unlike
+       PollAsyncServer, we only tell the kernel about a connection when
+       its (wantRead, wantWrite) state changes, and we only look at the
+       connections that are ready, so the cost of each call to process()
+       depends on how many connections are active rather than on how many
+       are open."""
+    ## Fields:
+    # epoll: a select.epoll object holding all of our connections' fds.
+    def __init__(self):
+        SelectAsyncServer.__init__(self)
+        self.epoll = select.epoll()
+        self.EVENT_MASK = {(0,0):0,
+                           (1,0): select.EPOLLIN+select.EPOLLERR,
+                           (0,1): select.EPOLLOUT+select.EPOLLERR,
+                           (0,2): select.EPOLLOUT+select.EPOLLERR,
+                           (1,1): select.EPOLLIN+select.EPOLLOUT+select.EPOLLERR,
+                           (1,2): select.EPOLLIN+select.EPOLLOUT+select.EPOLLERR }
+    def process(self,timeout):
+        if self._waitForBandwidth(timeout):
+            return
+        try:
+            events = self.epoll.poll(timeout)
+        except IOError, e:
+            if e.errno == errno.EINTR:
+                return
+            else:
+                raise e
+        self._processEvents(
+            [ (fd, mask&select.EPOLLIN, mask&select.EPOLLOUT,
+               mask&(select.EPOLLERR|select.EPOLLHUP)) for fd, mask in events ],
+            timeout)
+
+    def _setState(self, fd, wr, ww):
+        if self.state[fd] != (wr,ww):
+            self.state[fd] = (wr,ww)
+            self.epoll.modify(fd, self.EVENT_MASK[wr,ww])
+
+    def register(self,c):
+        fd = c.fileno()
+        wr, ww, isopen = c.getStatus()
+        if not isopen: return
+        mask = self.EVENT_MASK[(wr,ww)]
+        try:
+            self.epoll.register(fd, mask)
+        except IOError, e:
+            if e.errno != errno.EEXIST:
+                raise
+            self.epoll.modify(fd, mask)
+        self.connections[fd] = c
+        self.state[fd] = (wr,ww)
+    def remove(self,c,fd=None):
+        if fd is None:
+            fd = c.fileno()
+        try:
+            self.epoll.unregister(fd)
+        except (IOError, OSError):
+            # The kernel forgets about fds when they're closed.
+            pass
+        SelectAsyncServer.remove(self, c, fd)
 
-if hasattr(select,'poll') and not _ml.POLL_IS_EMULATED and sys.platform != 'cygwin':
+if hasattr(select,'epoll'):
+    # Linux: 'epoll' scales better than either 'poll' or 'select'.
+    AsyncServer = EpollAsyncServer
+elif hasattr(select,'poll') and not _ml.POLL_IS_EMULATED and sys.platform != 'cygwin':
     # Prefer 'poll' to 'select', except on MacOS and other platforms where
     # where 'poll' is just a wrapper around 'select'.  (The poll wrapper is
     # sometimes buggy.)
@@ -405,11 +600,18 @@ class MMTPServerConnection(mixminion.TLSConnection.TLSConnection):
         self.beginReading()
 
     def onDataRead(self):
-        while self.inbuflen >= self.MESSAGE_LEN:
-            data = self.getInbuf(self.MESSAGE_LEN, clear=1)
-            control = data[:SEND_CONTROL_LEN]
-            pkt = data[SEND_CONTROL_LEN:-DIGEST_LEN]
-            digest = data[-DIGEST_LEN:]
+        if self.inbuflen < self.MESSAGE_LEN:
+            return
+        # Take every complete packet from the input buffer at once, and
+        # slice each packet straight out of the result: this way we copy
+        # the buffer once, rather than once (plus the remainder) per packet.
+        nPackets = self.inbuflen / self.MESSAGE_LEN
+        data = self.getInbuf(nPackets*self.MESSAGE_LEN, clear=1)
+        for start in xrange(0, len(data), self.MESSAGE_LEN):
+            end = start+self.MESSAGE_LEN
+            control = data[start:start+SEND_CONTROL_LEN]
+            pkt = data[start+SEND_CONTROL_LEN:end-DIGEST_LEN]
+            digest = data[end-DIGEST_LEN:end]
             if control == JUNK_CONTROL:
                 expectedDigest = sha1(pkt+"JUNK")
                 replyDigest = sha1(pkt+"RECEIVED JUNK")
@@ -570,6 +772,12 @@ class MMTPAsyncServer(AsyncServer):
     #     to a new server, but we already have this many open outgoing
     #     connections, we put the packets in pendingPackets.
     # pendingPackets: A list of tuples to serve as arguments for _sendPackets.
+    # idleTimeout: The number of seconds to keep an outgoing connection open
+    #     after we have run out of packets to send on it, in case we have
+    #     more packets for the same server soon.  If 0, we close
+    #     connections as soon as they are done.
+    # maxIdleConnections: The largest number of idle outgoing connections
+    #     to keep open.
 
     def __init__(self, config, servercontext):
         AsyncServer.__init__(self)
@@ -623,6 +831,13 @@ class MMTPAsyncServer(AsyncServer):
         self.msgQueue = MessageQueue()
         self.pendingPackets = []
         self.pingLog = None
+        idleTimeout = config['Outgoing/MMTP'].get('IdleTimeout')
+        if idleTimeout is None:
+            self.idleTimeout = 0
+        else:
+            self.idleTimeout = idleTimeout.getSeconds()
+        self.maxIdleConnections = config['Outgoing/MMTP'].get(
+            'MaxIdleConnections', 8)
 
     def connectDNSCache(self, dnsCache):
         """Use the DNSCache object 'DNSCache' to resolve DNS queries for
@@ -646,8 +861,41 @@ class MMTPAsyncServer(AsyncServer):
            last done so at time 'now'."""
         if now is None:
             now = time.time()
+        if self.idleTimeout:
+            return now + min(self._timeout, self.idleTimeout)
         return now + self._timeout
 
+    def tryTimeout(self, now=None):
+        """Close idle client connections we no longer want, then timeout
+           any connection that is too old."""
+        if now is None:
+            now = time.time()
+        self.closeIdleConnections(now)
+        AsyncServer.tryTimeout(self, now)
+
+    def _getIdleConnections(self):
+        """Return a list of all idle client connections, the one that has
+           been idle longest first."""
+        idle = [ (con.idleSince, con) for con in self.clientConByAddr.values()
+                 if con.isIdle() ]
+        idle.sort()
+        return [ con for _, con in idle ]
+
+    def closeIdleConnections(self, now=None):
+        """Close every client connection that has been idle for longer
+           than idleTimeout, and close the longest-idle connections until
+           we have no more than maxIdleConnections idle."""
+        if now is None:
+            now = time.time()
+        idle = self._getIdleConnections()
+        nExtra = len(idle) - self.maxIdleConnections
+        cutoff = now - self.idleTimeout
+        for con in idle:
+            if nExtra > 0 or con.idleSince <= cutoff:
+                con.closeIdle()
+                self.connectionStateChanged(con)
+                nExtra -= 1
+
     def _newMMTPConnection(self, sock):
         """helper method.  Creates and registers a new server connection when
            the listener socket gets a hit."""
@@ -764,9 +1012,19 @@ class MMTPAsyncServer(AsyncServer):
                           len(deliverable), con.address)
                 for d in deliverable:
                     con.addPacket(d)
+                # The connection may have been idle, and so not waiting
+                # to write.
+                self.connectionStateChanged(con)
                 return
 
         if len(self.clientConByAddr) >= self.maxClientConnections:
+            # Make room for the new connection by closing the one that has
+            # been idle longest.  (It stays in clientConByAddr until it is
+            # closed, so we still need to delay these packets.)
+            idle = self._getIdleConnections()
+            if idle:
+                idle[0].closeIdle()
+                self.connectionStateChanged(idle[0])
             LOG.debug("We already have %s open client connections; delaying %s packets for %s",
                       len(self.clientConByAddr), len(deliverable), serverName)
             self.pendingPackets.append((family,ip,port,keyID,deliverable,serverName))
@@ -775,10 +1033,16 @@ class MMTPAsyncServer(AsyncServer):
         try:
             # There isn't any connection to the right server. Open one...
             addr = (ip, port, keyID)
-            finished = lambda addr=addr, self=self: self.__clientFinished(addr)
             con = _ClientCon(
                 family, ip, port, keyID, serverName=serverName,
-                context=self.clientContext, certCache=self.certificateCache)
+                context=self.clientContext, certCache=self.certificateCache,
+                keepAlive=(self.idleTimeout > 0))
+            finished = lambda addr=addr, con=con, self=self: \
+                       self.__clientFinished(addr, con)
+            if self.idleTimeout:
+                # When a connection goes idle, make sure we aren't keeping
+                # too many idle connections open.
+                con.allPacketsSent = self.__clientIdle
             nickname = mixminion.ServerInfo.getNicknameByKeyID(keyID)
             if nickname is not None:
                 # If we recognize this server, then we'll want to tell
@@ -805,15 +1069,22 @@ class MMTPAsyncServer(AsyncServer):
             self.register(con)
             self.clientConByAddr[addr] = con
 
-    def __clientFinished(self, addr):
+    def __clientFinished(self, addr, con):
         """Called when a client connection runs out of packets to send,
            or halts."""
         try:
-            del self.clientConByAddr[addr]
+            if self.clientConByAddr[addr] is con:
+                del self.clientConByAddr[addr]
         except KeyError:
             LOG.warn("Didn't find client connection to %s in address map",
                      addr)
 
+    def __clientIdle(self):
+        """Called when a kept-alive client connection runs out of packets
+           to send."""
+        if len(self._getIdleConnections()) > self.maxIdleConnections:
+            self.closeIdleConnections()
+
     def onPacketReceived(self, pkt):
         """Abstract function.  Called when we get a packet"""
         pass
@@ -136,6 +136,11 @@ class DeliveryModule:
     def sync(self):
         """Flush all pending data held by this module to disk."""
 
+    def closeIdleConnections(self, now=None):
+        """Close any network connections this module is keeping open for
+           reuse, but that have not been used for too long."""
+        pass
+
     def close(self):
         """Release all resources held by this module."""
         pass
@@ -237,18 +242,31 @@ class DeliveryThread(threading.Thread):
        background; delegates to ModuleManager._sendReadyMessages."""
     ## Fields:
     # moduleManager -- a ModuleManager object.
-    # event -- an Event that is set when we have messages to deliver, or
-    #    when we're stopping.
+    # event -- an Event that is set when we have messages to deliver,
+    #    connections to close, or when we're stopping.
     # __stoppingEvent -- an event that is set when we're shutting down.
+    # sendPending -- true iff we've been asked to send ready messages.
+    # closeIdlePending -- true iff we've been asked to close idle network
+    #    connections.
     def __init__(self, moduleManager):
         """Create a new DeliveryThread."""
         threading.Thread.__init__(self)
         self.moduleManager = moduleManager
         self.event = threading.Event()
         self.__stoppingevent = threading.Event()
+        self.sendPending = 0
+        self.closeIdlePending = 0
 
     def beginSending(self):
         """Tell this thread that there are messages ready to be sent."""
+        self.sendPending = 1
+        self.event.set()
+
+    def beginClosingIdle(self):
+        """Tell this thread to close any network connections that the
+           modules have not used recently.  (Closing a connection can block
+           on a slow peer, so we never do it from the main thread.)"""
+        self.closeIdlePending = 1
         self.event.set()
 
     def shutdown(self):
@@ -267,8 +285,15 @@ class DeliveryThread(threading.Thread):
                     LOG.info("Delivery thread shutting down.")
                     self.moduleManager.close()
                     return
-                self.moduleManager._sendReadyMessages()
-                waitForChildren(blocking=0)
+                # Clear each flag before we act on it, so that a request
+                # that arrives while we're working isn't lost.
+                if self.sendPending:
+                    self.sendPending = 0
+                    self.moduleManager._sendReadyMessages()
+                    waitForChildren(blocking=0)
+                if self.closeIdlePending:
+                    self.closeIdlePending = 0
+                    self.moduleManager._closeIdleConnections()
         except:
             LOG.error_exc(sys.exc_info(),
                           "Exception in delivery; shutting down thread.")
@@ -510,6 +535,22 @@ class ModuleManager:
         for module in self.enabled.keys():
             self.nameToModule[module].sync()
 
+    def closeIdleConnections(self):
+        """Close network connections that the modules have not used
+           recently, either directly, or by telling the delivery thread to
+           do so if we're threading."""
+        if self.thread is not None:
+            self.thread.beginClosingIdle()
+        else:
+            self._closeIdleConnections()
+
+    def _closeIdleConnections(self):
+        """Actual implementation of closeIdleConnections: tell all modules
+           to close network connections they have not used recently."""
+        now = time.time()
+        for module in self.enabled.keys():
+            self.nameToModule[module].closeIdleConnections(now)
+
 #----------------------------------------------------------------------
 class DropModule(DeliveryModule):
     """Null-object pattern: drops all messages it receives."""
@@ -965,6 +1006,16 @@ class MailBase:
     # maxMessageSize: Largest allowable size (after decompression, before
     #   base64) for outgoing messages.
     # allowFromAddr: Boolean: do we support user-supplied from addresses?
+    # smtpPool: An SMTPConnectionPool used to deliver mail, or None if we
+    #   use a SendmailCommand or don't send mail via SMTP ourselves.
+    smtpPool = None
+
+    # Options for modules that deliver mail via SMTP.
+    SMTP_OPTIONS = {
+        'SMTPServer' : ('ALLOW', None, None),
+        'SendmailCommand' : ('ALLOW', "command", None),
+        'SMTPIdleTimeout' : ('ALLOW', "interval", "1 minute"),
+        }
 
     COMMON_OPTIONS = {
         'MaximumSize' : ('ALLOW', "size", "100K"),
@@ -1014,6 +1065,30 @@ class MailBase:
 
         return msg
 
+    def initializeSMTPPool(self, sec):
+        """Create an SMTPConnectionPool for the MTA named in 'sec', unless
+           'sec' names a SendmailCommand."""
+        if sec.get('SendmailCommand') is not None:
+            self.smtpPool = None
+            return
+        idle = sec.get('SMTPIdleTimeout')
+        if idle is None:
+            idle = 60
+        else:
+            idle = idle.getSeconds()
+        self.smtpPool = SMTPConnectionPool(sec.get('SMTPServer') or
+                                           'localhost', idle)
+
+    def _closeIdleSMTPConnections(self, now=None):
+        """Close SMTP connections that haven't been used recently."""
+        if self.smtpPool is not None:
+            self.smtpPool.closeIdle(now)
+
+    def _closeSMTPConnections(self):
+        """Close all of our SMTP connections."""
+        if self.smtpPool is not None:
+            self.smtpPool.closeAll()
+
     def initializeHeaders(self, sec):
         """Sets subject and returns a string that can be added to message
            headers."""
@@ -1075,11 +1150,10 @@ class MBoxModule(DeliveryModule, MailBase):
                           "7 hours for 6 days"),
                 'AddressFile' : ('ALLOW', "filename", None),
                 'RemoveContact' : ('ALLOW', None, None),
-                'SMTPServer' : ('ALLOW', None, None),
-                'SendmailCommand' : ('ALLOW', "command", None),
                 'Advertise' : ('ALLOW', "boolean", "yes")
               }
         cfg.update(MailBase.COMMON_OPTIONS)
+        cfg.update(MailBase.SMTP_OPTIONS)
         return { "Delivery/MBOX" : cfg }
 
     def validateConfig(self, config, lines, contents):
@@ -1127,6 +1201,7 @@ class MBoxModule(DeliveryModule, MailBase):
 
         # These fields are needed by MailBase
         self.initializeHeaders(sec)
+        self.initializeSMTPPool(sec)
         self.fromTag = "[Anon]"
 
         # Parse the address file.
@@ -1193,7 +1268,14 @@ class MBoxModule(DeliveryModule, MailBase):
             return DELIVER_FAIL_NORETRY
 
         # Deliver the message
-        return sendSMTPMessage(self.cfgSection, [address], self.returnAddress, msg)
+        return sendSMTPMessage(self.cfgSection, [address], self.returnAddress,
+                               msg, self.smtpPool)
+
+    def closeIdleConnections(self, now=None):
+        self._closeIdleSMTPConnections(now)
+
+    def close(self):
+        self._closeSMTPConnections()
 
 #----------------------------------------------------------------------
 class SMTPModule(DeliveryModule, MailBase):
@@ -1214,6 +1296,10 @@ class SMTPModule(DeliveryModule, MailBase):
         return "SMTP"
     def getExitTypes(self):
         return [ mixminion.Packet.SMTP_TYPE ]
+    def closeIdleConnections(self, now=None):
+        self._closeIdleSMTPConnections(now)
+    def close(self):
+        self._closeSMTPConnections()
 
 class DirectSMTPModule(SMTPModule):
     """Module that delivers SMTP messages via a local MTA."""
@@ -1239,10 +1325,9 @@ class DirectSMTPModule(SMTPModule):
                 'Retry': ('ALLOW', "intervalList",
                           "7 hours for 6 days"),
                 'BlacklistFile' : ('ALLOW', "filename", None),
-                'SMTPServer' : ('ALLOW', None, None),
-                'SendmailCommand' : ('ALLOW', "command", None),
                 }
         cfg.update(MailBase.COMMON_OPTIONS)
+        cfg.update(MailBase.SMTP_OPTIONS)
         return { "Delivery/SMTP" : cfg }
 
     def validateConfig(self, config, lines, contents):
@@ -1282,6 +1367,7 @@ class DirectSMTPModule(SMTPModule):
         self.allowFromAddr = sec['AllowFromAddress']
 
         self.initializeHeaders(sec)
+        self.initializeSMTPPool(sec)
 
         self.maxMessageSize = _cleanMaxSize(sec['MaximumSize'],
                                             "Delivery/SMTP")
@@ -1309,7 +1395,8 @@ class DirectSMTPModule(SMTPModule):
             return DELIVER_FAIL_NORETRY
 
         # Send the message.
-        return sendSMTPMessage(self.cfgSection, [address], self.returnAddress, msg)
+        return sendSMTPMessage(self.cfgSection, [address], self.returnAddress,
+                               msg, self.smtpPool)
 
 class MixmasterSMTPModule(SMTPModule):
     """Implements SMTP by relaying messages via Mixmaster nodes.  This
@@ -1449,39 +1536,205 @@ def checkMailHeaders(headers):
 
 #----------------------------------------------------------------------
 
-def sendSMTPMessage(cfgSection, toList, fromAddr, message):
+# How many idle connections do we keep to a single MTA?  We only deliver
+# from one thread, so we rarely need more than one.
+SMTP_MAX_IDLE_CONNECTIONS = 2
+# How many seconds do we wait for an MTA to accept a connection or answer
+# a command before we give up?  (Python before 2.6 can't set this.)
+SMTP_TIMEOUT = 120
+
+class SMTPConnectionPool:
+    """An SMTPConnectionPool keeps connections to a single MTA open between
+       messages, so that we don't need to reconnect for every message in a
+       batch, or for every batch.  If the MTA supports PIPELINING, we send
+       each message's envelope commands together.  Connections that have
+       been idle for longer than idleTimeout are closed by closeIdle, which
+       should be called periodically.
+
+       It is safe to use an SMTPConnectionPool from more than one thread.
+    """
+    ## Fields:
+    # server: the hostname of the MTA.
+    # idleTimeout: how many seconds may a connection stay open unused?
+    # idle: a list of (time last used, smtplib.SMTP) tuples for open
+    #    connections that nobody is using, most recently used last.
+    # _lock: a lock to protect 'idle'.
+    def __init__(self, server, idleTimeout=60):
+        """Create a new SMTPConnectionPool to talk to the MTA at 'server'.
+           If idleTimeout is 0, we close each connection when we're done
+           with it."""
+        self.server = server
+        self.idleTimeout = idleTimeout
+        self.idle = []
+        self._lock = threading.Lock()
+
+    def sendMessage(self, toList, fromAddr, message):
+        """Send 'message' to every address in 'toList', from 'fromAddr'.
+           Return DELIVER_OK or DELIVER_FAIL_RETRY."""
+        LOG.debug("Sending message via SMTP host %s to %s", self.server,
+                  toList)
+        try:
+            con, reused = self._getConnection()
+        except (smtplib.SMTPException, socket.error), e:
+            LOG.warn("Unsuccessful SMTP connection to %s: %s",
+                     self.server, str(e))
+            return DELIVER_FAIL_RETRY
+        try:
+            try:
+                self._sendmail(con, fromAddr, toList, message)
+            except (smtplib.SMTPServerDisconnected, socket.error), e:
+                if not reused:
+                    raise
+                # The MTA probably closed our idle connection; try again
+                # with a new one.
+                LOG.debug("Reused SMTP connection to %s failed (%s); "
+                          "reconnecting", self.server, e)
+                self._close(con)
+                con = self._connect()
+                self._sendmail(con, fromAddr, toList, message)
+        except (smtplib.SMTPException, socket.error), e:
+            LOG.warn("Unsuccessful SMTP connection to %s: %s",
+                     self.server, str(e))
+            self._close(con)
+            return DELIVER_FAIL_RETRY
+        self._releaseConnection(con)
+        return DELIVER_OK
+
+    def closeIdle(self, now=None):
+        """Close every connection that has been idle for longer than
+           idleTimeout."""
+        if now is None:
+            now = time.time()
+        cutoff = now - self.idleTimeout
+        self._lock.acquire()
+        try:
+            old = [ con for t, con in self.idle if t <= cutoff ]
+            self.idle = [ (t, con) for t, con in self.idle if t > cutoff ]
+        finally:
+            self._lock.release()
+        for con in old:
+            LOG.debug("Closing idle SMTP connection to %s", self.server)
+            self._quit(con)
+
+    def closeAll(self):
+        """Close every idle connection."""
+        self._lock.acquire()
+        try:
+            cons = self.idle
+            self.idle = []
+        finally:
+            self._lock.release()
+        for _, con in cons:
+            self._quit(con)
+
+    def _getConnection(self):
+        """Helper: return a tuple of an open connection to our MTA, and a
+           flag that is true iff it was already open."""
+        self._lock.acquire()
+        try:
+            if self.idle:
+                return self.idle.pop()[1], 1
+        finally:
+            self._lock.release()
+        return self._connect(), 0
+
+    def _connect(self):
+        """Helper: open and greet a new connection to our MTA."""
+        if sys.version_info[:2] >= (2,6):
+            con = smtplib.SMTP(self.server, timeout=SMTP_TIMEOUT)
+        else:
+            con = smtplib.SMTP(self.server)
+        code, resp = con.ehlo()
+        if not (200 <= code <= 299):
+            code, resp = con.helo()
+            if not (200 <= code <= 299):
+                self._close(con)
+                raise smtplib.SMTPHeloError(code, resp)
+        return con
+
+    def _releaseConnection(self, con):
+        """Helper: we're done with 'con'.  Keep it for later if we can."""
+        self._lock.acquire()
+        try:
+            if (self.idleTimeout > 0 and
+                len(self.idle) < SMTP_MAX_IDLE_CONNECTIONS):
+                self.idle.append((time.time(), con))
+                return
+        finally:
+            self._lock.release()
+        self._quit(con)
+
+    def _sendmail(self, con, fromAddr, toList, message):
+        """Helper: send a single message on 'con'.  If the MTA supports
+           PIPELINING, we send MAIL and all the RCPTs at once and then read
+           the replies; otherwise we use smtplib's sendmail.  Raises
+           SMTPException on failure."""
+        if not con.has_extn('pipelining'):
+            con.sendmail(fromAddr, toList, message)
+            return
+
+        cmds = [ "MAIL FROM:%s" % smtplib.quoteaddr(fromAddr) ]
+        for addr in toList:
+            cmds.append("RCPT TO:%s" % smtplib.quoteaddr(addr))
+        con.send("".join([ c+"\r\n" for c in cmds ]))
+        replies = [ con.getreply() for _ in cmds ]
+
+        code, resp = replies[0]
+        if code != 250:
+            con.rset()
+            raise smtplib.SMTPSenderRefused(code, resp, fromAddr)
+        refused = {}
+        for addr, (code, resp) in zip(toList, replies[1:]):
+            if code not in (250, 251):
+                refused[addr] = (code, resp)
+        if len(refused) == len(toList):
+            con.rset()
+            raise smtplib.SMTPRecipientsRefused(refused)
+        code, resp = con.data(message)
+        if code != 250:
+            con.rset()
+            raise smtplib.SMTPDataError(code, resp)
+
+    def _quit(self, con):
+        """Helper: politely close 'con', ignoring errors."""
+        try:
+            con.quit()
+        except (smtplib.SMTPException, socket.error):
+            pass
+        self._close(con)
+
+    def _close(self, con):
+        """Helper: close 'con' without saying goodbye."""
+        try:
+            con.close()
+        except socket.error:
+            pass
+
+def sendSMTPMessage(cfgSection, toList, fromAddr, message, pool=None):
     """Send a single SMTP message.  The message will be delivered to
-       toList, and seem to originate from fromAddr.  We use 'server' as an
-       MTA.
-       DOCDOC
+       toList, and seem to originate from fromAddr.  If cfgSection has a
+       SendmailCommand, we pipe the message to it.  Otherwise, we use
+       cfgSection's SMTPServer (default: localhost) as an MTA, via the
+       SMTPConnectionPool 'pool' if one is given.
+
+       Returns DELIVER_OK or DELIVER_FAIL_RETRY.
     """
     # FFFF This implementation can stall badly if we don't have a fast
     # FFFF local MTA.
-
-    # FFFF We should leave the connection open if we're going to send many
-    # FFFF messages in a row.
-    if cfgSection['SendmailCommand'] is not None:
+    if cfgSection.get('SendmailCommand') is not None:
         cmd, opts = cfgSection['SendmailCommand']
-        command = cmd + (" ".join(opts))
+        command = " ".join([cmd]+list(opts))
         f = os.popen(command, 'w')
         f.write(message)
-        f.close()
-    else:
-        server = cfgSection.get('SMTPServer','localhost')
-        LOG.debug("Sending message via SMTP host %s to %s", server, toList)
-        con = smtplib.SMTP(server)
-        try:
-            con.sendmail(fromAddr, toList, message)
-            res = DELIVER_OK
-        except (smtplib.SMTPException, socket.error), e:
-            LOG.warn("Unsuccessful SMTP connection to %s: %s",
-                     server, str(e))
-            res = DELIVER_FAIL_RETRY
-
-        con.quit()
-        con.close()
+        if f.close():
+            LOG.warn("Sendmail command %s failed", command)
+            return DELIVER_FAIL_RETRY
+        return DELIVER_OK
 
-    return res
+    if pool is None:
+        pool = SMTPConnectionPool(cfgSection.get('SMTPServer','localhost'),
+                                  idleTimeout=0)
+    return pool.sendMessage(toList, fromAddr, message)
 
 #----------------------------------------------------------------------
 
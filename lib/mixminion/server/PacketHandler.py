@@ -3,6 +3,8 @@
 """mixminion.server.PacketHandler: Code to process mixminion packets"""
 
 import binascii
+import os
+import signal
 import threading
 import types
 
@@ -14,12 +16,29 @@ import mixminion.BuildMessage
 from mixminion.ServerInfo import PACKET_KEY_BYTES
 from mixminion.Common import MixError, MixFatalError, isPrintingAscii
 
-__all__ = [ 'PacketHandler', 'ContentError', 'DeliveryPacket', 'RelayedPacket']
+try:
+    import multiprocessing
+except ImportError:
+    multiprocessing = None
+
+__all__ = [ 'PacketHandler', 'ContentError', 'DeliveryPacket', 'RelayedPacket',
+            'canUseWorkerProcesses' ]
 
 class ContentError(MixError):
     """Exception raised when a packed is malformatted or unacceptable."""
     pass
 
+# Every time we decrypt a packet, we multiply the score for every key by
+# this amount, and add 1 to the score of the key that worked.  A key's
+# score is thus a count of its recent successes, with a half-life of
+# about 70 packets.
+KEY_SCORE_DECAY = 0.99
+
+def canUseWorkerProcesses():
+    """Return true iff we have the required libraries installed to decrypt
+       packets in a pool of worker processes."""
+    return multiprocessing is not None and hasattr(os, 'fork')
+
 class PacketHandler:
     """Class to handle processing packets.  Given an incoming packet,
        it removes one layer of encryption, does all necessary integrity
@@ -30,18 +49,37 @@ class PacketHandler:
     # privatekeys: a list of 2-tuples of
     #      (1) a RSA private key that we accept
     #      (2) a HashLog objects corresponding to the given key
+    # keyIDs: a list of the SHA1 digests of the public keys in privatekeys,
+    #      in the same order.
+    # keyScores: a map from the SHA1 digest of each public key to a
+    #      decaying count of how many packets it has decrypted recently.
+    #      We keep privatekeys sorted by keyScores, so that we try the
+    #      most likely key first.  During a key rotation, this saves us
+    #      a failed RSA decryption for most packets.
+    # hashlogByKeyID: a map from the SHA1 digest of each public key in
+    #      privatekeys to the corresponding HashLog.
+    # workers: None, or a multiprocessing.Pool whose processes each hold
+    #      a copy of the private keys in privatekeys.
+    # nWorkers: the number of worker processes we want to run; 0 if we
+    #      should process all packets in the calling thread.
     def __init__(self, privatekeys=(), hashlogs=()):
         """Constructs a new packet handler, given a sequence of
            private key object for header encryption, and a sequence of
            corresponding hashlog object to prevent replays.
 
            The lists must be equally long.  When a new packet is
-           processed, we try each of the private keys in sequence.  If
-           the packet is decodeable with one of the keys, we log it in
-           the corresponding entry of the hashlog list.
+           processed, we try each of the private keys in sequence, starting
+           with the one that has worked most often recently.  If the
+           packet is decodeable with one of the keys, we log it in the
+           corresponding entry of the hashlog list.
         """
         self.privatekeys = []
+        self.keyIDs = []
+        self.keyScores = {}
+        self.hashlogByKeyID = {}
         self.lock = threading.Lock()
+        self.workers = None
+        self.nWorkers = 0
 
         assert type(privatekeys) in (types.ListType, types.TupleType)
         assert type(hashlogs) in (types.ListType, types.TupleType)
@@ -65,11 +103,71 @@ class PacketHandler:
             for k, h in self.privatekeys:
                 if not newKeys.get(k.encode_key(1)):
                     h.close()
-            # Now, set the keys.
-            self.privatekeys = zip(keys, hashlogs)
+            # Now, set the keys.  Keep the scores of any keys we already
+            # had, so that we still try the likeliest key first.
+            self.hashlogByKeyID = {}
+            scores = {}
+            decorated = []
+            for i in xrange(len(keys)):
+                keyID = _getKeyID(keys[i])
+                self.hashlogByKeyID[keyID] = hashlogs[i]
+                scores[keyID] = self.keyScores.get(keyID, 0.0)
+                decorated.append((-scores[keyID], i, keyID))
+            decorated.sort()
+            self.privatekeys = [ (keys[i], hashlogs[i])
+                                 for _, i, _ in decorated ]
+            self.keyIDs = [ keyID for _, _, keyID in decorated ]
+            self.keyScores = scores
+            oldWorkers = self.workers
+            if self.nWorkers:
+                self.workers = self._startWorkers()
         finally:
             self.lock.release()
 
+        # Let the old workers finish whatever they were doing with the
+        # old keys.  Their results will still reach the HashLogs, since
+        # we look up HashLogs by key digest, not by position.  We're
+        # probably being called from the main thread, so we wait for them
+        # to exit in a thread of our own.
+        if oldWorkers is not None:
+            oldWorkers.close()
+            t = threading.Thread(None, oldWorkers.join,
+                                 "Old packet workers")
+            t.setDaemon(1)
+            t.start()
+
+    def startWorkers(self, nWorkers):
+        """Begin decrypting packets passed to processPacketAsync in a pool
+           of 'nWorkers' separate processes.  Each process holds its own
+           copy of our private keys; replay detection still happens in
+           this process."""
+        assert nWorkers > 0
+        if not canUseWorkerProcesses():
+            raise MixFatalError("Worker processes require Python 2.6 or later"
+                                " on a platform with fork()")
+        self.lock.acquire()
+        try:
+            assert self.workers is None
+            self.nWorkers = nWorkers
+            self.workers = self._startWorkers()
+        finally:
+            self.lock.release()
+
+    def _startWorkers(self):
+        """Helper: create and return a new pool of self.nWorkers worker
+           processes holding our current private keys.  Callers must hold
+           self.lock."""
+        LOG.debug("Starting %s packet processing workers", self.nWorkers)
+        encodedKeys = [ Crypto.pk_encode_private_key(k)
+                        for k, _ in self.privatekeys ]
+        return multiprocessing.Pool(self.nWorkers, _initWorker,
+                                    (encodedKeys, self.keyScores.copy()))
+
+    def hasWorkers(self):
+        """Return true iff this PacketHandler decrypts packets in worker
+           processes."""
+        return self.workers is not None
+
     def syncLogs(self):
         """Sync all this PacketHandler's hashlogs."""
         try:
@@ -80,13 +178,20 @@ class PacketHandler:
             self.lock.release()
 
     def close(self):
-        """Close all this PacketHandler's hashlogs."""
+        """Close all this PacketHandler's hashlogs, and stop any worker
+           processes."""
         try:
             self.lock.acquire()
+            workers = self.workers
+            self.workers = None
+            self.nWorkers = 0
             for _, h in self.privatekeys:
                 h.close()
         finally:
             self.lock.release()
+        if workers is not None:
+            workers.terminate()
+            workers.join()
 
     def processPacket(self, msg):
         """Given a 32K mixminion packet, processes it completely.
@@ -105,49 +210,16 @@ class PacketHandler:
            packets, and exit packets are all processed faster than
            forwarded packets.  You must prevent timing attacks elsewhere."""
 
-        # Break into headers and payload
-        pkt = Packet.parsePacket(msg)
-        header1 = Packet.parseHeader(pkt.header1)
-        encSubh = header1[:Packet.ENC_SUBHEADER_LEN]
-        header1 = header1[Packet.ENC_SUBHEADER_LEN:]
-
-        assert len(header1) == Packet.HEADER_LEN - Packet.ENC_SUBHEADER_LEN
-        assert len(header1) == (128*16) - 256 == 1792
-
         # Try to decrypt the first subheader.  Try each private key in
         # order.  Only fail if all private keys fail.
-        subh = None
-        e = None
         self.lock.acquire()
         try:
-            for pk, hashlog in self.privatekeys:
-                try:
-                    subh = Crypto.pk_decrypt(encSubh, pk)
-                    break
-                except Crypto.CryptoError, err:
-                    e = err
+            pkt, subh, header1, keys, idx = _decodeHeader(msg,
+                                                          self.privatekeys)
+            hashlog = self.privatekeys[idx][1]
+            _noteKeyUsed(self.privatekeys, self.keyIDs, self.keyScores, idx)
         finally:
             self.lock.release()
-        if not subh:
-            # Nobody managed to get us the first subheader.  Raise the
-            # most-recently-received error.
-            raise e
-
-        if len(subh) != Packet.MAX_SUBHEADER_LEN:
-            raise ContentError("Bad length in RSA-encrypted part of subheader")
-
-        subh = Packet.parseSubheader(subh) #may raise ParseError
-
-        # Check the version: can we read it?
-        if subh.major != Packet.MAJOR_NO or subh.minor != Packet.MINOR_NO:
-            raise ContentError("Invalid protocol version")
-
-        # Check the digest of all of header1 but the first subheader.
-        if subh.digest != Crypto.sha1(header1):
-            raise ContentError("Invalid digest")
-
-        # Get ready to generate packet keys.
-        keys = Crypto.Keyset(subh.secret)
 
         # Replay prevention
         replayhash = keys.get(Crypto.REPLAY_PREVENTION_MODE, Crypto.DIGEST_LEN)
@@ -156,87 +228,323 @@ class PacketHandler:
         else:
             hashlog.logHash(replayhash)
 
-        # If we're meant to drop, drop now.
-        rt = subh.routingtype
-        if rt == Packet.DROP_TYPE:
-            return None
-
-        # Prepare the key to decrypt the header in counter mode.  We'll be
-        # using this more than once.
-        header_sec_key = Crypto.aes_key(keys.get(Crypto.HEADER_SECRET_MODE))
-
-        # Prepare key to generate padding
-        junk_key = Crypto.aes_key(keys.get(Crypto.RANDOM_JUNK_MODE))
-
-        # Pad the rest of header 1
-        header1 += Crypto.prng(junk_key,
-                               Packet.OAEP_OVERHEAD + Packet.MIN_SUBHEADER_LEN
-                               + subh.routinglen)
-
-        assert len(header1) == (Packet.HEADER_LEN - Packet.ENC_SUBHEADER_LEN
-                             + Packet.OAEP_OVERHEAD+Packet.MIN_SUBHEADER_LEN
-                                + subh.routinglen)
-        assert len(header1) == 1792 + 42 + 42 + subh.routinglen == \
-               1876 + subh.routinglen
+        return _decodePayload(pkt, subh, header1, keys)
 
-        # Decrypt the rest of header 1, encrypting the padding.
-        header1 = Crypto.ctr_crypt(header1, header_sec_key)
+    def processPackets(self, msgs):
+        """Given a list of 32K mixminion packets, process them all
+           completely, as with processPacket.  This is faster than calling
+           processPacket for each packet: we only take our lock once, and
+           we check each HashLog for replays in a single pass.
 
-        # If the subheader says that we have extra routing info that didn't
-        # fit in the RSA-encrypted part, get it now.
-        overflowLength = subh.getOverflowLength()
-        if overflowLength:
-            subh.appendOverflow(header1[:overflowLength])
-            header1 = header1[overflowLength:]
-
-        assert len(header1) == (
-            1876 + subh.routinglen
-            - max(0,subh.routinglen-Packet.MAX_ROUTING_INFO_LEN))
-
-        header1 = subh.underflow + header1
-
-        assert len(header1) == Packet.HEADER_LEN
-
-        # Decrypt the payload.
-        payload = Crypto.lioness_decrypt(pkt.payload,
-                              keys.getLionessKeys(Crypto.PAYLOAD_ENCRYPT_MODE))
-
-        # If we're an exit node, there's no need to process the headers
-        # further.
-        if rt >= Packet.MIN_EXIT_TYPE:
-            return DeliveryPacket(rt, subh.getExitAddress(0),
-                                  keys.get(Crypto.APPLICATION_KEY_MODE),
-                                  payload)
-
-        # If we're not an exit node, make sure that what we recognize our
-        # routing type.
-        if rt not in (Packet.SWAP_FWD_IPV4_TYPE, Packet.FWD_IPV4_TYPE,
-                      Packet.SWAP_FWD_HOST_TYPE, Packet.FWD_HOST_TYPE):
-            raise ContentError("Unrecognized Mixminion routing type")
-
-        # Decrypt header 2.
-        header2 = Crypto.lioness_decrypt(pkt.header2,
-                           keys.getLionessKeys(Crypto.HEADER_ENCRYPT_MODE))
-
-        # If we're the swap node, (1) decrypt the payload with a hash of
-        # header2... (2) decrypt header2 with a hash of the payload...
-        # (3) and swap the headers.
-        if Packet.typeIsSwap(rt):
-            hkey = Crypto.lioness_keys_from_header(header2)
-            payload = Crypto.lioness_decrypt(payload, hkey)
-
-            hkey = Crypto.lioness_keys_from_payload(payload)
-            header2 = Crypto.lioness_decrypt(header2, hkey)
-
-            header1, header2 = header2, header1
-
-        # Build the address object for the next hop
-        address = Packet.parseRelayInfoByType(rt, subh.routinginfo)
-
-        # Construct the packet for the next hop.
-        pkt = Packet.Packet(header1, header2, payload).pack()
+           Return a list of (result, error) tuples, in the same order as
+           msgs.  If a packet was processed successfully, result is as would
+           be returned from processPacket, and error is None.  Otherwise,
+           result is None, and error is the exception that processPacket
+           would have raised.
+        """
+        results = [ (None, None) ] * len(msgs)
+        # List of (index, pkt, subh, header1, keys) for every packet whose
+        # header we could decode.
+        decoded = []
+        # Map from id(hashlog) to a list of (index into decoded, replay hash)
+        byLog = {}
+        logs = {}
+        self.lock.acquire()
+        try:
+            for i in xrange(len(msgs)):
+                try:
+                    pkt, subh, header1, keys, idx = _decodeHeader(
+                        msgs[i], self.privatekeys)
+                except Exception, e:
+                    results[i] = (None, e)
+                    continue
+                hashlog = self.privatekeys[idx][1]
+                _noteKeyUsed(self.privatekeys, self.keyIDs, self.keyScores,
+                             idx)
+                replayhash = keys.get(Crypto.REPLAY_PREVENTION_MODE,
+                                      Crypto.DIGEST_LEN)
+                byLog.setdefault(id(hashlog), []).append(
+                    (len(decoded), replayhash))
+                logs[id(hashlog)] = hashlog
+                decoded.append((i, pkt, subh, header1, keys))
+        finally:
+            self.lock.release()
 
-        return RelayedPacket(address, pkt)
+        # Replay prevention, one HashLog at a time.
+        isReplay = [0] * len(decoded)
+        for logID, entries in byLog.items():
+            seen = logs[logID].logHashes([ h for _, h in entries ])
+            for (d, _), s in zip(entries, seen):
+                isReplay[d] = s
+
+        for d in xrange(len(decoded)):
+            i, pkt, subh, header1, keys = decoded[d]
+            if isReplay[d]:
+                results[i] = (None, ContentError("Duplicate packet detected."))
+                continue
+            try:
+                results[i] = (_decodePayload(pkt, subh, header1, keys), None)
+            except Exception, e:
+                results[i] = (None, e)
+
+        return results
+
+    def processPacketAsync(self, msg, callback):
+        """Begin processing the 32K packet 'msg' in one of our worker
+           processes.  When the worker is done, 'callback' is invoked --
+           from some other thread -- with an opaque result object.  The
+           caller must pass that object to finishPacket, preferably from
+           the same thread that would otherwise call processPacket, since
+           finishPacket is where replays are detected."""
+        assert self.workers is not None
+        self.workers.apply_async(_workerProcessPacket, (msg,),
+                                 callback=callback)
+
+    def finishPacket(self, result):
+        """Given a result object passed to a processPacketAsync callback,
+           check it for replays, and return or raise as processPacket
+           would have."""
+        keyID, replayhash, pkt, err = result
+        if keyID is not None:
+            # The worker only updated its own copy of the key scores; update
+            # ours too, so that we still pass the right order to new workers
+            # after a key rotation.
+            self.lock.acquire()
+            try:
+                if keyID in self.keyIDs:
+                    _noteKeyUsed(self.privatekeys, self.keyIDs,
+                                 self.keyScores, self.keyIDs.index(keyID))
+            finally:
+                self.lock.release()
+        if replayhash is not None:
+            hashlog = self.hashlogByKeyID.get(keyID)
+            if hashlog is None:
+                raise ContentError("Packet key expired during processing")
+            if hashlog.seenHash(replayhash):
+                raise ContentError("Duplicate packet detected.")
+            else:
+                hashlog.logHash(replayhash)
+        if err is not None:
+            raise err
+        return pkt
+
+def _getKeyID(pk):
+    """Helper: return a digest to identify the private key 'pk'
+       across processes."""
+    return Crypto.sha1(pk.encode_key(1))
+
+def _noteKeyUsed(privatekeys, keyIDs, scores, idx):
+    """Helper: note that we just decrypted a packet with the idx'th key in
+       'privatekeys', whose digest is keyIDs[idx].  Update the key scores
+       in 'scores', and move the key earlier in both lists if it has
+       become likelier than the keys before it."""
+    if len(keyIDs) < 2:
+        return
+    for k in keyIDs:
+        scores[k] *= KEY_SCORE_DECAY
+    keyID = keyIDs[idx]
+    scores[keyID] += 1
+    while idx > 0 and scores[keyIDs[idx-1]] < scores[keyID]:
+        privatekeys[idx-1], privatekeys[idx] = \
+                            privatekeys[idx], privatekeys[idx-1]
+        keyIDs[idx-1], keyIDs[idx] = keyIDs[idx], keyIDs[idx-1]
+        idx -= 1
+
+def _decodeHeader(msg, privatekeys):
+    """Helper: parse the 32K packet 'msg', and try to decrypt its first
+       subheader with each of the keys in 'privatekeys', a list of
+       (key, hashlog) tuples as in PacketHandler.privatekeys.
+
+       Return a 5-tuple of: the parsed Packet, the parsed Subheader, the
+       still-encrypted remainder of header 1, the Keyset for the
+       subheader's master secret, and the index in privatekeys of the key
+       that worked.  Raise CryptoError, ParseError,
+       or ContentError if the header is bad.
+    """
+    # Break into headers and payload
+    pkt = Packet.parsePacket(msg)
+    header1 = Packet.parseHeader(pkt.header1)
+    encSubh = header1[:Packet.ENC_SUBHEADER_LEN]
+    header1 = header1[Packet.ENC_SUBHEADER_LEN:]
+
+    assert len(header1) == Packet.HEADER_LEN - Packet.ENC_SUBHEADER_LEN
+    assert len(header1) == (128*16) - 256 == 1792
+
+    subh = None
+    e = None
+    idx = 0
+    for pk, _ in privatekeys:
+        try:
+            subh = Crypto.pk_decrypt(encSubh, pk)
+            break
+        except Crypto.CryptoError, err:
+            e = err
+        idx += 1
+    if not subh:
+        # Nobody managed to get us the first subheader.  Raise the
+        # most-recently-received error.
+        raise e
+
+    if len(subh) != Packet.MAX_SUBHEADER_LEN:
+        raise ContentError("Bad length in RSA-encrypted part of subheader")
+
+    subh = Packet.parseSubheader(subh) #may raise ParseError
+
+    # Check the version: can we read it?
+    if subh.major != Packet.MAJOR_NO or subh.minor != Packet.MINOR_NO:
+        raise ContentError("Invalid protocol version")
+
+    # Check the digest of all of header1 but the first subheader.
+    if subh.digest != Crypto.sha1(header1):
+        raise ContentError("Invalid digest")
+
+    # Get ready to generate packet keys.
+    keys = Crypto.Keyset(subh.secret)
+
+    return pkt, subh, header1, keys, idx
+
+def _decodePayload(pkt, subh, header1, keys):
+    """Helper: given the outputs of _decodeHeader for a packet that has
+       passed replay detection, finish processing the packet as described
+       in PacketHandler.processPacket."""
+    # If we're meant to drop, drop now.
+    rt = subh.routingtype
+    if rt == Packet.DROP_TYPE:
+        return None
+
+    # Prepare the key to decrypt the header in counter mode.  We'll be
+    # using this more than once.
+    header_sec_key = Crypto.aes_key(keys.get(Crypto.HEADER_SECRET_MODE))
+
+    # Prepare key to generate padding
+    junk_key = Crypto.aes_key(keys.get(Crypto.RANDOM_JUNK_MODE))
+
+    # Pad the rest of header 1
+    header1 += Crypto.prng(junk_key,
+                           Packet.OAEP_OVERHEAD + Packet.MIN_SUBHEADER_LEN
+                           + subh.routinglen)
+
+    assert len(header1) == (Packet.HEADER_LEN - Packet.ENC_SUBHEADER_LEN
+                         + Packet.OAEP_OVERHEAD+Packet.MIN_SUBHEADER_LEN
+                            + subh.routinglen)
+    assert len(header1) == 1792 + 42 + 42 + subh.routinglen == \
+           1876 + subh.routinglen
+
+    # Decrypt the rest of header 1, encrypting the padding.
+    header1 = Crypto.ctr_crypt(header1, header_sec_key)
+
+    # If the subheader says that we have extra routing info that didn't
+    # fit in the RSA-encrypted part, get it now.
+    overflowLength = subh.getOverflowLength()
+    if overflowLength:
+        subh.appendOverflow(header1[:overflowLength])
+        header1 = header1[overflowLength:]
+
+    assert len(header1) == (
+        1876 + subh.routinglen
+        - max(0,subh.routinglen-Packet.MAX_ROUTING_INFO_LEN))
+
+    header1 = subh.underflow + header1
+
+    assert len(header1) == Packet.HEADER_LEN
+
+    # Decrypt the payload.
+    payload = Crypto.lioness_decrypt(pkt.payload,
+                          keys.getLionessKeys(Crypto.PAYLOAD_ENCRYPT_MODE))
+
+    # If we're an exit node, there's no need to process the headers
+    # further.
+    if rt >= Packet.MIN_EXIT_TYPE:
+        return DeliveryPacket(rt, subh.getExitAddress(0),
+                              keys.get(Crypto.APPLICATION_KEY_MODE),
+                              payload)
+
+    # If we're not an exit node, make sure that what we recognize our
+    # routing type.
+    if rt not in (Packet.SWAP_FWD_IPV4_TYPE, Packet.FWD_IPV4_TYPE,
+                  Packet.SWAP_FWD_HOST_TYPE, Packet.FWD_HOST_TYPE):
+        raise ContentError("Unrecognized Mixminion routing type")
+
+    # Decrypt header 2.
+    header2 = Crypto.lioness_decrypt(pkt.header2,
+                       keys.getLionessKeys(Crypto.HEADER_ENCRYPT_MODE))
+
+    # If we're the swap node, (1) decrypt the payload with a hash of
+    # header2... (2) decrypt header2 with a hash of the payload...
+    # (3) and swap the headers.
+    if Packet.typeIsSwap(rt):
+        hkey = Crypto.lioness_keys_from_header(header2)
+        payload = Crypto.lioness_decrypt(payload, hkey)
+
+        hkey = Crypto.lioness_keys_from_payload(payload)
+        header2 = Crypto.lioness_decrypt(header2, hkey)
+
+        header1, header2 = header2, header1
+
+    # Build the address object for the next hop
+    address = Packet.parseRelayInfoByType(rt, subh.routinginfo)
+
+    # Construct the packet for the next hop.
+    pkt = Packet.Packet(header1, header2, payload).pack()
+
+    return RelayedPacket(address, pkt)
+
+#----------------------------------------------------------------------
+# Worker processes.
+#
+# Each worker process holds a list of (key, None) tuples in _WORKER_KEYS,
+# and decodes packets with them.  Like PacketHandler, it keeps the keys
+# ordered by how often they have worked recently.  Because the HashLogs
+# live in the parent process, workers can't do replay detection:
+# instead, they return the replay hash along with the decoded packet, and
+# let PacketHandler.finishPacket decide whether the packet is new.
+
+# List of (private key, None) for the current worker process.
+_WORKER_KEYS = None
+# List of key IDs for the keys in _WORKER_KEYS.
+_WORKER_KEYIDS = None
+# Map from key ID to score, as in PacketHandler.keyScores.
+_WORKER_KEY_SCORES = None
+
+def _initWorker(encodedKeys, scores):
+    """Initializer for worker processes: decode our copy of the private
+       keys, and reset the server's signal handlers."""
+    global _WORKER_KEYS, _WORKER_KEYIDS, _WORKER_KEY_SCORES
+    _WORKER_KEYS = []
+    _WORKER_KEYIDS = []
+    for s in encodedKeys:
+        pk = Crypto.pk_decode_private_key(s)
+        _WORKER_KEYS.append((pk, None))
+        _WORKER_KEYIDS.append(_getKeyID(pk))
+    _WORKER_KEY_SCORES = scores
+    # The parent process handles all signals for us.
+    for name in 'SIGTERM', 'SIGHUP', 'SIGINT':
+        if hasattr(signal, name):
+            signal.signal(getattr(signal, name), signal.SIG_IGN)
+    if hasattr(signal, 'SIGCHLD'):
+        signal.signal(signal.SIGCHLD, signal.SIG_DFL)
+
+def _workerProcessPacket(msg):
+    """Process the packet 'msg' in a worker process, and return a 4-tuple
+       of (keyID, replayhash, packet, error) for PacketHandler.finishPacket.
+       If the packet never got far enough to have a replay hash, replayhash
+       is None.  Exceptions are returned, not raised, so that they reach
+       the parent process."""
+    replayhash = keyID = None
+    try:
+        pkt, subh, header1, keys, idx = _decodeHeader(msg, _WORKER_KEYS)
+        keyID = _WORKER_KEYIDS[idx]
+        _noteKeyUsed(_WORKER_KEYS, _WORKER_KEYIDS, _WORKER_KEY_SCORES, idx)
+        replayhash = keys.get(Crypto.REPLAY_PREVENTION_MODE,
+                              Crypto.DIGEST_LEN)
+        return (keyID, replayhash, _decodePayload(pkt, subh, header1, keys),
+                None)
+    except (MixError, Crypto.CryptoError), e:
+        return keyID, replayhash, None, e
+    except Exception, e:
+        # The exception might not survive pickling; send its description.
+        return keyID, replayhash, None, MixError(
+            "Unexpected %s in worker process: %s"%(e.__class__.__name__, e))
 
 class RelayedPacket:
     """A packet that is to be relayed to another server; returned by
@@ -54,6 +54,10 @@ except ImportError:
 HEARTBEAT_INTERVAL = 30*60
 # Number of seconds in a day.
 ONE_DAY = 24*60*60
+# How often should the server write buffered ping events to disk (seconds)?
+FLUSH_INTERVAL = 5*60
+# How many ping events should we buffer before writing them to disk?
+MAX_PENDING_EVENTS = 256
 
 class IntervalSchedule:
     """A partition of time into a series of intervals.  (Currently, only
@@ -91,6 +95,7 @@ class SQLiteDatabase:
        only need to install a library.
     """
     ## Fields:
+    # _location: The filename of the database.
     # _theConnection: A SQLite database connection.  Only one thread should
     #    use this connection at a time.
     # _theCursor: A cursor for the connection.
@@ -105,19 +110,42 @@ class SQLiteDatabase:
                   'varchar'   : 'varchar',
                   'char'      : 'char',
               }
+    # How long should we wait for another connection to release its lock
+    # on the database before giving up? (seconds)
+    BUSY_TIMEOUT = 60
+
 
     def __init__(self, location):
         """Create a SQLite database storing its data in the file 'location'."""
         parent = os.path.split(location)[0]
         createPrivateDir(parent)
-        self._theConnection = sqlite3.connect(location, isolation_level=None)
+        self._location = location
+        # We open the connection in one thread and then use it from the
+        # database thread; we never use it from two threads at once.
+        self._theConnection = sqlite3.connect(location, isolation_level=None,
+                                              timeout=self.BUSY_TIMEOUT,
+                                              check_same_thread=False)
         self._theCursor = self._theConnection.cursor()
+        # With a write-ahead log, a commit only needs to append to the log,
+        # and readers don't block writers.  (Older SQLite versions ignore
+        # this pragma.)
+        self._theCursor.execute("PRAGMA journal_mode=WAL")
+        self._theCursor.execute("PRAGMA synchronous=NORMAL")
 
     def close(self):
         """Release resources held by this database."""
         self._theConnection.close()
         self._theConnection = self._theCursor = None
 
+    def reopen(self):
+        """Return a new database object for the same database, with a
+           connection of its own.  Since we use a write-ahead log, readers
+           on one connection don't block writers on the other.  Note that
+           our connections are in autocommit mode, so each statement sees
+           the database as of when it began: a series of queries does not
+           see a single consistent snapshot."""
+        return self.__class__(self._location)
+
     def getConnection(self):
         """Return a database connection object.  You do not need to close it
            when you are done."""
@@ -195,6 +223,20 @@ class SQLiteDatabase:
         self._theCursor.execute(stmt)
         self._theConnection.commit()
 
+    def executeBatch(self, batch):
+        """Given a list of (statement, list of argument tuples) pairs,
+           execute each statement once for each of its argument tuples,
+           in order, all within a single transaction."""
+        cur = self._theCursor
+        cur.execute("BEGIN")
+        try:
+            for stmt, rows in batch:
+                cur.executemany(stmt, rows)
+        except:
+            cur.execute("ROLLBACK")
+            raise
+        cur.execute("COMMIT")
+
     def time(self, t=None):
         """Convert 't' (a Unix time in seconds since the epoch) into the
            format the database wants for its timestamp fields.  If 't' is None,
@@ -227,11 +269,7 @@ class SQLiteDatabase:
 ##             ", ".join(keyCols),
 ##             ", ".join(valCols),
 ##             ", ".join(["%s"]*(len(valCols)+len(keyCols))))
-        stmt = "INSERT OR REPLACE INTO %s (%s, %s) VALUES (%s)"% (
-            table,
-            ", ".join(keyCols),
-            ", ".join(valCols),
-            ", ".join(["?"]*(len(valCols)+len(keyCols))))
+        stmt = self._getInsertOrUpdateStmt(table, keyCols, valCols)
         def fn(keyVals, valVals):
             assert len(keyVals) == len(keyCols)
             assert len(valVals) == len(valCols)
@@ -239,6 +277,25 @@ class SQLiteDatabase:
             self._theCursor.execute(stmt, (keyVals+valVals))
         return fn
 
+    def getInsertOrUpdateManyFn(self, table, keyCols, valCols):
+        """As getInsertOrUpdateFn, but return a function that takes a
+           list of (keyVals, valVals) tuples and stores them all in a
+           single transaction."""
+        stmt = self._getInsertOrUpdateStmt(table, keyCols, valCols)
+        def fn(rows):
+            self.executeBatch([(stmt, [ k+v for k,v in rows ])])
+        return fn
+
+    def _getInsertOrUpdateStmt(self, table, keyCols, valCols):
+        """Helper: return a statement to insert or replace a row in
+           'table', taking the values for keyCols and then valCols as
+           arguments."""
+        return "INSERT OR REPLACE INTO %s (%s, %s) VALUES (%s)"% (
+            table,
+            ", ".join(keyCols),
+            ", ".join(valCols),
+            ", ".join(["?"]*(len(valCols)+len(keyCols))))
+
     def encodeIdentity(self, identity):
         """DOCDOC"""
         if identity == '<self>':
@@ -278,8 +335,13 @@ class PingLog:
     # _startTime: The 'startup' time for the current myLifespan row.
     # _lastRecalculation: The last time this process recomputed all
     #   the stats, or 0 for 'never'.
-    # _set{Uptime|OneHop|CurOneHop|TwoHop}: Functions generated by
+    # _calculating: True iff we are recomputing the stats in the background.
+    # _set{Uptime|OneHop|Latency|Finished|CurOneHop}: Functions generated by
     #   getInsertOrUpdateFn.
+    # _setTwoHops: A function generated by getInsertOrUpdateManyFn.
+    # _pendingEvents: A list of (statement, arguments) tuples for events
+    #   that we have noted but not yet written to the database, in order.
+    # _lastFlush: The last time we wrote _pendingEvents to the database.
 
     # FFFF Maybe refactor this into data storage and stats computation.
     def __init__(self, db):
@@ -294,6 +356,9 @@ class PingLog:
         self._interestingChains = {}
         self._startTime = None
         self._lastRecalculation = 0
+        self._calculating = 0
+        self._pendingEvents = []
+        self._lastFlush = time.time()
         self._createAllTables()
         self._loadServers()
 
@@ -424,6 +489,29 @@ class PingLog:
                  ("interesting", "bool",      "not null")],
                 ["PRIMARY KEY (server1, server2)"])
 
+            # Holds the distribution of one-hop latencies for finished
+            # intervals.  Each row means: during 'interval', we received 'n'
+            # one-hop probes sent to 'server' whose latency, rounded with
+            # _roundLatency, was 'latency' seconds.
+            self._db.createTable(
+                "echolotOneHopLatency",
+                [("server",   "integer", "not null REFERENCES server(id)"),
+                 ("interval", "integer", "not null REFERENCES statsInterval(id)"),
+                 ("latency",  "integer", "not null"),
+                 ("n",        "integer", "not null")],
+                ["PRIMARY KEY (server, interval, latency)"])
+
+            # Records which results we will not recompute.  A row in
+            # finishedInterval means: at 'at', we decided that our results
+            # of type 'kind' ('uptime' or 'onehop') for 'interval' were
+            # final.
+            self._db.createTable(
+                "finishedInterval",
+                [("interval", "integer", "not null REFERENCES statsInterval(id)"),
+                 ("kind",     "varchar(16)", "not null"),
+                 ("at",       "timestamp",   "not null")],
+                ["PRIMARY KEY (interval, kind)"])
+
             #### Indices.
 
             self._db.createIndex("serverIdentity", "server",
@@ -450,11 +538,17 @@ class PingLog:
                 ["server", "interval"],
                 ["nSent", "nReceived", "latency", "wsent", "wreceived",
                  "reliability"])
+            self._setLatency = self._db.getInsertOrUpdateFn(
+                "echolotOneHopLatency",
+                ["server", "interval", "latency"],
+                ["n"])
+            self._setFinished = self._db.getInsertOrUpdateFn(
+                "finishedInterval", ["interval", "kind"], ["at"])
             self._setCurOneHop = self._db.getInsertOrUpdateFn(
                 "echolotCurrentOneHopResult",
                 ["server"],
                 ["at", "latency", "reliability"])
-            self._setTwoHop = self._db.getInsertOrUpdateFn(
+            self._setTwoHops = self._db.getInsertOrUpdateManyFn(
                 "echolotCurrentTwoHopResult",
                 ["server1", "server2"],
                 ["at", "nSent", "nReceived", "broken", "interesting"])
@@ -563,6 +657,7 @@ class PingLog:
            before 'dataCutoff', and any computed statistics from before
            'resultsCutoff'.
         """
+        self.flush()
         #if now is None: now = time.time()
         #sec = config['Pinging']
         #dataCutoff = self._db.time(now - sec['RetainPingData'])
@@ -579,17 +674,56 @@ class PingLog:
         cur.execute("DELETE FROM echolotOneHopResult WHERE interval IN "
                     "( SELECT id FROM statsInterval WHERE endAt < ? )",
                     [resultsCutoff])
+        cur.execute("DELETE FROM echolotOneHopLatency WHERE interval IN "
+                    "( SELECT id FROM statsInterval WHERE endAt < ? )",
+                    [resultsCutoff])
+        cur.execute("DELETE FROM finishedInterval WHERE interval IN "
+                    "( SELECT id FROM statsInterval WHERE endAt < ? )",
+                    [resultsCutoff])
         cur.execute("DELETE FROM statsInterval WHERE endAt < ?", [resultsCutoff])
 
         self._db.getConnection().commit()
 
+    def _noteEvent(self, stmt, args):
+        """Helper: remember that we need to execute 'stmt' with the
+           arguments 'args'.  We buffer events in memory, and write them
+           in a single transaction every FLUSH_INTERVAL seconds, or once
+           we have MAX_PENDING_EVENTS of them, whichever comes first.
+        """
+        self._lock.acquire()
+        try:
+            self._pendingEvents.append((stmt, args))
+            if (len(self._pendingEvents) >= MAX_PENDING_EVENTS or
+                time.time() >= self._lastFlush + FLUSH_INTERVAL):
+                self.flush()
+        finally:
+            self._lock.release()
+
     def flush(self):
         """Write any pending information to disk."""
-        self._db.getConnection().commit()
+        self._lock.acquire()
+        try:
+            events = self._pendingEvents
+            self._pendingEvents = []
+            self._lastFlush = time.time()
+            if not events:
+                return
+            # Group runs of the same statement so that we can use
+            # executemany on each run.
+            batch = []
+            for stmt, args in events:
+                if batch and batch[-1][0] == stmt:
+                    batch[-1][1].append(args)
+                else:
+                    batch.append((stmt, [args]))
+            self._db.executeBatch(batch)
+        finally:
+            self._lock.release()
 
     def close(self):
         """Release all resources held by this PingLog and the underlying
            database."""
+        self.flush()
         self._db.close()
 
     _STARTUP = "INSERT INTO myLifespan (startup, stillup, shutdown) VALUES (?,?, 0)"
@@ -599,8 +733,7 @@ class PingLog:
         self._lock.acquire()
         self._startTime = now = self._db.time(now)
         self._lock.release()
-        self._db.getCursor().execute(self._STARTUP, (now,now))
-        self._db.getConnection().commit()
+        self._noteEvent(self._STARTUP, (now,now))
 
     _SHUTDOWN = "UPDATE myLifespan SET stillup = ?, shutdown = ? WHERE startup = ?"
     def shutdown(self, now=None):
@@ -608,8 +741,8 @@ class PingLog:
            interval of this server's lifetime."""
         if self._startTime is None: self.startup()
         now = self._db.time(now)
-        self._db.getCursor().execute(self._SHUTDOWN, (now, now, self._startTime))
-        self._db.getConnection().commit()
+        self._noteEvent(self._SHUTDOWN, (now, now, self._startTime))
+        self.flush()
 
     _HEARTBEAT = "UPDATE myLifespan SET stillup = ? WHERE startup = ? AND stillup < ?"
     def heartbeat(self, now=None):
@@ -617,8 +750,7 @@ class PingLog:
            the time 'now'."""
         if self._startTime is None: self.startup()
         now = self._db.time(now)
-        self._db.getCursor().execute(self._HEARTBEAT, (now, self._startTime, now))
-        self._db.getConnection().commit()
+        self._noteEvent(self._HEARTBEAT, (now, self._startTime, now))
 
     _CONNECTED = ("INSERT INTO connectionAttempt (at, server, success) "
                   "VALUES (?,?,?)")
@@ -627,9 +759,8 @@ class PingLog:
            We successfully negotiated a protocol iff success is true.
         """
         serverID = self._getServerID(identity)
-        self._db.getCursor().execute(self._CONNECTED,
+        self._noteEvent(self._CONNECTED,
                         (self._db.time(now), serverID, self._db.bool(success)))
-        self._db.getConnection().commit()
 
     def connectFailed(self, identity, now=None):
         """Note that we attempted to connect to the server named 'nickname',
@@ -647,9 +778,8 @@ class PingLog:
         """
         assert len(hash) == mixminion.Crypto.DIGEST_LEN
         ids = ",".join([ str(self._getServerID(s)) for s in path ])
-        self._db.getCursor().execute(self._QUEUED_PING,
-                             (formatBase64(hash), ids, self._db.time(now), 0))
-        self._db.getConnection().commit()
+        self._noteEvent(self._QUEUED_PING,
+                        (formatBase64(hash), ids, self._db.time(now), 0))
 
     _GOT_PING = "UPDATE ping SET received = ? WHERE hash = ?"
     def gotPing(self, hash, now=None):
@@ -657,17 +787,18 @@ class PingLog:
            as its digest.
         """
         assert len(hash) == mixminion.Crypto.DIGEST_LEN
-        self._db.getCursor().execute(self._GOT_PING, (self._db.time(now), formatBase64(hash)))
-        n = self._db.getCursor().rowcount
-        if n == 0:
-            LOG.warn("Received ping with no record of its hash")
-        elif n > 1:
-            LOG.warn("Received ping with multiple hash entries!")
+        # Pending events are written in order, so if we sent this ping
+        # recently, its row is inserted before we update it.  (We no longer
+        # warn about pings with no record of their hash: executemany can't
+        # tell us which update in a batch matched no rows.)
+        self._noteEvent(self._GOT_PING,
+                        (self._db.time(now), formatBase64(hash)))
 
     def _calculateUptimes(self, serverIdentities, startTime, endTime, now=None):
         """Helper: calculate the uptime results for a set of servers, named in
            serverIdentities, for all intervals between startTime and endTime
-           inclusive.  Does not commit the current transaction.
+           inclusive, except for those whose results are already final.
+           Does not commit the current transaction.
         """
         cur = self._db.getCursor()
         serverIdentities.sort()
@@ -675,10 +806,20 @@ class PingLog:
         # First, calculate my own uptime.
         if now is None: now = time.time()
         self.heartbeat(now)
+        self.flush()
 
-        timespan = IntervalSet( [(startTime, endTime)] )
+        finished = self._getFinishedIntervals("uptime")
         calcIntervals = [ (s,e,self._getIntervalID(s,e)) for s,e in
                           self._intervals.getIntervals(startTime,endTime)]
+        calcIntervals = [ (s,e,i) for s,e,i in calcIntervals
+                          if not finished.has_key(i) ]
+        if not calcIntervals:
+            return
+        # We only need raw data for the intervals we're computing, and for
+        # one day before them, so we know how each server was doing when
+        # the first of them began.
+        startTime = max(startTime, calcIntervals[0][0]-ONE_DAY)
+        timespan = IntervalSet( [(startTime, endTime)] )
 
         cur.execute("SELECT startup, stillup, shutdown FROM myLifespan WHERE "
                     "startup <= ? AND stillup >= ?",
@@ -732,6 +873,37 @@ class PingLog:
                 fraction = float(uptime)/(uptime+downtime)
                 self._setUptime((intervalID, serverID), (fraction,))
 
+        self._markIntervalsFinished("uptime", calcIntervals, now)
+
+    # How long after an interval ends do we wait before deciding that our
+    # results for it are final?  (Pings sent in the interval may still
+    # arrive, and connection attempts after the interval affect our idea
+    # of servers' uptime near its end.)
+    _FINALIZE_DELAY = ONE_DAY
+
+    def _getFinishedIntervals(self, kind):
+        """Helper: return a map whose keys are the IDs of all intervals for
+           which our results of type 'kind' ('uptime' or 'onehop') are
+           final."""
+        cur = self._db.getCursor()
+        cur.execute("SELECT interval FROM finishedInterval WHERE kind = ?",
+                    (kind,))
+        finished = {}
+        for i, in cur:
+            finished[i] = 1
+        return finished
+
+    def _markIntervalsFinished(self, kind, intervals, now):
+        """Helper: given a list of (start, end, interval ID) tuples for
+           which we have just computed results of type 'kind', note that
+           the results are final for those intervals that ended at least
+           _FINALIZE_DELAY seconds before 'now'.  Does not commit the
+           current transaction.
+        """
+        for s, e, i in intervals:
+            if e + self._FINALIZE_DELAY <= now:
+                self._setFinished((i, kind), (self._db.time(now),))
+
     def calculateUptimes(self, startAt, endAt, now=None):
         """Calculate the uptimes for all servers for all intervals between
            startAt and endAt, inclusive."""
@@ -783,16 +955,24 @@ class PingLog:
     _WEIGHT_AGE = [ 1, 2, 2, 3, 5, 8, 9, 10, 10, 10, 10, 5 ]
     _PING_GRANULARITY = 24*60*60
     def _calculateOneHopResult(self, serverIdentity, startTime, endTime,
-                                now=None, calculateOverallResults=1):
+                                now=None, calculateOverallResults=1,
+                                finished=None):
         """Calculate the latency and reliablity for a given server on
            intervals between startTime and endTime, inclusive.  If
            calculateOverallResults is true, also compute the current overall
            results for that server.
+
+           If 'finished' is provided, it is a map whose keys are the IDs of
+           intervals whose results are final.  We don't recompute those
+           intervals; instead, we use their stored results and latency
+           distributions to compute the overall results.
         """
         # commit when done; serverName must exist.
         cur = self._db.getCursor()
         if now is None:
             now = time.time()
+        if finished is None:
+            finished = {}
         if calculateOverallResults:
             startTime = min(startTime,
                        now - (len(self._WEIGHT_AGE)*self._WEIGHT_AGE_PERIOD))
@@ -802,22 +982,69 @@ class PingLog:
         startTime = intervals[0][0]
         endTime = intervals[-1][1]
         serverID = self._getServerID(serverIdentity)
+        intervalIDs = [ self._getIntervalID(s,e) for s,e in intervals ]
+
+        # 0. Load the stored results for the finished periods at the start
+        #    of our range; we only need to look at raw pings after them.
+        nFinished = 0
+        while (nFinished < nPeriods and
+               finished.has_key(intervalIDs[nFinished])):
+            nFinished += 1
+        nSent = [0]*nPeriods
+        nReceived = [0]*nPeriods
+        perTotalWeights = [0]*nPeriods
+        perTotalWeighted = [0]*nPeriods
+        # Map from rounded latency to number of pings received in finished
+        # periods with that latency.
+        oldLatencies = {}
+        if nFinished:
+            finishedEnd = intervals[nFinished-1][1]
+            cur.execute("SELECT startAt, nSent, nReceived, wsent, wreceived "
+                        "FROM echolotOneHopResult, statsInterval "
+                        "WHERE server = ? AND interval = statsInterval.id "
+                        "AND startAt >= ? AND endAt <= ?",
+                        (serverID, startTime, finishedEnd))
+            for s, sent, rcvd, wsent, wrcvd in cur:
+                pIdx = floorDiv(s-startTime, self._PING_GRANULARITY)
+                nSent[pIdx] = sent
+                nReceived[pIdx] = rcvd
+                perTotalWeights[pIdx] = wsent
+                perTotalWeighted[pIdx] = wrcvd
+            cur.execute("SELECT latency, SUM(n) "
+                        "FROM echolotOneHopLatency, statsInterval "
+                        "WHERE server = ? AND interval = statsInterval.id "
+                        "AND startAt >= ? AND endAt <= ? GROUP BY latency",
+                        (serverID, startTime, finishedEnd))
+            for latent, n in cur:
+                oldLatencies[latent] = n
+        if nFinished == nPeriods:
+            recentStart = endTime
+        else:
+            recentStart = intervals[nFinished][0]
+        # Sorted list of the old latencies, and a list such that
+        # oldCounts[i] is the number of pings with latency below
+        # oldValues[i].
+        oldValues = oldLatencies.keys()
+        oldValues.sort()
+        oldCounts = [0]
+        for v in oldValues:
+            oldCounts.append(oldCounts[-1]+oldLatencies[v])
 
         # 1. Compute latencies and number of pings sent in each period.
         #    We need to learn these first so we can tell the percentile
         #    of each ping's latency.
         dailyLatencies = [[] for _ in xrange(nPeriods)]
-        nSent = [0]*nPeriods
-        nPings = 0
         cur.execute("SELECT sentat, received FROM ping WHERE path = ?"
                     " AND sentat >= ? AND sentat <= ?",
-                    (serverID, startTime, endTime))
+                    (serverID, recentStart, endTime))
         for sent,received in cur:
             pIdx = floorDiv(sent-startTime, self._PING_GRANULARITY)
             nSent[pIdx] += 1
-            nPings += 1
             if received:
                 dailyLatencies[pIdx].append(received-sent)
+        nPings = 0
+        for n in nSent:
+            nPings += n
 
         dailyMedianLatency = []
         allLatencies = []
@@ -829,7 +1056,6 @@ class PingLog:
                 dailyMedianLatency.append(0)
             allLatencies.extend(d)
             del d
-        del dailyLatencies
         allLatencies.sort()
         #if allLatencies:
         #    LOG.warn("%s pings in %s intervals. Median latency is %s seconds",
@@ -839,12 +1065,9 @@ class PingLog:
         # 2. Compute the number of pings actually received each day,
         #    and the number of pings received each day weighted by
         #    apparent-latency percentile.
-        nReceived = [0]*nPeriods
-        perTotalWeights = [0]*nPeriods
-        perTotalWeighted = [0]*nPeriods
         cur.execute("SELECT sentat, received FROM ping WHERE path = ?"
                     " AND sentat >= ? AND sentat <= ?",
-                    (serverID, startTime, endTime))
+                    (serverID, recentStart, endTime))
         for sent,received in cur:
             pIdx = floorDiv(sent-startTime, self._PING_GRANULARITY)
             if received:
@@ -852,17 +1075,20 @@ class PingLog:
                 w = 1.0
             else:
                 mod_age = (now-sent-15*60)*0.8
-                w = bisect.bisect_left(allLatencies, mod_age)/float(nPings)
+                nFaster = (bisect.bisect_left(allLatencies, mod_age) +
+                           oldCounts[bisect.bisect_left(oldValues, mod_age)])
+                w = nFaster/float(nPings)
                 #LOG.warn("Percentile is %s.", w)
 
             perTotalWeights[pIdx] += w
             if received:
                 perTotalWeighted[pIdx] += w
 
-        # 2b. Write per-day results into the DB.
-        for pIdx in xrange(len(intervals)):
+        # 2b. Write per-day results into the DB.  For the periods that
+        #     are about to become final, remember their latencies too.
+        for pIdx in xrange(nFinished, nPeriods):
             s,e = intervals[pIdx]
-            intervalID = self._getIntervalID(s,e)
+            intervalID = intervalIDs[pIdx]
             latent = self._roundLatency(dailyMedianLatency[pIdx])
             sent = nSent[pIdx]
             rcvd = nReceived[pIdx]
@@ -879,15 +1105,34 @@ class PingLog:
             self._setOneHop(
                 (serverID, intervalID),
                 (sent, rcvd, latent, wsent, wrcvd, rel))
+            if e + self._FINALIZE_DELAY <= now:
+                hist = {}
+                for lat in dailyLatencies[pIdx]:
+                    lat = self._roundLatency(lat)
+                    hist[lat] = hist.get(lat, 0) + 1
+                for lat, n in hist.items():
+                    self._setLatency((serverID, intervalID, lat), (n,))
+        del dailyLatencies
 
         if not calculateOverallResults:
             return None
 
-        # 3. Write current overall results into the DB.
-        if allLatencies:
-            latent = self._roundLatency(allLatencies[floorDiv(len(allLatencies),2)])
-        else:
-            latent = 0
+        # 3. Write current overall results into the DB.  Rounding doesn't
+        #    change the order of latencies, so the median of the rounded
+        #    latencies is the rounded median latency.
+        for lat in allLatencies:
+            lat = self._roundLatency(lat)
+            oldLatencies[lat] = oldLatencies.get(lat, 0) + 1
+        nLatencies = len(allLatencies) + oldCounts[-1]
+        latent = 0
+        if nLatencies:
+            values = oldLatencies.keys()
+            values.sort()
+            idx = floorDiv(nLatencies, 2)
+            for latent in values:
+                idx -= oldLatencies[latent]
+                if idx < 0:
+                    break
         wsent = wrcvd = 0.0
         nPeriods = len(self._WEIGHT_AGE)
         perTotalWeights = perTotalWeights[-nPeriods:]
@@ -913,14 +1158,23 @@ class PingLog:
 
         if now is None:
             now = time.time()
+        self.flush()
         serverIdentities.sort()
+        finished = self._getFinishedIntervals("onehop")
         reliability = {}
         for s in serverIdentities:
             if s in ('<self>','<unknown>'): continue
             # For now, always calculate overall results.
             r = self._calculateOneHopResult(s,now,now,now,
-                                             calculateOverallResults=1)
+                                             calculateOverallResults=1,
+                                             finished=finished)
             reliability[s] = r
+        startAt = now - len(self._WEIGHT_AGE)*self._WEIGHT_AGE_PERIOD
+        calcIntervals = [ (s,e,self._getIntervalID(s,e)) for s,e in
+                          self._intervals.getIntervals(startAt, now) ]
+        calcIntervals = [ (s,e,i) for s,e,i in calcIntervals
+                          if not finished.has_key(i) ]
+        self._markIntervalsFinished("onehop", calcIntervals, now)
         self._db.getConnection().commit()
         self._lock.acquire()
         try:
@@ -928,89 +1182,116 @@ class PingLog:
         finally:
             self._lock.release()
 
-    def _calculate2ChainStatus(self, since, s1, s2, now=None):
-        """Helper: Calculate the status (broken/interesting/both/neither) for
-           a chain of the servers 's1' and 's2' (given as identity digests),
-           considering pings sent since 'since'.  Return a tuple of (number of
-           pings sent, number of those pings received, is-broken,
-           is-interesting).  Does not commit the current transaction.
+    def _countChainPings(self, paths, since):
+        """Helper: Count the pings sent since 'since' along every chain in
+           'paths', a list of "ID1,ID2" strings of database server IDs.
+           Return a tuple of three maps from path: to the number of pings
+           sent, to the number of those pings received, and to the number
+           of those pings we would have expected to receive given the
+           one-hop reliability of each server on the day the ping was sent.
+           Paths with no pings are omitted.  Does not commit the current
+           transaction.
         """
-        # doesn't commit.
         cur = self._db.getCursor()
-        path = "%s,%s"%(self._getServerID(s1),self._getServerID(s2))
-        cur.execute("SELECT count() FROM ping WHERE path = ?"
-                    " AND sentat >= ?",
-                    (path,self._db.time(since)))
-        nSent, = cur.fetchone()
-        cur.execute("SELECT count() FROM ping WHERE path = ?"
-                    " AND sentat >= ? AND received > 0",
-                    (path,since))
-        nReceived, = cur.fetchone()
-        cur.execute("SELECT SUM(r1.reliability * r2.reliability) "
-                   "FROM ping, echolotOneHopResult as r1, "
-                   "   echolotOneHopResult as r2, statsInterval "
-                   "WHERE ping.path = ? AND ping.sentAt >= ? "
-                   "AND statsInterval.startAt <= ping.sentAt "
-                   "AND statsInterval.endAt >= ping.sentAt "
-                   "AND r1.server = ? "
-                   "AND r1.interval = statsInterval.id "
-                   "AND r2.server = ? "
-                   "AND r2.interval = statsInterval.id ",
-                    (path, self._db.time(since),
-                     self._getServerID(s1), self._getServerID(s2)))
-
-        nExpected, = cur.fetchone()
-
+        nSent = {}
+        nReceived = {}
+        cur.execute("SELECT path, count(), SUM(sentat >= ? AND received > 0)"
+                    " FROM ping WHERE sentat >= ? GROUP BY path",
+                    (since, self._db.time(since)))
+        for path, nS, nR in cur:
+            nSent[path] = nS
+            nReceived[path] = nR or 0
+
+        # To compute the expected number of pings, we need to join each
+        # ping against both of its servers' one-hop results, so we put the
+        # server IDs for each path into a temporary table.
+        cur.execute("CREATE TEMP TABLE IF NOT EXISTS chainPath ("
+                    "path varchar(200) primary key, "
+                    "server1 integer not null, server2 integer not null)")
+        self._db.executeBatch([
+            ("DELETE FROM chainPath", [()]),
+            ("INSERT OR REPLACE INTO chainPath (path, server1, server2) "
+             "VALUES (?,?,?)",
+             [ (p,)+tuple(map(int, p.split(","))) for p in paths ])])
+        nExpected = {}
+        cur.execute("SELECT chainPath.path, "
+                    "  SUM(r1.reliability * r2.reliability) "
+                    "FROM chainPath, ping, echolotOneHopResult as r1, "
+                    "   echolotOneHopResult as r2, statsInterval "
+                    "WHERE ping.path = chainPath.path AND ping.sentAt >= ? "
+                    "AND statsInterval.startAt <= ping.sentAt "
+                    "AND statsInterval.endAt >= ping.sentAt "
+                    "AND r1.server = chainPath.server1 "
+                    "AND r1.interval = statsInterval.id "
+                    "AND r2.server = chainPath.server2 "
+                    "AND r2.interval = statsInterval.id "
+                    "GROUP BY chainPath.path",
+                    (self._db.time(since),))
+        for path, nE in cur:
+            nExpected[path] = nE
+        return nSent, nReceived, nExpected
+
+    def _getChainStatus(self, nSent, nReceived, nExpected):
+        """Helper: Given the number of pings sent along a two-hop chain, the
+           number of those pings received, and the number we would have
+           expected to receive (or None if we have no idea), return a tuple
+           of (is-broken, is-interesting).
+        """
         isBroken = nSent >= 3 and nExpected and nReceived <= nExpected*0.3
 
         isInteresting = ((nSent < 3 and nReceived == 0) or
                          (nExpected and nReceived <= nExpected*0.3))
-        if 0:
-            if isInteresting:
-                if nSent < 3 and nReceived == 0:
-                    LOG.trace("%s,%s is interesting because %d were sent and %d were received",
-                              s1,s2, nSent, nReceived)
-                elif nExpected and nReceived <= nExpected*0.3:
-                    LOG.trace("%s,%s is interesting because we expected %s and got %s", s1, s2, nExpected, nReceived)
-                else:
-                    LOG.trace("I have no idea why %s,%s is interesting.",s1,s2)
 
-        return nSent, nReceived, isBroken, isInteresting
+        return isBroken, isInteresting
 
     _CHAIN_PING_HORIZON = 12*ONE_DAY
     def calculateChainStatus(self, now=None):
         """Calculate the status of all two-hop chains."""
         self._lock.acquire()
         try:
-            serverIdentities = self._serverIDs.keys()
+            serverIDs = self._serverIDs.copy()
         finally:
             self._lock.release()
 
         if now is None:
             now = time.time()
+        self.flush()
 
-        brokenChains = {}
-        interestingChains = {}
         since = now - self._CHAIN_PING_HORIZON
+        serverIdentities = serverIDs.keys()
         serverIdentities.sort()
 
+        # XXXX We store results for chains with '<self>' as a second hop,
+        # XXXX though we never ping along them.  (_loadServers ignores them.)
+        chains = []
         for s1 in serverIdentities:
             if s1 in ('<self>','<unknown>'): continue
             for s2 in serverIdentities:
-                if s2 == ('<self>','<unknown>'): continue
-                p = "%s,%s"%(s1,s2)
-                nS, nR, isBroken, isInteresting = \
-                    self._calculate2ChainStatus(since, s1, s2)
+                chains.append((s1, s2))
+        paths = [ "%s,%s"%(serverIDs[s1],serverIDs[s2]) for s1,s2 in chains ]
+
+        nSent, nReceived, nExpected = self._countChainPings(paths, since)
+
+        brokenChains = {}
+        interestingChains = {}
+        rows = []
+        for (s1, s2), path in zip(chains, paths):
+            nS = nSent.get(path, 0)
+            nR = nReceived.get(path, 0)
+            isBroken, isInteresting = self._getChainStatus(
+                nS, nR, nExpected.get(path))
+            if s2 not in ('<self>','<unknown>'):
+                p = "%s,%s"%(self._db.encodeIdentity(s1),
+                             self._db.encodeIdentity(s2))
                 if isBroken:
                     brokenChains[p] = 1
                 if isInteresting:
                     interestingChains[p] = 1
 
-                self._setTwoHop(
-                    (self._getServerID(s1), self._getServerID(s2)),
-                    (self._db.time(now), nS, nR, self._db.bool(isBroken),
-                     self._db.bool(isInteresting)))
-        self._db.getConnection().commit()
+            rows.append(((serverIDs[s1], serverIDs[s2]),
+                         (self._db.time(now), nS, nR, self._db.bool(isBroken),
+                          self._db.bool(isInteresting))))
+        self._setTwoHops(rows)
 
         self._lock.acquire()
         try:
@@ -1129,6 +1410,69 @@ class PingLog:
         LOG.info("Done computing ping results")
         self.lastCalculation = now
 
+    def calculateAllInBackground(self, thread, outFname=None, now=None):
+        """As calculateAll, but do the work in the ProcessingThread 'thread',
+           using a separate connection to the database, so that we can keep
+           recording events while the statistics are computed.  When the
+           computation is done, replace this PingLog's reliabilities and
+           broken/interesting chains with the new ones.  If a previous
+           computation is still running, do nothing.
+        """
+        if now is None: now = time.time()
+        self._lock.acquire()
+        try:
+            if self._calculating:
+                LOG.info("Still computing ping results; not starting again.")
+                return
+            self._calculating = 1
+        finally:
+            self._lock.release()
+        # Make sure the other connection sees everything we know.
+        self._getServerID("<self>")
+        self.heartbeat(now)
+        self.flush()
+        def calculate(self=self, outFname=outFname, now=now):
+            try:
+                try:
+                    self._calculateAllSeparately(outFname, now)
+                except:
+                    LOG.error_exc(sys.exc_info(),
+                                  "Error while computing ping results")
+            finally:
+                self._lock.acquire()
+                self._calculating = 0
+                self._lock.release()
+        thread.addJob(calculate)
+
+    def _calculateAllSeparately(self, outFname, now):
+        """Helper: run calculateAll on a new PingLog with its own connection
+           to our database, and then publish the results into this PingLog.
+
+           The calculation doesn't run in a single transaction: it writes
+           results as it goes, and a long write transaction would block
+           our own flushes.  So events we record while it runs may be seen
+           by some of its queries and not others.  That's harmless for
+           statistics this coarse: at worst, a few events recorded during
+           the calculation are counted in one result and not another, and
+           the next calculation will see them all.
+        """
+        db = self._db.reopen()
+        try:
+            log = PingLog(db)
+            log._startTime = self._startTime
+            log.calculateAll(outFname, now)
+            log.flush()
+        finally:
+            db.close()
+        self._lock.acquire()
+        try:
+            self._serverReliability.update(log._serverReliability)
+            self._brokenChains = log._brokenChains
+            self._interestingChains = log._interestingChains
+            self._lastRecalculation = now
+        finally:
+            self._lock.release()
+
 class PingGenerator:
     """Abstract class: A PingGenerator periodically sends traffic into the
        network, or adds link padding to outgoing connections.
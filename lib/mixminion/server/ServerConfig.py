@@ -11,6 +11,7 @@ import os
 
 import mixminion.Config
 import mixminion.server.Modules
+import mixminion.server.PacketHandler
 from mixminion.Config import ConfigError
 from mixminion.Common import LOG
 
@@ -83,6 +84,14 @@ class ServerConfig(mixminion.Config._ConfigFile):
             if minSize < 0:
                 raise ConfigError("MixPoolMinSize %s must be nonnegative.")
 
+        workers = server.get('ProcessingWorkers', 0)
+        if workers < 0:
+            raise ConfigError("ProcessingWorkers must be nonnegative.")
+        if workers and not \
+               mixminion.server.PacketHandler.canUseWorkerProcesses():
+            raise ConfigError("ProcessingWorkers requires Python 2.6 or later"
+                              " on a platform with fork().")
+
         if not self['Incoming/MMTP'].get('Enabled'):
             LOG.warn("Disabling incoming MMTP is not yet supported.")
         if [e for e in self._sectionEntries['Incoming/MMTP']
@@ -97,6 +106,13 @@ class ServerConfig(mixminion.Config._ConfigFile):
         mc = self['Outgoing/MMTP'].get('MaxConnections')
         if mc is not None and mc < 1:
             raise ConfigError("MaxConnections must be at least 1.")
+        idle = self['Outgoing/MMTP'].get('IdleTimeout')
+        if idle is not None and (idle.getSeconds() >=
+                                 self['Server']['Timeout'].getSeconds()):
+            raise ConfigError("IdleTimeout must be shorter than Timeout.")
+        mi = self['Outgoing/MMTP'].get('MaxIdleConnections')
+        if mi is not None and mi < 0:
+            raise ConfigError("MaxIdleConnections must not be negative.")
         bw = self['Outgoing/MMTP'].get('MaxBandwidth')
         if bw is not None and bw < 4096:
             #XXXX007 this is completely arbitrary. :P
@@ -356,6 +372,9 @@ SERVER_SYNTAX =  {
 		     'Timeout' : ('ALLOW', "interval", "5 min"),
                      'MaxBandwidth' : ('ALLOW', "size", None),
                      'MaxBandwidthSpike' : ('ALLOW', "size", None),
+                     'ProcessingWorkers' : ('ALLOW', "int", "0"),
+                     'EncryptQueues' : ('ALLOW', "boolean", "no"),
+                     'DeleteBandwidth' : ('ALLOW', "size", None),
                      },
         #DOCDOC
         'Pinging' : { 'Enabled' : ('ALLOW', 'boolean', 'yes'),
@@ -391,6 +410,8 @@ SERVER_SYNTAX =  {
                             'Retry' : ('ALLOW', "intervalList",
                               "every 1 hour for 1 day, 7 hours for 5 days"),
                            'MaxConnections' : ('ALLOW', 'int', '16'),
+                           'IdleTimeout' : ('ALLOW', 'interval', '1 minute'),
+                           'MaxIdleConnections' : ('ALLOW', 'int', '8'),
                            'Allow' : ('ALLOW*', "addressSet_allow", None),
                            'Deny' : ('ALLOW*', "addressSet_deny", None) },
         # FFFF Missing: Queue-Size / Queue config options
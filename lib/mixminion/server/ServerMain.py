@@ -78,7 +78,7 @@ from bisect import insort
 from mixminion.Common import LOG, LogStream, MixError, MixFatalError,\
      UIError, ceilDiv, createPrivateDir, disp64, formatTime, \
      installSIGCHLDHandler, Lockfile, LockfileLocked, readFile, secureDelete, \
-     succeedingMidnight, tryUnlink, waitForChildren, writeFile
+     succeedingMidnight, tryUnlink, waitForChildren, wipeFiles, writeFile
 
 # Version number for server home-directory.
 #
@@ -146,23 +146,71 @@ is too old to recognize."""
 
     return 1
 
-class IncomingQueue(mixminion.Filestore.StringStore):
+class IncomingQueue(mixminion.Filestore.SegmentedStringStore):
     """A Queue to accept packets from incoming MMTP connections,
        and hold them until they can be processed.  As packets arrive, and
        are stored to disk, we notify a MessageQueue so that another thread
-       can read them."""
+       can read them.
+
+       Since every packet is exactly PACKET_LEN bytes long, we keep them
+       in the slots of a SegmentedStringStore, rather than in a file
+       apiece."""
     ## Fields:
     # packetHandler -- an instance of PacketHandler.
     # mixPool -- an instance of MixPool
     # processingThread -- an instance of ProcessingThread
     # pingLog -- an instance of pingLog, or None
+    # pending -- a list of (handle, packet) tuples for packets that are
+    #    waiting to be processed in the processing thread.  'packet' is the
+    #    packet's contents, or None if we need to read it from disk.
+    #    Whenever this list is nonempty, there is a job in the processing
+    #    thread to drain it.
+    # nOutstanding -- the number of packets we have handed to the
+    #    packetHandler's worker processes and not yet finished.
+    # parked -- a list of handles for packets waiting for a worker process,
+    #    because nOutstanding had reached MAX_OUTSTANDING.
+    # pendingLock -- a lock to protect 'pending', 'nOutstanding', and
+    #    'parked'.
+
+    # Largest number of packets to process in a single batch.
+    MAX_BATCH = 128
+    # Largest number of pending packets whose contents we keep in memory.
+    # Past this point, we read packets back from disk when we process them.
+    MAX_PENDING_IN_MEMORY = 1024
+    # Largest number of packets we hand to worker processes at once.  Past
+    # this point, we remember only their handles, and read them back from
+    # disk as the workers finish.
+    MAX_OUTSTANDING = 256
+
     def __init__(self, location, packetHandler):
         """Create an IncomingQueue that stores its packets in <location>
            and processes them through <packetHandler>."""
-        mixminion.Filestore.StringStore.__init__(self, location, create=1)
+        mixminion.Filestore.SegmentedStringStore.__init__(self, location,
+                                 mixminion.Packet.PACKET_LEN, create=1)
+        self.__importOldPackets()
         self.packetHandler = packetHandler
         self.mixPool = None
         self.pingLog = None
+        self.pending = []
+        self.nOutstanding = 0
+        self.parked = []
+        self.pendingLock = threading.Lock()
+
+    def __importOldPackets(self):
+        """Helper: move any packets left in our directory by an older
+           version, which stored each packet in a file of its own, into
+           our segments."""
+        old = [ fn for fn in os.listdir(self.dir)
+                if fn[:4] in ("msg_", "inp_", "rmv_") ]
+        if not old:
+            return
+        LOG.info("Converting old-style incoming queue in %s", self.dir)
+        for fn in old:
+            if fn.startswith("msg_"):
+                mixminion.Filestore.SegmentedStringStore.queueMessage(
+                    self, readFile(os.path.join(self.dir, fn), 1))
+        secureDelete([ os.path.join(self.dir, fn) for fn in old ],
+                     blocking=1)
 
     def connectQueues(self, mixPool, processingThread):
         """Sets the target mix queue"""
@@ -170,8 +218,7 @@ class IncomingQueue(mixminion.Filestore.StringStore):
         self.processingThread = processingThread
         for h in self.getAllMessages():
             assert h is not None
-            self.processingThread.addJob(
-                lambda self=self, h=h: self.__deliverPacket(h))
+            self.__schedulePacket(h)
 
     def setPingLog(self, pingLog):
         """Configure this queue to inform 'pingLog' about received
@@ -181,24 +228,128 @@ class IncomingQueue(mixminion.Filestore.StringStore):
 
     def queuePacket(self, pkt):
         """Add a packet for delivery"""
-        h = mixminion.Filestore.StringStore.queueMessage(self, pkt)
+        h = mixminion.Filestore.SegmentedStringStore.queueMessage(self, pkt)
         LOG.trace("Inserting packet IN:%s into incoming queue", h)
         assert h is not None
-        self.processingThread.addJob(
-            lambda self=self, h=h: self.__deliverPacket(h))
+        self.__schedulePacket(h, pkt)
 
     def queueMessage(self, m):
         # Never call this directly.
         assert 0
 
-    def __deliverPacket(self, handle):
-        """Process a single packet with a given handle, and insert it into
-           the Mix pool.  This function is called from within the processing
+    def __schedulePacket(self, handle, packet=None):
+        """Arrange for the packet with a given handle to be processed and
+           inserted into the Mix pool.  If the packet's contents are
+           already in memory, they may be passed as 'packet'."""
+        if not self.packetHandler.hasWorkers():
+            self.pendingLock.acquire()
+            try:
+                if len(self.pending) >= self.MAX_PENDING_IN_MEMORY:
+                    packet = None
+                self.pending.append((handle, packet))
+                if len(self.pending) > 1:
+                    # There's already a job to drain the list.
+                    return
+            finally:
+                self.pendingLock.release()
+            self.processingThread.addJob(self.__deliverPending)
+            return
+
+        # We have worker processes: send the packet to one of them for
+        # decryption, unless they already have as much as we want to hold
+        # in memory.
+        self.pendingLock.acquire()
+        try:
+            if self.nOutstanding >= self.MAX_OUTSTANDING:
+                self.parked.append(handle)
+                return
+            self.nOutstanding += 1
+        finally:
+            self.pendingLock.release()
+        if not self.__submitPacket(handle, packet):
+            self.__workerDone()
+
+    def __submitPacket(self, handle, packet=None):
+        """Helper: hand the packet with a given handle to a worker process.
+           When the worker is done, we still check for replays and insert
+           the result into the mix pool from the processing thread, so that
+           HashLog access stays serialized.  The caller must already have
+           counted this packet in self.nOutstanding.  Return true on
+           success, or false if we couldn't read the packet."""
+        if packet is None:
+            try:
+                packet = self.messageContents(handle)
+            except (IOError, OSError), e:
+                LOG.error("Couldn't read packet IN:%s: %s", handle, e)
+                return 0
+        def callback(result, self=self, h=handle):
+            self.processingThread.addJob(
+                lambda self=self, h=h, r=result: self.__finishPacket(h, r))
+        self.packetHandler.processPacketAsync(packet, callback)
+        return 1
+
+    def __workerDone(self):
+        """Helper: note that a worker process has finished with a packet,
+           and hand the workers the oldest parked packet, if any."""
+        while 1:
+            self.pendingLock.acquire()
+            try:
+                if not self.parked:
+                    self.nOutstanding -= 1
+                    return
+                handle = self.parked.pop(0)
+            finally:
+                self.pendingLock.release()
+            if self.__submitPacket(handle):
+                return
+
+    def __deliverPending(self):
+        """Process up to MAX_BATCH packets waiting in self.pending as a
+           single batch, and insert them into the Mix pool.  This function is
+           called from within the processing thread."""
+        self.pendingLock.acquire()
+        try:
+            batch = self.pending[:self.MAX_BATCH]
+            del self.pending[:self.MAX_BATCH]
+            if self.pending:
+                self.processingThread.addJob(self.__deliverPending)
+        finally:
+            self.pendingLock.release()
+
+        handles = []
+        packets = []
+        for h, pkt in batch:
+            handles.append(h)
+            if pkt is None:
+                try:
+                    pkt = self.messageContents(h)
+                except (IOError, OSError), e:
+                    LOG.error("Couldn't read packet IN:%s: %s", h, e)
+            packets.append(pkt)
+        readable = [ i for i in xrange(len(handles))
+                     if packets[i] is not None ]
+        results = self.packetHandler.processPackets(
+            [ packets[i] for i in readable ])
+        for i, result in zip(readable, results):
+            self.__handlePacket(handles[i], _getBatchResult, result)
+
+    def __finishPacket(self, handle, result):
+        """Given the result of decrypting the packet with a given handle in
+           a worker process, check it for replays and insert it into the Mix
+           pool.  This function is called from within the processing
            thread."""
-        ph = self.packetHandler
-        packet = self.messageContents(handle)
         try:
-            res = ph.processPacket(packet)
+            self.__handlePacket(handle, self.packetHandler.finishPacket,
+                                result)
+        finally:
+            self.__workerDone()
+
+    def __handlePacket(self, handle, processFn, arg):
+        """Helper: call processFn(arg) to get the processed form of the
+           packet with a given handle, and insert the result into the Mix
+           pool."""
+        try:
+            res = processFn(arg)
             if res is None:
                 # Drop padding before it gets to the mix.
                 LOG.debug("Padding packet IN:%s dropped", handle)
@@ -237,6 +388,14 @@ class IncomingQueue(mixminion.Filestore.StringStore):
                     "Unexpected error when processing IN:%s", handle)
             self.removeMessage(handle)
 
+def _getBatchResult((result, error)):
+    """Helper: given a (result, error) tuple as returned by
+       PacketHandler.processPackets, raise the error or return the
+       result."""
+    if error is not None:
+        raise error
+    return result
+
 class MixPool:
     """Wraps a mixminion.server.ServerQueue.*MixPool to send packets
        to an exit queue and a delivery queue.  The files in the
@@ -270,6 +429,7 @@ class MixPool:
                 sendRate=server.get("MixPoolRate", 0.6))
         else:
             raise MixFatalError("Got impossible mix pool type from config")
+        self.queue.setErasureMode(server['EncryptQueues'])
 
         self.outgoingPool = None
         self.moduleManager = None
@@ -358,6 +518,7 @@ class OutgoingQueue(mixminion.server.ServerQueue.PerAddressDeliveryQueue):
         """Set up this queue according to a ServerConfig object."""
         retry = config['Outgoing/MMTP']['Retry']
         self.setRetrySchedule(retry)
+        self.store.setErasureMode(config['Server']['EncryptQueues'])
 
     def connectQueues(self, server, incoming, pingGenerator):
         """Set the MMTPServer and IncomingQueue that this
@@ -431,24 +592,81 @@ class CleaningThread(threading.Thread):
     """Thread that handles file deletion.  Some methods of secure deletion
        are slow enough that they'd block the server if we did them in the
        main thread.
+
+       Unless the configuration names a ShredCommand, we overwrite and
+       unlink files ourself with wipeFiles, in batches of up to BATCH_SIZE
+       files, so that we need only one round of disk syncs per batch
+       instead of a separate shred process per queue.  If DeleteBandwidth
+       is set, we never overwrite more than that many bytes per second, so
+       that a burst of deletions after a mix doesn't compete with packet
+       I/O.
     """
     # Fields:
     #   mqueue: A ClearableQueue holding lists of filenames to delete,
     #     or None to indicate a shutdown.
-    def __init__(self):
+    #   useShred: true iff we should delete files with secureDelete (and so
+    #     with an external shred command) rather than with wipeFiles.
+    #   bucket: A TokenBucket limiting how many bytes per second we
+    #     overwrite, or None if we have no limit.
+    #   _statsLock: A lock to protect 'pending', 'bytesWiped', and
+    #     'statsSince'.
+    #   pending: The number of files scheduled for deletion but not yet
+    #     deleted.
+    #   bytesWiped: The number of bytes overwritten since 'statsSince'.
+    #   statsSince: When did we last reset 'bytesWiped'?
+    ## Constants:
+    # BATCH_SIZE: The largest number of files we overwrite before syncing
+    #   them all to disk and unlinking them.
+    BATCH_SIZE = 64
+    def __init__(self, config=None):
         threading.Thread.__init__(self)
         self.mqueue = ClearableQueue()
+        self.useShred = 0
+        self.bucket = None
+        if config is not None:
+            self.useShred = config['Host'].get('ShredCommand') is not None
+            bw = config['Server'].get('DeleteBandwidth')
+            if bw:
+                self.bucket = mixminion.server.MMTPServer.TokenBucket(
+                    bw, bw)
+        self._statsLock = threading.Lock()
+        self.pending = 0
+        self.bytesWiped = 0
+        self.statsSince = time.time()
 
     def deleteFile(self, fname):
         """Schedule the file named 'fname' for deletion"""
         #LOG.trace("Scheduling %s for deletion", fname)
         assert fname is not None
-        self.mqueue.put([fname])
+        self.deleteFiles([fname])
 
     def deleteFiles(self, fnames):
         """Schedule all the files in the list 'fnames' for deletion"""
+        if not fnames:
+            return
+        self._statsLock.acquire()
+        try:
+            self.pending += len(fnames)
+        finally:
+            self._statsLock.release()
         self.mqueue.put(fnames)
 
+    def getStats(self, now=None):
+        """Return a tuple of the number of files waiting to be deleted, and
+           the average number of bytes per second we have overwritten since
+           the last call to getStats."""
+        if now is None:
+            now = time.time()
+        self._statsLock.acquire()
+        try:
+            elapsed = max(now - self.statsSince, 1)
+            rate = self.bytesWiped / float(elapsed)
+            self.bytesWiped = 0
+            self.statsSince = now
+            return self.pending, rate
+        finally:
+            self._statsLock.release()
+
     def shutdown(self):
         """Tell this thread to shut down once it has deleted all pending
            files."""
@@ -456,6 +674,31 @@ class CleaningThread(threading.Thread):
         self.mqueue.clear()
         self.mqueue.put(None)
 
+    def _throttle(self, n):
+        """Callback for wipeFiles: wait until our bandwidth budget lets us
+           overwrite 'n' more bytes, and account for them."""
+        self._statsLock.acquire()
+        try:
+            self.bytesWiped += n
+        finally:
+            self._statsLock.release()
+        if self.bucket is None:
+            return
+        self.bucket.refill()
+        delay = self.bucket.getDelay(min(n, self.bucket.burst))
+        if delay:
+            time.sleep(delay)
+            self.bucket.refill()
+        self.bucket.spend(n)
+
+    def _delete(self, fnames):
+        """Securely delete all the files in 'fnames'."""
+        if self.useShred:
+            secureDelete(fnames, blocking=1)
+        else:
+            for i in xrange(0, len(fnames), self.BATCH_SIZE):
+                wipeFiles(fnames[i:i+self.BATCH_SIZE], self._throttle)
+
     def run(self):
         """implementation of the cleaning thread's main loop: waits for
            a filename to delete or an indication to shutdown, then
@@ -473,7 +716,8 @@ class CleaningThread(threading.Thread):
                         more = self.mqueue.get(0)
                         if more is None:
                             running=0
-                        fnames.extend(more)
+                        else:
+                            fnames.extend(more)
                 except QueueEmpty:
                     pass
 
@@ -484,7 +728,13 @@ class CleaningThread(threading.Thread):
                     else:
                         LOG.warn("Delete thread didn't find file %s",fn)
 
-                secureDelete(delNames, blocking=1)
+                self._delete(delNames)
+                # Files that had already vanished were pending too.
+                self._statsLock.acquire()
+                try:
+                    self.pending = max(0, self.pending - len(fnames))
+                finally:
+                    self._statsLock.release()
 
             LOG.info("Cleanup thread shutting down.")
         except:
@@ -529,7 +779,8 @@ class MixminionServer(Scheduler):
     #    before they are decoded.  Decodes packets with PacketHandler,
     #    and places them in mixPool.
     # packetHandler: Instance of PacketHandler.  Used by incomingQueue to
-    #    decrypt, check, and re-pad received packets.
+    #    decrypt, check, and re-pad received packets, either in the
+    #    processing thread or in a pool of worker processes.
     # mixPool: Instance of MixPool.  Holds processed packets, and
     #    periodically decides which ones to deliver, according to some
     #    batching algorithm.
@@ -543,6 +794,9 @@ class MixminionServer(Scheduler):
     #    be slow.  (If the database has good locking, this is only statistics
     #    recomputation.  If the database has dumb locking, this is all
     #    database activity.)
+    # pingStatsThread: Thread used to recompute pinger statistics on a
+    #    separate database connection, so that recording ping events doesn't
+    #    wait for it.
     # lockFile: An instance of Lockfile to prevent multiple servers from
     #    running in the same directory.  The filename for this lock is
     #    stored in self.pidFile.
@@ -620,6 +874,10 @@ class MixminionServer(Scheduler):
         self.keyring.updateKeys(self.packetHandler,
                                 self.descriptorFile)
         self.keyring.updateMMTPServerTLSContext(self.mmtpServer)
+        nWorkers = config['Server'].get('ProcessingWorkers', 0)
+        if nWorkers:
+            LOG.debug("Initializing packet processing workers")
+            self.packetHandler.startWorkers(nWorkers)
         LOG.debug("Initializing directory client")
         self.dirClient = mixminion.ClientDirectory.ClientDirectory(config)
         try:
@@ -667,6 +925,7 @@ class MixminionServer(Scheduler):
             #FFFF Later, enable this stuff anyway, to make R-G-B mixing work.
             LOG.debug("Initializing database thread for pinger")
             self.databaseThread = ProcessingThread("database thread")
+            self.pingStatsThread = ProcessingThread("ping statistics thread")
 
             LOG.debug("Initializing ping log")
             self.pingLog = mixminion.server.Pinger.openPingLog(
@@ -680,8 +939,9 @@ class MixminionServer(Scheduler):
             self.pingLog = None
             self.pingGenerator = None
             self.databaseThread = None
+            self.pingStatsThread = None
 
-        self.cleaningThread = CleaningThread()
+        self.cleaningThread = CleaningThread(config)
         self.processingThread = ProcessingThread()
 
         self.dnsCache = mixminion.server.DNSFarm.DNSCache()
@@ -707,6 +967,7 @@ class MixminionServer(Scheduler):
 
         if self.databaseThread is not None:
             self.databaseThread.start()
+            self.pingStatsThread.start()
         if self.pingLog is not None:
             self.incomingQueue.setPingLog(self.pingLog)
             self.mmtpServer.connectPingLog(self.pingLog)
@@ -794,6 +1055,9 @@ class MixminionServer(Scheduler):
         self.scheduleEvent(RecurringEvent(now+180,
                                      lambda: waitForChildren(blocking=0),
                                      180))
+        self.scheduleEvent(RecurringEvent(now+30,
+                                     self.moduleManager.closeIdleConnections,
+                                     30))
         if EventStats.log.getNextRotation():
             def _rotateStats():
                 EventStats.log.rotate()
@@ -840,11 +1104,16 @@ class MixminionServer(Scheduler):
                 now+mixminion.server.Pinger.HEARTBEAT_INTERVAL,
                 self.pingLog.heartbeat,
                 mixminion.server.Pinger.HEARTBEAT_INTERVAL))
-            # FFFF if we aren't using a LOCKING_IS_COURSE database, we will
-            # FFFF still want this to happen in another thread.
+            self.scheduleEvent(RecurringEvent(
+                now+mixminion.server.Pinger.FLUSH_INTERVAL,
+                self.pingLog.flush,
+                mixminion.server.Pinger.FLUSH_INTERVAL))
+            # The database thread flushes the ping log, and then the
+            # statistics thread does the actual work on its own connection.
             self.scheduleEvent(RecurringEvent(
                 now+60,
-                lambda self=self: self.pingLog.calculateAll(
+                lambda self=self: self.pingLog.calculateAllInBackground(
+                  self.pingStatsThread,
                   os.path.join(self.config.getWorkDir(), "pinger", "status")),
                 self.config['Pinging']['RecomputeInterval'].getSeconds()))
 
@@ -868,40 +1137,41 @@ class MixminionServer(Scheduler):
         if self.config['Server'].get("Daemon",1):
             closeUnusedFDs()
 
-        SCHEDULE_INTERVAL = 60
         TICK_INTERVAL = self.mmtpServer.TICK_INTERVAL
+        nextTick = time.time()+TICK_INTERVAL
         while 1:
+            # Handle pending network events, waiting no longer than until
+            # the next scheduled event.  (We wake up at least once per
+            # TICK_INTERVAL anyway, to check for signals.)
             now = time.time()
-            nextEvent = now + SCHEDULE_INTERVAL
-            timeLeft = SCHEDULE_INTERVAL
-            nextTick = now+TICK_INTERVAL
-            while timeLeft > 0:
-                # Handle pending network events
-                self.mmtpServer.process(TICK_INTERVAL)
-                # Check for signals
-                if STOPPING:
-                    LOG.info("Caught SIGTERM; shutting down.")
-                    return
-                elif GOT_HUP:
-                    LOG.info("Caught SIGHUP")
-                    self.doReset()
-                    GOT_HUP = 0
-                # Make sure that our worker threads are still running.
-                if not (self.cleaningThread.isAlive() and
-                        self.processingThread.isAlive() and
-                        self.moduleManager.thread.isAlive()):
-                    LOG.fatal("One of our threads has halted; shutting down.")
-                    return
-
-                # Calculate remaining time until the next event.
-                now = time.time()
-                if now > nextTick:
-                    self.mmtpServer.tick()
-                    nextTick = now+TICK_INTERVAL
-                timeLeft = nextEvent - now
+            nextEvent = self.firstEventTime()
+            if nextEvent == -1:
+                timeout = TICK_INTERVAL
+            else:
+                timeout = max(0, min(nextEvent-now, TICK_INTERVAL))
+            self.mmtpServer.process(timeout)
+            # Check for signals
+            if STOPPING:
+                LOG.info("Caught SIGTERM; shutting down.")
+                return
+            elif GOT_HUP:
+                LOG.info("Caught SIGHUP")
+                self.doReset()
+                GOT_HUP = 0
+            # Make sure that our worker threads are still running.
+            if not (self.cleaningThread.isAlive() and
+                    self.processingThread.isAlive() and
+                    self.moduleManager.thread.isAlive()):
+                LOG.fatal("One of our threads has halted; shutting down.")
+                return
 
-            # An event has fired.
-            self.processEvents()
+            now = time.time()
+            if now > nextTick:
+                self.mmtpServer.tick()
+                nextTick = now+TICK_INTERVAL
+            if nextEvent != -1 and now >= nextEvent:
+                # An event has fired.
+                self.processEvents(now)
 
     def doReset(self):
         """Called when server receives SIGHUP.  Flushes logs to disk,
@@ -958,6 +1228,9 @@ class MixminionServer(Scheduler):
         self.mixPool.queue.cleanQueue(df)
         self.outgoingQueue.cleanQueue(df)
         self.moduleManager.cleanQueues(df)
+        pending, rate = self.cleaningThread.getStats()
+        LOG.debug("%s files waiting to be deleted; deleting %d bytes/sec",
+                  pending, rate)
         if self.pingLog:
             now = time.time()
             self.pingLog.rotate(now-self.config['Pinging']['RetainData'].getSeconds(),
@@ -971,11 +1244,13 @@ class MixminionServer(Scheduler):
         self.processingThread.shutdown()
         self.moduleManager.shutdown()
         if self.databaseThread: self.databaseThread.shutdown(flush=0)
+        if self.pingStatsThread: self.pingStatsThread.shutdown()
 
         self.cleaningThread.join()
         self.processingThread.join()
         self.moduleManager.join()
         if self.databaseThread: self.databaseThread.join()
+        if self.pingStatsThread: self.pingStatsThread.join()
 
         self.packetHandler.close()
         self.moduleManager.close()
@@ -6,6 +6,7 @@
    """
 
 import cPickle
+import heapq
 import math
 import os
 import operator
@@ -218,6 +219,11 @@ class DeliveryQueue:
     #      should be reattempted, as described in "setRetrySchedule".
     #   _lock -- a reference to the RLock used to control access to the
     #      store.
+    #   _nextAttemptHeap -- a heap of (time, handle) tuples for the
+    #      non-pending messages in the store, ordered by the time at which
+    #      sendReadyMessages should next look at each message.  Entries can
+    #      go stale when a message is removed or rescheduled; they are
+    #      checked against the message's _DeliveryState when they are popped.
     def __init__(self, location, retrySchedule=None, now=None, name=None):
         """Create a new DeliveryQueue object that stores its files in
            <location>.  If retrySchedule is provided, it is interpreted as
@@ -226,6 +232,7 @@ class DeliveryQueue:
         self.store = mixminion.Filestore.ObjectMetadataStore(
             location,create=1,scrub=1)
         self._lock = self.store._lock
+        self._nextAttemptHeap = []
         if name is None:
             self.qname = os.path.split(location)[1]
         else:
@@ -294,10 +301,26 @@ class DeliveryQueue:
         else:
             rs = self.retrySchedule
 
-        for ds in self.store._metadata_cache.values():
+        self._nextAttemptHeap = []
+        for h, ds in self.store._metadata_cache.items():
             ds.setNextAttempt(rs, now)
+            if not ds.isPending():
+                self._scheduleMessage(h, ds, now)
         self._repOK()
 
+    def _scheduleMessage(self, handle, ds, now):
+        """Helper: remember that the non-pending message 'handle', whose
+           _DeliveryState is 'ds', should be considered by sendReadyMessages
+           once ds.nextAttempt has arrived.  Expired messages are considered
+           on the next call.
+
+           Callers must hold self._lock."""
+        if ds.isRemovable():
+            when = 0
+        else:
+            when = ds.nextAttempt
+        heapq.heappush(self._nextAttemptHeap, (when, handle))
+
     def _repOK(self):
         """Raise an assertion error if the internal state of this object is
            nonsensical."""
@@ -319,11 +342,14 @@ class DeliveryQueue:
              msg -- the message.  This can be any pickleable object.
         """
         assert self.retrySchedule is not None
+        if now is None:
+            now = time.time()
         try:
             self._lock.acquire()
             ds = _DeliveryState(now,None,address)
             ds.setNextAttempt(self.retrySchedule, now)
             handle = self.store.queueObjectAndMetadata(msg, ds)
+            self._scheduleMessage(handle, ds, now)
             LOG.trace("DeliveryQueue got message %s for %s",
                       handle, self.qname)
         finally:
@@ -358,7 +384,6 @@ class DeliveryQueue:
         """Sends all messages which are not already being sent, and which
            are scheduled to be sent."""
         assert self.retrySchedule is not None
-        self._repOK()
         if now is None:
             now = time.time()
         LOG.trace("DeliveryQueue checking for deliverable messages in %s",
@@ -366,33 +391,30 @@ class DeliveryQueue:
         try:
             self._lock.acquire()
             messages = []
-            for h in self.store._metadata_cache.keys():
-                try:
-                    state = self.store.getMetadata(h)
-                except CorruptedFile:
-                    continue
-                if state.isPending():
-                    #LOG.trace("     [%s] is pending delivery", h)
+            heap = self._nextAttemptHeap
+            cache = self.store._metadata_cache
+            # Only look at the messages whose time has come; everything
+            # else stays in the heap untouched.
+            while heap and heap[0][0] <= now:
+                when, h = heapq.heappop(heap)
+                state = cache.get(h)
+                if state is None or state.isPending():
+                    # Stale entry: the message is gone, or we're already
+                    # trying to deliver it.
                     continue
                 elif state.isRemovable():
                     #LOG.trace("     [%s] is expired", h)
                     self.removeMessage(h)
-                elif state.nextAttempt <= now:
+                elif state.nextAttempt == when:
                     #LOG.trace("     [%s] is ready for delivery", h)
-                    if state is None:
-                        addr = None
-                    else:
-                        addr = state.address
-                    messages.append(PendingMessage(h,self,addr))
+                    messages.append(PendingMessage(h,self,state.address))
                     state.setPending(now)
-                else:
-                    #LOG.trace("     [%s] is not yet ready for redelivery", h)
-                    continue
+                # Otherwise, the message was rescheduled, and a later entry
+                # in the heap will cover it.
         finally:
             self._lock.release()
 
         self._deliverMessages(messages)
-        self._repOK()
 
     def _deliverMessages(self, msgList):
         """Abstract method; Invoked with a list of PendingMessage objects
@@ -458,6 +480,7 @@ class DeliveryQueue:
                 ds = _DeliveryState(now)
                 ds.setNextAttempt(self.retrySchedule, now)
                 self.store.setMetadata(handle, ds)
+                self._scheduleMessage(handle, ds, now)
                 return
 
             if not ds.isPending():
@@ -480,6 +503,7 @@ class DeliveryQueue:
                               formatTime(ds.nextAttempt, 1))
 
                     self.store.setMetadata(handle, ds)
+                    self._scheduleMessage(handle, ds, now)
                     return
                 else:
                     assert ds.isRemovable()
@@ -587,11 +611,31 @@ class PerAddressDeliveryQueue(DeliveryQueue):
     # correctly: most (all?) MTAs use a retry algorithm equivalent to
     # this one.
 
-    # DOCDOC 
+    ## Fields:
+    # addressStateDB: a WritethroughDict mapping str(address) to the
+    #    _AddressState for that address.
+    # totalLifetime: the number of seconds a message may stay in the queue
+    #    before we give up on it.
+    # _waiting: a map from str(address) to a dict whose keys are the
+    #    handles of all the non-pending messages queued for that address.
+    # _readyAddresses: a dict whose keys are the str(address) values for
+    #    addresses that have waiting messages and whose nextAttempt has
+    #    arrived.
+    # _addressHeap: a heap of (nextAttempt, str(address)) for addresses
+    #    that are waiting to be retried.  Entries may be stale.
+    # _expiryHeap: a heap of (queuedTime, handle) for non-pending messages,
+    #    so that we can find expired messages without scanning the queue.
+    #    Entries may be stale.
+    #
+    # (The per-message _nextAttemptHeap from DeliveryQueue is unused here.)
     def __init__(self, location, retrySchedule=None, now=None, name=None):
         self.addressStateDB = mixminion.Filestore.WritethroughDict(
             filename=os.path.join(location,"addressStatus.db"),
             purpose="address state")
+        self._waiting = {}
+        self._readyAddresses = {}
+        self._addressHeap = []
+        self._expiryHeap = []
         if retrySchedule is None:
             retrySchedule = [3600]
         DeliveryQueue.__init__(self, location=location,
@@ -612,6 +656,8 @@ class PerAddressDeliveryQueue(DeliveryQueue):
             self._lock.release()
 
     def _rebuildNextAttempt(self, now=None):
+        if now is None:
+            now = time.time()
         self._lock.acquire()
         try:
             for ds in self.store._metadata_cache.values():
@@ -624,8 +670,16 @@ class PerAddressDeliveryQueue(DeliveryQueue):
             else:
                 rs = self.retrySchedule
                 self.totalLifetime = reduce(operator.add,self.retrySchedule,0)
+            self._waiting = {}
+            self._readyAddresses = {}
+            self._addressHeap = []
+            self._expiryHeap = []
             for addr_state in self.addressStateDB.values():
                 addr_state.setNextAttempt(rs, now)
+                self._scheduleAddress(addr_state, now)
+            for h, ds in self.store._metadata_cache.items():
+                if not ds.isPending():
+                    self._scheduleMessage(h, ds, now)
             self._repOK()
         finally:
             self._lock.release()
@@ -660,9 +714,40 @@ class PerAddressDeliveryQueue(DeliveryQueue):
             addr_state.setNextAttempt(self.retrySchedule, now)
         return addr_state
 
+    def _scheduleAddress(self, addr_state, now):
+        """Helper: note that addr_state.nextAttempt has changed, and
+           either mark the address as ready, or remember when to retry it.
+
+           Callers must hold self._lock."""
+        key = str(addr_state.address)
+        if addr_state.nextAttempt <= now:
+            if self._waiting.has_key(key):
+                self._readyAddresses[key] = 1
+        else:
+            self._readyAddresses.pop(key, None)
+            heapq.heappush(self._addressHeap, (addr_state.nextAttempt, key))
+
+    def _scheduleMessage(self, handle, ds, now):
+        """Helper: add the non-pending message 'handle', whose
+           _DeliveryState is 'ds', to the set of messages waiting for its
+           address.
+
+           Callers must hold self._lock."""
+        key = str(ds.address)
+        self._waiting.setdefault(key, {})[handle] = 1
+        heapq.heappush(self._expiryHeap, (ds.queuedTime, handle))
+        if self._getAddressState(ds.address, now).nextAttempt <= now:
+            self._readyAddresses[key] = 1
+
     def queueDeliveryMessage(self, msg, address, now=None):
-        self._getAddressState(address, now=now)
-        return DeliveryQueue.queueDeliveryMessage(self,msg,address,now)
+        if now is None:
+            now = time.time()
+        self._lock.acquire()
+        try:
+            self._getAddressState(address, now=now)
+            return DeliveryQueue.queueDeliveryMessage(self,msg,address,now)
+        finally:
+            self._lock.release()
 
     def sendReadyMessages(self, now=None):
         if now is None:
@@ -670,32 +755,59 @@ class PerAddressDeliveryQueue(DeliveryQueue):
         self._lock.acquire()
         try:
             messages = []
-            for h in self.store._metadata_cache.keys():
-                try:
-                    state = self.store.getMetadata(h)
-                except CorruptedFile:
+            cache = self.store._metadata_cache
+            # First, drop any expired messages.
+            heap = self._expiryHeap
+            while heap and heap[0][0] + self.totalLifetime < now:
+                queuedTime, h = heapq.heappop(heap)
+                state = cache.get(h)
+                if state is None or state.isPending():
+                    # Stale entry: the message is gone, or it is being
+                    # delivered and deliveryFailed will requeue it.
                     continue
-                if state.isPending():
-                    #LOG.trace("     [%s] is pending delivery", h)
-                    continue
-                elif state.queuedTime + self.totalLifetime < now:
-                    #LOG.trace("     [%s] is expired", h)
-                    self.removeMessage(h)
-                    continue
-                addressState = self._getAddressState(state.address, now)
-                if addressState.nextAttempt <= now:
+                #LOG.trace("     [%s] is expired", h)
+                self.removeMessage(h)
+
+            # Next, note any addresses whose retry time has come.
+            heap = self._addressHeap
+            while heap and heap[0][0] <= now:
+                when, key = heapq.heappop(heap)
+                addressState = self.addressStateDB.get(key)
+                if (addressState is not None and
+                    addressState.nextAttempt == when and
+                    self._waiting.has_key(key)):
+                    self._readyAddresses[key] = 1
+
+            # Finally, send every waiting message for every ready address.
+            for key in self._readyAddresses.keys():
+                for h in self._waiting[key].keys():
+                    state = cache[h]
                     #LOG.trace("     [%s] is ready for next attempt on %s", h,
                     #          state.address)
                     messages.append(PendingMessage(h,self,state.address))
                     state.setPending(now)
-                else:
-                    #LOG.trace("     [%s] will wait for next attempt on %s",h,
-                    #          state.address)
-                    continue
+                del self._waiting[key]
+            self._readyAddresses = {}
         finally:
             self._lock.release()
 
-            self._deliverMessages(messages)
+        self._deliverMessages(messages)
+
+    def removeMessage(self, handle):
+        self._lock.acquire()
+        try:
+            ds = self.store._metadata_cache.get(handle)
+            if ds is not None:
+                key = str(ds.address)
+                handles = self._waiting.get(key)
+                if handles and handles.has_key(handle):
+                    del handles[handle]
+                    if not handles:
+                        del self._waiting[key]
+                        self._readyAddresses.pop(key, None)
+            DeliveryQueue.removeMessage(self, handle)
+        finally:
+            self._lock.release()
 
     def cleanQueue(self, secureDeleteFn=None):
         self.sync()
@@ -706,6 +818,8 @@ class PerAddressDeliveryQueue(DeliveryQueue):
 
     def deliverySucceeded(self, handle, now=None):
         assert self.retrySchedule is not None
+        if now is None:
+            now = time.time()
         self._lock.acquire()
         try:
             LOG.trace("PerAddressDeliveryQueue got successful delivery for %s from %s",
@@ -719,6 +833,7 @@ class PerAddressDeliveryQueue(DeliveryQueue):
                 aState.succeeded(now=now)
                 aState.setNextAttempt(self.retrySchedule, now)
                 self.addressStateDB[str(mState.address)] = aState
+                self._scheduleAddress(aState, now)
 
             self.removeMessage(handle)
         finally:
@@ -757,6 +872,9 @@ class PerAddressDeliveryQueue(DeliveryQueue):
             aState.failed(attempt=last,now=now)
             aState.setNextAttempt(self.retrySchedule,now=now)
             self.addressStateDB[str(aState.address)] = aState # flush to db.
+            if retriable:
+                self._scheduleMessage(handle, mState, now)
+            self._scheduleAddress(aState, now)
         finally:
             self._lock.release()
 
@@ -781,6 +899,11 @@ class PerAddressDeliveryQueue(DeliveryQueue):
                 ds = self.store._metadata_cache[h]
                 addr_state = self._getAddressState(ds.address)
                 assert addr_state.address == ds.address
+            for key, handles in self._waiting.items():
+                assert handles
+                for h in handles.keys():
+                    ds = self.store._metadata_cache[h]
+                    assert str(ds.address) == key and not ds.isPending()
         finally:
             self._lock.release()
 
@@ -18,6 +18,8 @@ import gzip
 import operator
 import os
 import re
+import select
+import smtplib
 import socket
 import stat
 import struct
@@ -77,7 +79,7 @@ from mixminion.Common import Log, _FileLogHandler, _ConsoleLogHandler
 from mixminion.Config import _ConfigFile, ConfigError, _parseInt
 from mixminion.Crypto import *
 from mixminion.Packet import *
-from mixminion.server.HashLog import HashLog
+from mixminion.server.HashLog import HashLog, SegmentHashLog
 from mixminion.server.Modules import *
 from mixminion.server.PacketHandler import *
 from mixminion.server.ServerQueue import *
@@ -391,6 +393,11 @@ class MiscTests(TestCase):
         eq(zeroToTen.getIntervals(), [(0, 10)])
         for iset in oneToTen, fourToFive, zeroToTen, zeroToTwenty, oneToTwenty:
             iset._checkRep()
+        # Unsorted, overlapping, and touching intervals get merged.
+        messy = IntervalSet([(15,20),(1,5),(3,10),(10,12),(30,30)])
+        messy._checkRep()
+        eq(messy.getIntervals(), [(1,12),(15,20)])
+        eq(messy.spanLength(), 16)
 
         checkEq = self._intervalEq
 
@@ -837,6 +844,22 @@ World!
             self.assertEquals(lst, tst)
             tst.append("unterminated line")
 
+    def test_wipeFiles(self):
+        d = mix_mktemp()
+        createPrivateDir(d)
+        fns = [ os.path.join(d, str(i)) for i in range(5) ]
+        for i in range(5):
+            writeFile(fns[i], "x"*(i*5000))
+        bs = mixminion.Common._getBlockSize(d)
+        # A missing file is skipped; the rest are overwritten in whole
+        # blocks, with the throttle told about each one.
+        seen = []
+        n = wipeFiles(fns+[os.path.join(d, "nonesuch")], seen.append)
+        self.assertEquals(seen, [ ceilDiv(i*5000,bs)*bs for i in range(5) ])
+        self.assertEquals(n, reduce(operator.add, seen))
+        self.assertEquals(os.listdir(d), [])
+        self.assertEquals(wipeFiles([]), 0)
+
 #----------------------------------------------------------------------
 
 class MinionlibCryptoTests(TestCase):
@@ -1782,8 +1805,117 @@ class HashLogTests(TestCase):
         log("Ghij"*5)
         seen("Ghij"*5)
 
+        # Check and log several hashes at once.
+        self.assertEquals([1,0,0,1],
+                          h[0].logHashes(["Ghij"*5,"Klmn"*5,"Opqr"*5,"Klmn"*5]))
+        seen("Klmn"*5)
+        seen("Opqr"*5)
+        self.assertEquals([], h[0].logHashes([]))
+
         h[0].close()
 
+    def test_hashlog_filter(self):
+        fname = mix_mktemp(".db")
+        h = HashLog(fname, "Xyzzy")
+        prng = AESCounterPRNG("a"*16)
+        hashes = [ prng.getBytes(20) for _ in xrange(3000) ]
+        # Log more hashes than the filter's initial capacity, so it must grow.
+        for hash_ in hashes:
+            h.logHash(hash_)
+        self.assert_(h.filter.capacity >= 3000)
+        h.sync()
+        h.close()
+
+        # After reopening, the filter is rebuilt from the database.
+        h = HashLog(fname, "Xyzzy")
+        lookups = []
+        def getItemNoJournal(k, lookups=lookups, h=h):
+            lookups.append(k)
+            return mixminion.Filestore.JournaledDBBase.getItemNoJournal(h, k)
+        h.getItemNoJournal = getItemNoJournal
+        for hash_ in hashes:
+            self.assert_(h.seenHash(hash_))
+        self.assertEquals(3000, len(lookups))
+        # Most misses never touch the database.
+        del lookups[:]
+        for _ in xrange(1000):
+            self.failIf(h.seenHash(prng.getBytes(20)))
+        self.assert_(len(lookups) < 50)
+        h.close()
+
+    def test_segment_hashlog(self):
+        fname = mix_mktemp()
+        h = SegmentHashLog(fname, "Xyzzy")
+        h.MIN_MERGE = 100
+        prng = AESCounterPRNG("b"*16)
+        hashes = [ prng.getBytes(20) for _ in xrange(1000) ]
+        self.failIf(h.seenHash("\000"*20))
+        for hash_ in hashes[:500]:
+            self.failIf(h.seenHash(hash_))
+            h.logHash(hash_)
+            self.assert_(h.seenHash(hash_))
+        # We've merged at least once, and the segment is still sorted.
+        self.assert_(h.segCount >= 400)
+        self.assertEquals(h.segCount+len(h.tail), 500)
+        segHashes = h.seg[h.segOffset:]
+        segHashes = [ segHashes[i:i+20] for i in xrange(0,len(segHashes),20) ]
+        sortedHashes = segHashes[:]
+        sortedHashes.sort()
+        self.assertEquals(segHashes, sortedHashes)
+        self.assertEquals([0,1,1,0], h.logHashes([hashes[500], hashes[500],
+                                                  hashes[0], hashes[501]]))
+        h.close()
+
+        # Reopen: everything in both the segment and the tail is there.
+        # A partially written digest at the end of the tail is dropped.
+        f = open(fname+".tail", 'ab')
+        f.write("xyz")
+        f.close()
+        h = SegmentHashLog(fname, "Xyzzy")
+        self.assert_(h.filter.capacity >= 502)
+        searches = []
+        def searchSegment(hash_, searches=searches, h=h):
+            searches.append(hash_)
+            return SegmentHashLog._searchSegment(h, hash_)
+        h._searchSegment = searchSegment
+        for hash_ in hashes[:502]:
+            self.assert_(h.seenHash(hash_))
+        # Most misses are answered by the filter, without a search.
+        del searches[:]
+        for hash_ in hashes[502:]:
+            self.failIf(h.seenHash(hash_))
+        self.assert_(len(searches) < 25)
+        self.assertEquals(0, os.path.getsize(fname+".tail") % 20)
+        # The filter grows as we log more hashes.
+        for _ in xrange(3000):
+            h.logHash(prng.getBytes(20))
+        self.assert_(h.filter.capacity >= 3502)
+        for hash_ in hashes[:502]:
+            self.assert_(h.seenHash(hash_))
+        h.close()
+        suspendLog()
+        try:
+            self.assertRaises(MixFatalError, SegmentHashLog, fname, "Plugh")
+        finally:
+            resumeLog()
+
+        # Old-style hashlogs are converted and removed.
+        fname2 = mix_mktemp()
+        h = HashLog(fname2, "Xyzzy")
+        for hash_ in hashes[:10]:
+            h.logHash(hash_)
+        h.close()
+        h = mixminion.server.HashLog.getHashLog(fname2, "Xyzzy")
+        self.assert_(isinstance(h, SegmentHashLog))
+        self.failIf(os.path.exists(fname2+"_jrnl"))
+        for hash_ in hashes[:10]:
+            self.assert_(h.seenHash(hash_))
+        self.failIf(h.seenHash(hashes[10]))
+        self.assert_(h is mixminion.server.HashLog.getHashLog(fname2, "Xyzzy"))
+        mixminion.server.HashLog.deleteHashLog(fname2)
+        for suffix in ("", "_jrnl", ".seg", ".tail"):
+            self.failIf(os.path.exists(fname2+suffix))
+
 #----------------------------------------------------------------------
 class NetUtilTests(TestCase):
     def testGetIP(self):
@@ -2338,6 +2470,43 @@ class BuildMessageTests(TestCase):
             self.assertEquals(sha1(msg[22:]), msg[2:22])
             self.assertStartsWith(msg[22:], comp)
 
+    def test_build_fwd_packets(self):
+        bfp = BuildMessage.buildForwardPackets
+        payloads = [ BuildMessage.encodeMessage("Hello %s"%i,0)[0]
+                     for i in range(6) ]
+        paths = [ ([self.server1], [self.server3]) ] * 6
+        seed = "X"*AES_KEY_LEN
+        pkts = bfp(payloads, 500, "Goodbye", paths,
+                   AESCounterPRNG(seed), nWorkers=0)
+        self.assertEquals(len(pkts), 6)
+        # The packets come back in order, and decode as we expect.
+        for i in 0, 5:
+            self.do_message_test(pkts[i],
+                                 ( (self.pk1,), None,
+                                   (SWAP_FWD_HOST_TYPE,),
+                                   (self.server3.getRoutingInfo().pack(),) ),
+                                 ( (self.pk3,), None,
+                                   (500,),
+                                   ("Goodbye",) ),
+                                 "Hello %s"%i)
+        # Building in parallel gives packets in the same order, and they
+        # decode as we expect.
+        if BuildMessage.canBuildInParallel():
+            pkts2 = bfp(payloads, 500, "Goodbye", paths,
+                        AESCounterPRNG(seed), nWorkers=3)
+            self.assertEquals(len(pkts2), 6)
+            for i in range(6):
+                self.do_message_test(pkts2[i],
+                                 ( (self.pk1,), None,
+                                   (SWAP_FWD_HOST_TYPE,),
+                                   (self.server3.getRoutingInfo().pack(),) ),
+                                 ( (self.pk3,), None,
+                                   (500,),
+                                   ("Goodbye",) ),
+                                 "Hello %s"%i)
+        else:
+            print "[Skipping parallel build test; no multiprocessing]",
+
     def test_buildreply(self):
         brbi = BuildMessage._buildReplyBlockImpl
         brb = BuildMessage.buildReplyBlock
@@ -2954,6 +3123,126 @@ class PacketHandlerTests(TestCase):
         m_x = self.sp2.processPacket(m_x).getPacket()
         self.failUnlessRaises(CryptoError, self.sp3.processPacket, m_x)
 
+    def test_keyOrder(self):
+        bfm = BuildMessage.buildForwardPacket
+        zPayload = BuildMessage.encodeMessage("Z",0)[0]
+        ph = self.sp2_3
+        self.assert_(ph.privatekeys[0][0] is self.pk2)
+        # Once the second key has decrypted more packets, we try it first.
+        for _ in xrange(3):
+            m = bfm(zPayload, DROP_TYPE, "", [self.server3], [self.server2])
+            ph.processPacket(m)
+        self.assert_(ph.privatekeys[0][0] is self.pk3)
+        self.assert_(ph.privatekeys[1][0] is self.pk2)
+        self.assertEquals(ph.keyIDs[0], sha1(self.pk3.encode_key(1)))
+        # Packets for the other key still work.
+        m = bfm(zPayload, DROP_TYPE, "", [self.server2], [self.server3])
+        ph.processPacket(m)
+        self.assert_(ph.privatekeys[0][0] is self.pk3)
+        # The ordering survives setKeys.
+        ph.setKeys([self.pk2, self.pk3], [self.hlog, self.hlog])
+        self.assert_(ph.privatekeys[0][0] is self.pk3)
+        self.assertEquals(2, len(ph.keyScores))
+
+    def test_batch(self):
+        bfm = BuildMessage.buildForwardPacket
+        p = "Take this kiss upon the brow"
+        m1 = bfm(BuildMessage.encodeMessage("\n"+p,0)[0],
+                 SMTP_TYPE, "nobody@invalid", [self.server1], [self.server3])
+        m2 = bfm(BuildMessage.encodeMessage("\n"+p,0)[0],
+                 DROP_TYPE, "", [self.server1], [self.server3])
+        m3 = bfm(BuildMessage.encodeMessage("\n"+p,0)[0],
+                 SMTP_TYPE, "nobody@invalid", [self.server2], [self.server3])
+        m4 = bfm(BuildMessage.encodeMessage("\n"+p,0)[0],
+                 SMTP_TYPE, "nobody@invalid", [self.server1], [self.server3])
+        self.sp1.processPacket(m4)
+
+        self.assertEquals([], self.sp1.processPackets([]))
+        # Good packets, a bad packet, a replay from an earlier batch, and a
+        # replay within this batch.
+        res = self.sp1.processPackets([m1, m3, m1+"Z", m4, m2, m1])
+        self.assertEquals(6, len(res))
+        r, e = res[0]
+        self.assertEquals(None, e)
+        self.assertEquals(r.getAddress().pack(),
+                          self.server3.getRoutingInfo().pack())
+        self.assertStartsWith(self.sp3.processPacket(r.getPacket())
+                              .getContents(), p)
+        self.assertEquals(None, res[1][0])
+        self.assert_(isinstance(res[1][1], CryptoError))
+        self.assert_(isinstance(res[2][1], ParseError))
+        self.assert_(isinstance(res[3][1], ContentError))
+        self.assertEquals((None, None), res[4])
+        self.assertEquals(None, res[5][0])
+        self.assert_(isinstance(res[5][1], ContentError))
+
+        # Packets for different keys in one batch.
+        m5 = bfm(BuildMessage.encodeMessage("\n"+p,0)[0],
+                 SMTP_TYPE, "nobody@invalid", [self.server2], [self.server3])
+        m6 = bfm(BuildMessage.encodeMessage("\n"+p,0)[0],
+                 SMTP_TYPE, "nobody@invalid", [self.server3], [self.server3])
+        res = self.sp2_3.processPackets([m5, m6, m5])
+        self.assertEquals(None, res[0][1])
+        self.assertEquals(None, res[1][1])
+        self.assert_(isinstance(res[2][1], ContentError))
+
+    def test_workers(self):
+        if not canUseWorkerProcesses():
+            print "[Skipping worker process tests; no multiprocessing]",
+            return
+        import Queue
+        bfm = BuildMessage.buildForwardPacket
+        hlog1 = HashLog(mix_mktemp(".db"), "Z"*20)
+        hlog2 = HashLog(mix_mktemp(".db"), "Q"*20)
+        ph = PacketHandler([self.pk1], [hlog1])
+        ph.startWorkers(2)
+        self.assert_(ph.hasWorkers())
+        results = Queue.Queue()
+        def process(pkt, ph=ph, results=results):
+            ph.processPacketAsync(pkt, results.put)
+            return ph.finishPacket(results.get())
+        try:
+            # A good packet comes back just as from processPacket.
+            p = "Some say the world will end in fire"
+            m = bfm(BuildMessage.encodeMessage("\n"+p,0)[0],
+                    SMTP_TYPE, "nobody@invalid",
+                    [self.server1], [self.server3])
+            res = process(m)
+            self.failIf(res.isDelivery())
+            self.assertEquals(res.getAddress().pack(),
+                              self.server3.getRoutingInfo().pack())
+            res = self.sp3.processPacket(res.getPacket())
+            self.assertStartsWith(res.getContents(), p)
+
+            # Replays are still caught in this process.
+            self.failUnlessRaises(ContentError, process, m)
+            # Bad packets give the same errors as before.
+            self.failUnlessRaises(ParseError, process, m+"Z")
+            m_x = bfm(BuildMessage.encodeMessage("X",0)[0], DROP_TYPE, "",
+                      [self.server2], [self.server2])
+            self.failUnlessRaises(CryptoError, process, m_x)
+
+            # After a key change, the workers know the new keys.
+            ph.setKeys([self.pk1, self.pk2], [hlog1, hlog2])
+            self.assertEquals(None, process(self.sp2.processPacket(m_x)
+                                            .getPacket()))
+            # The parent process notices which key worked, and tries it
+            # first from now on.
+            self.assert_(ph.privatekeys[0][0] is self.pk2)
+            self.assertEquals(ph.keyIDs[0], sha1(self.pk2.encode_key(1)))
+            self.assert_(ph.keyScores[ph.keyIDs[0]] > 0)
+            self.assertEquals(ph.keyScores[ph.keyIDs[1]], 0)
+            # ...and results for keys we no longer have are rejected.
+            m = bfm(BuildMessage.encodeMessage("\n"+p,0)[0],
+                    SMTP_TYPE, "nobody@invalid",
+                    [self.server1], [self.server3])
+            ph.processPacketAsync(m, results.put)
+            r = results.get()
+            ph.setKeys([self.pk2], [hlog2])
+            self.failUnlessRaises(ContentError, ph.finishPacket, r)
+        finally:
+            ph.close()
+
 #----------------------------------------------------------------------
 # FILESTORE and QUEUE
 
@@ -3125,33 +3414,247 @@ class FilestoreTests(FStoreTestBase):
 
         queue = Store(d_d, create=1)
         h1 = queue.queueMessageAndMetadata("abc", [2,3])
-        self.assertEquals(readPickled(os.path.join(d_d, "meta_"+h1)), [2,3])
         self.assertEquals(queue.getMetadata(h1), [2,3])
         h2 = queue.queueMessageAndMetadata("def", [5,6])
         h3 = queue.queueMessageAndMetadata("ghi", None)
         self.assertEquals(queue._metadata_cache, { h1 : [2,3], h2 : [5,6],
                                                    h3 : None })
-        os.unlink(os.path.join(d_d, "meta_"+h3))
+        # All the metadata lives in a single log.
+        self.assertUnorderedEq(os.listdir(d_d), ["metadata.log", "msg_"+h1,
+                                                 "msg_"+h2, "msg_"+h3])
+        queue.setMetadata(h3, "X")
+        queue.close()
         queue = Store(d_d, create=0)
         self.assertEquals(queue.getMetadata(h2), [5,6])
-        self.assertEquals(queue._metadata_cache, { h2 : [5,6] })
+        self.assertEquals(queue._metadata_cache, { h1 : [2,3], h2 : [5,6],
+                                                   h3 : "X" })
+        self.assertEquals(queue._metadataLogRecords, 4)
+        self.failUnlessRaises(KeyError, queue.getMetadata, "xyzzy")
+
+        # Messages without metadata get new metadata.
+        writeFile(os.path.join(d_d, "msg_xyzzy"), "jkl")
+        queue.resyncCatalog()
         try:
             suspendLog()
             queue.loadAllMetadata(lambda h: h)
         finally:
             s = resumeLog()
-        self.assertEndsWith(s, "Missing metadata for file %s\n"%h3)
-        self.assertEquals(queue._metadata_cache, { h1 : [2,3], h2 : [5,6],
-                                                   h3: h3})
-        self.assertEquals(readPickled(os.path.join(d_d, "meta_"+h3)), h3)
+        self.assertEndsWith(s, "Missing metadata for file xyzzy\n")
+        self.assertEquals(queue.getMetadata("xyzzy"), "xyzzy")
         queue.removeMessage(h2)
-        self.assertEquals(queue._metadata_cache, { h1 : [2,3], h3: h3 })
-        self.assert_(os.path.exists(os.path.join(d_d, "rmvm_"+h2)))
+        self.assertEquals(queue._metadata_cache, { h1 : [2,3], h3: "X",
+                                                   "xyzzy" : "xyzzy" })
         self.assert_(os.path.exists(os.path.join(d_d, "rmv_"+h2)))
         queue.cleanQueue(self.unlink)
-        self.assert_(not os.path.exists(os.path.join(d_d, "rmvm_"+h2)))
         self.assert_(not os.path.exists(os.path.join(d_d, "rmv_"+h2)))
 
+        # A torn record at the end of the log is discarded.
+        queue.close()
+        f = open(os.path.join(d_d, "metadata.log"), 'ab')
+        f.write("\x08\x00\x00\x00\x10garbage")
+        f.close()
+        try:
+            suspendLog()
+            queue = Store(d_d, create=0)
+        finally:
+            s = resumeLog()
+        self.assert_(s.find("damaged bytes at the end of") >= 0)
+        self.assertEquals(queue._metadata_cache, { h1 : [2,3], h3: "X",
+                                                   "xyzzy" : "xyzzy" })
+        h4 = queue.queueMessageAndMetadata("mno", "Y")
+        queue.close()
+        queue = Store(d_d, create=0)
+        self.assertEquals(queue.getMetadata(h4), "Y")
+
+        # The log gets compacted once it's mostly garbage.
+        for i in xrange(mixminion.Filestore.METADATA_LOG_MIN_COMPACT+10):
+            queue.setMetadata(h1, i)
+        self.assert_(queue._metadataLogRecords < 100)
+        self.assert_(not os.path.exists(os.path.join(d_d, "metadata.log.tmp")))
+        queue.close()
+        queue = Store(d_d, create=0)
+        self.assertEquals(queue.getMetadata(h1),
+                          mixminion.Filestore.METADATA_LOG_MIN_COMPACT+9)
+        queue.close()
+
+        # Two stores can share a directory if they take turns: once it
+        # calls refreshMetadata, each one sees whether the other has
+        # appended to the log or replaced it.
+        queue = Store(d_d, create=0)
+        queue2 = Store(d_d, create=0)
+        h5 = queue.queueMessageAndMetadata("stu", "Z")
+        # Without a refresh, we only look at our cache.
+        self.failUnlessRaises(KeyError, queue2.getMetadata, h5)
+        queue2.refreshMetadata()
+        self.assertEquals(queue2.getMetadata(h5), "Z")
+        for i in xrange(mixminion.Filestore.METADATA_LOG_MIN_COMPACT+10):
+            queue2.setMetadata(h4, i)
+        queue.refreshMetadata()
+        queue.setMetadata(h1, "W")
+        self.assertEquals(queue.getMetadata(h4),
+                          mixminion.Filestore.METADATA_LOG_MIN_COMPACT+9)
+        queue2.refreshMetadata()
+        self.assertEquals(queue2.getMetadata(h1), "W")
+        queue2.removeMessage(h5)
+        queue.refreshMetadata()
+        self.failUnlessRaises(KeyError, queue.getMetadata, h5)
+        self.failIf(h5 in queue.getAllMessages())
+        # Refreshing an unchanged log keeps our cache.
+        cache = queue._metadata_cache
+        queue.refreshMetadata()
+        self.assert_(cache is queue._metadata_cache)
+        queue.close()
+        queue2.close()
+
+        # Old-style metadata files get moved into the log.
+        d_old = mix_mktemp("q_md")
+        createPrivateDir(d_old)
+        writeFile(os.path.join(d_old, "msg_abcdefgh"), "pqr")
+        writePickled(os.path.join(d_old, "meta_abcdefgh"), [7,8])
+        writeFile(os.path.join(d_old, "inpm_ijklmnop"), "partial")
+        try:
+            suspendLog()
+            queue = Store(d_old, create=0, scrub=1)
+        finally:
+            resumeLog()
+        self.assertEquals(queue.getMetadata("abcdefgh"), [7,8])
+        self.assertUnorderedEq(os.listdir(d_old),
+                               ["metadata.log", "msg_abcdefgh"])
+        queue.close()
+        queue = Store(d_old, create=0)
+        self.assertEquals(queue._metadata_cache, { "abcdefgh" : [7,8] })
+        queue.removeAll(self.unlink)
+        self.assertEquals(os.listdir(d_old), ["metadata.log"])
+        queue.close()
+
+    def testErasureMode(self):
+        d = mix_mktemp("q_enc")
+        queue = mixminion.Filestore.ObjectStore(d, create=1)
+        queue.setErasureMode(1)
+        h1 = queue.queueObject(["Hello", 1])
+        h2 = queue.queueObject(["World", 2])
+        # The messages are encrypted on disk, but read back as usual.
+        contents = readFile(os.path.join(d, "msg_"+h1), 1)
+        self.assertEquals(-1, contents.find("Hello"))
+        self.assertEquals(queue.getObject(h1), ["Hello", 1])
+        self.assertEquals(cPickle.load(queue.openMessage(h2)), ["World", 2])
+        self.assertUnorderedEq(os.listdir(d), ["ekey_1", "msg_"+h1, "msg_"+h2])
+
+        # Reopening the store finds the key again.
+        queue = mixminion.Filestore.ObjectStore(d, create=0)
+        self.assertEquals(queue.getObject(h2), ["World", 2])
+        # New messages are only encrypted if we ask.
+        h3 = queue.queueObject("Plain")
+        contents = readFile(os.path.join(d, "msg_"+h3), 1)
+        self.assertNotEquals(-1, contents.find("Plain"))
+        self.assertEquals(queue.getObject(h3), "Plain")
+
+        # Encrypted messages are just unlinked; the key is wiped once nothing
+        # uses it.
+        deleted = []
+        def deleteFn(fns, deleted=deleted):
+            deleted.extend(fns)
+            for fn in fns:
+                os.unlink(fn)
+        queue.removeMessage(h1)
+        queue.cleanQueue(deleteFn)
+        self.assertEquals(deleted, [])
+        self.assertUnorderedEq(os.listdir(d), ["ekey_1", "msg_"+h2, "msg_"+h3])
+        queue.removeMessage(h2)
+        queue.removeMessage(h3)
+        queue.cleanQueue(deleteFn)
+        self.assertUnorderedEq(deleted, [os.path.join(d, "rmv_"+h3),
+                                         os.path.join(d, "ekey_1")])
+        self.assertEquals(os.listdir(d), [])
+
+        # The key for the current epoch stays until the epoch is over.
+        del deleted[:]
+        queue.setErasureMode(1)
+        h4 = queue.queueObject("Again")
+        queue.removeMessage(h4)
+        queue.cleanQueue(deleteFn)
+        self.assertEquals(deleted, [])
+        self.assertEquals(os.listdir(d), ["ekey_1"])
+        queue.setErasureMode(1, epochLength=0)
+        queue.cleanQueue(deleteFn)
+        self.assertEquals(deleted, [os.path.join(d, "ekey_1")])
+        self.assertEquals(os.listdir(d), [])
+
+    def testCatalog(self):
+        d_c = mix_mktemp("q_cat")
+        queue = mixminion.Filestore.StringMetadataStore(d_c, create=1)
+        h1 = queue.queueMessageAndMetadata("abc", 1)
+        h2 = queue.queueMessageAndMetadata("def", 2)
+        f, h3 = queue.openNewMessage()
+        self.assertUnorderedEq([h1, h2], queue.getAllMessages())
+        self.assertEquals(queue._catalog["inp"], { h3 : 1 })
+        queue.finishMessage(f, h3)
+        queue.removeMessage(h1)
+        self.assertUnorderedEq([h2, h3], queue.getAllMessages())
+        self.assertEquals(queue._catalog["rmv"], { h1 : 1 })
+        queue.cleanQueue(self.unlink)
+        self.assertEquals(queue._catalog["rmv"], {})
+        self.assertUnorderedEq(["msg_"+h2, "metadata.log", "msg_"+h3],
+                               os.listdir(d_c))
+
+        # Changes made behind the store's back are noticed on a resync.
+        writeFile(os.path.join(d_c, "msg_xyzzy"), "ghi")
+        self.assertEquals(2, queue.count())
+        self.assertEquals(3, queue.count(recount=1))
+        self.assertEquals("ghi", queue.messageContents("xyzzy"))
+        os.unlink(os.path.join(d_c, "msg_xyzzy"))
+        queue.resyncCatalog()
+        self.assertUnorderedEq([h2, h3], queue.getAllMessages())
+        queue.removeAll(self.unlink)
+        self.assertEquals(0, queue.count())
+        self.assertEquals(["metadata.log"], os.listdir(d_c))
+
+    def testSegmentedStore(self):
+        d_s = mix_mktemp("q_seg")
+        class Store(mixminion.Filestore.SegmentedStringStore):
+            SLOTS_PER_SEGMENT = 4
+        self.failUnlessRaises(MixFatalError, Store, d_s, 64)
+        store = Store(d_s, 64, create=1)
+        self.assertEquals(0, store.count())
+        handles = [ store.queueMessage("Packet %s"%i) for i in range(10) ]
+        self.assertEquals(10, store.count())
+        self.assertUnorderedEq(handles, store.getAllMessages())
+        self.assertUnorderedEq(["index", "seg_0000", "seg_0001", "seg_0002"],
+                               os.listdir(d_s))
+        self.assertEquals("Packet 3", store.messageContents(handles[3]))
+        self.failUnlessRaises(MixError, store.queueMessage, "x"*65)
+        h = store.queueMessage("x"*64)
+        self.assertEquals("x"*64, store.messageContents(h))
+        store.removeMessage(h)
+
+        # Removed slots are overwritten and reused.
+        store.removeMessage(handles[1])
+        self.failIf(store.messageExists(handles[1]))
+        self.failUnlessRaises(IOError, store.messageContents, handles[1])
+        f = open(os.path.join(d_s, "seg_0000"), 'rb')
+        self.assertEquals("\000"*64, f.read()[64:128])
+        f.close()
+        h = store.queueMessage("Packet 1b")
+        self.assertEquals(1, store._slots[h])
+        handles[1] = h
+
+        # Empty segments at the end are released.
+        for h in handles[4:]:
+            store.removeMessage(h)
+        store.cleanQueue()
+        self.assertUnorderedEq(["index", "seg_0000"], os.listdir(d_s))
+        store.close()
+
+        # Reopen the store.
+        store = Store(d_s, 64)
+        self.assertUnorderedEq(handles[:4], store.getAllMessages())
+        self.assertEquals("Packet 1b", store.messageContents(handles[1]))
+        self.assertEquals(4, len(store.pickRandom(10)))
+        store.removeAll()
+        self.assertEquals(0, store.count())
+        self.assertEquals(["index"], os.listdir(d_s))
+        store.close()
+
     def testDBWrappers(self):
         d_parent = mix_mktemp("db")
         loc = os.path.join(d_parent, "db0")
@@ -3381,7 +3884,7 @@ class QueueTests(FStoreTestBase):
         allHandles = queue.getAllMessages()
         h4 = allHandles[0]
         queue.cleanQueue(self.unlink)
-        self.assertUnorderedEq(os.listdir(d_d), ["meta_"+h4, "msg_"+h4])
+        self.assertUnorderedEq(os.listdir(d_d), ["metadata.log", "msg_"+h4])
         self.assertEquals([h4], queue.getAllMessages())
         self.assertEquals(("Message 2", now, now, now+10), queue._inspect(h2))
 
@@ -3557,6 +4060,75 @@ class QueueTests(FStoreTestBase):
         self.assertEquals(msgs[hB].getAddress(),A3)
         q.close()
 
+    def testDeliveryQueueRetryIndex(self):
+        # Make sure that sendReadyMessages only looks at the messages
+        # that are actually due.
+        now = 10000
+        queue = TestDeliveryQueue(mix_mktemp("qd"), now)
+        queue.setRetrySchedule([10, 10, 10])
+        hs = [ queue.queueDeliveryMessage("Msg %s"%i, now=now)
+               for i in xrange(20) ]
+        queue.sendReadyMessages(now)
+        self.assertEquals(20, len(queue._msgs))
+        # Everything but the first message fails; the first one succeeds.
+        queue.deliverySucceeded(hs[0])
+        for h in hs[1:]:
+            queue.deliveryFailed(h, retriable=1, now=now+1)
+        h21 = queue.queueDeliveryMessage("Msg 21", now=now+2)
+        def noMetadata(h):
+            raise AssertionError("Looked at metadata for %s"%h)
+        queue.store.getMetadata = noMetadata
+        queue.sendReadyMessages(now+3)
+        self.assertEquals([h21], [m.getHandle() for m in queue._msgs])
+        queue.sendReadyMessages(now+5)
+        self.assertEquals([], queue._msgs)
+        # Only the still-waiting messages remain in the index.
+        self.assertEquals(19, len(queue._nextAttemptHeap))
+        del queue.store.getMetadata
+        queue.sendReadyMessages(now+10)
+        self.assertUnorderedEq(hs[1:], [m.getHandle() for m in queue._msgs])
+        # Rebuilding the schedule rebuilds the index.
+        queue.setRetrySchedule([5], now=now+11)
+        self.assertEquals([], queue._nextAttemptHeap)
+        # All the messages are now past their last retry, so they are
+        # dropped when they fail.
+        for m in queue._msgs:
+            m.failed(retriable=1, now=now+12)
+        queue.sendReadyMessages(now+13)
+        self.assertEquals([], queue._msgs)
+        self.assertEquals([h21], queue.getAllMessages())
+        queue.removeAll(self.unlink)
+        queue.cleanQueue(self.unlink)
+
+        # Now try a PerAddressDeliveryQueue with one dead address.
+        A1 = _TestAddr("Dead")
+        A2 = _TestAddr("Alive")
+        q = TestPerAddressDeliveryQueue(mix_mktemp("qd"), now)
+        q.setRetrySchedule([100, 100], now=now)
+        dead = [ q.queueDeliveryMessage("D%s"%i, A1, now) for i in xrange(10) ]
+        q.sendReadyMessages(now)
+        for m in q._msgs:
+            m.failed(retriable=1, now=now+1)
+        q.store.getMetadata = noMetadata
+        h = q.queueDeliveryMessage("Live", A2, now+2)
+        q.sendReadyMessages(now+3)
+        self.assertEquals([h], [m.getHandle() for m in q._msgs])
+        del q.store.getMetadata
+        q._msgs[0].succeeded(now=now+4)
+        self.assertEquals(q._readyAddresses, {})
+        self.assertUnorderedEq(q._waiting[str(A1)].keys(), dead)
+        q._repOK()
+        # When A1 comes due, all of its messages go out at once.
+        q.sendReadyMessages(now+100)
+        self.assertUnorderedEq(dead, [m.getHandle() for m in q._msgs])
+        for m in q._msgs:
+            m.failed(retriable=1, now=now+101)
+        # After the total lifetime, they expire.
+        q.sendReadyMessages(now+201)
+        self.assertEquals([], q._msgs)
+        self.assertEquals([], q.getAllMessages())
+        q.close()
+
     def _pendingMsgDict(self, lst):
         d = {}
         for m in lst:
@@ -4027,12 +4599,137 @@ class MMTPTests(TestCase):
     def testNonblockingTransmission(self):
         self.doTest(self._testNonblockingTransmission)
 
+    def testKeepAliveTransmission(self):
+        self.doTest(self._testKeepAliveTransmission)
+
     def testTimeout(self):
         self.doTest(self._testTimeout)
 
     def testRejected(self):
         self.doTest(self._testRejected)
 
+    def testWriteaheadWindow(self):
+        MMTPClientConnection = mixminion.MMTPClient.MMTPClientConnection
+        class FakeCon(MMTPClientConnection):
+            def __init__(self):
+                self.window = float(self.WRITEAHEAD)
+                self.rtt = self.minRTT = None
+                self.packets = []
+        con = FakeCon()
+        self.assertEquals(con.getWindowStatus(), "(window 6)")
+        # With nothing waiting to be sent, we don't grow the window.
+        for _ in xrange(10):
+            con._noteAckTime(0.1)
+        self.assertEquals(int(con.window), 6)
+        # With packets waiting and fast acks, we grow about one packet
+        # per window's worth of acks, up to the maximum.
+        con.packets = ["x"]
+        for _ in xrange(7):
+            con._noteAckTime(0.1)
+        self.assertEquals(int(con.window), 7)
+        for _ in xrange(5000):
+            con._noteAckTime(0.1)
+        self.assertEquals(con.window, MMTPClientConnection.MAX_WRITEAHEAD)
+        # Once acks take much longer than the fastest we've seen, we shrink.
+        for _ in xrange(5000):
+            con._noteAckTime(1.0)
+        self.assertEquals(con.window, MMTPClientConnection.MIN_WRITEAHEAD)
+        self.assertEquals(con.minRTT, 0.1)
+        self.assertEquals(con.getWindowStatus(),
+                          "(window 2, rtt 1.000s, min 0.100s)")
+
+    def testBandwidthLimits(self):
+        TokenBucket = mixminion.server.MMTPServer.TokenBucket
+        b = TokenBucket(1000, 5000, now=100)
+        self.assertEquals(b.tokens, 5000)
+        b.spend(5500)
+        self.assertEquals(b.getDelay(1000), 1.5)
+        b.refill(now=101)
+        self.assertEquals(b.tokens, 500)
+        b.refill(now=200)
+        self.assertEquals(b.tokens, 5000)
+        self.assertEquals(b.getDelay(1000), 0)
+
+        if not hasattr(socket, 'socketpair'):
+            return
+        server = mixminion.server.MMTPServer.AsyncServer()
+        server.setBandwidth(100000, 10000)
+        class FakeCon(mixminion.server.MMTPServer.Connection):
+            # Always wants to write 5000 bytes at a time.
+            def __init__(self, sock):
+                self.sock = sock
+                self.nWritten = 0
+            def fileno(self):
+                return self.sock.fileno()
+            def getStatus(self):
+                return 0,1,1
+            def process(self, r, w, x, cap):
+                assert w and cap is not None
+                n = min(cap, 5000)
+                self.nWritten += n
+                return 0,1,1,n
+        pairs = [ socket.socketpair() for _ in range(3) ]
+        cons = [ FakeCon(a) for a, b in pairs ]
+        for c in cons:
+            server.register(c)
+        start = time.time()
+        while time.time() < start+0.5:
+            server.process(0.5)
+        elapsed = time.time()-start
+        written = [ c.nWritten for c in cons ]
+        # Everybody gets about the same share, and we stay near the limit.
+        self.assert_(max(written)-min(written) <= 5000)
+        self.assert_(sum(written) <= 100000*elapsed + 10000 + 5000)
+        self.assert_(sum(written) >= 100000*0.3)
+        for c in cons:
+            server.remove(c)
+        for a, b in pairs:
+            a.close()
+            b.close()
+
+    def testEpollAsyncServer(self):
+        if not hasattr(select, 'epoll') or not hasattr(socket, 'socketpair'):
+            return
+        server = mixminion.server.MMTPServer.EpollAsyncServer()
+        class FakeCon(mixminion.server.MMTPServer.Connection):
+            def __init__(self, sock):
+                self.sock = sock
+                self.received = []
+                self.nCalls = 0
+            def fileno(self):
+                return self.sock.fileno()
+            def getStatus(self):
+                return 1,0,1
+            def process(self, r, w, x, cap):
+                self.nCalls += 1
+                s = self.sock.recv(1024)
+                if not s:
+                    self.sock.close()
+                    return 0,0,0,0
+                self.received.append(s)
+                return 1,0,1,len(s)
+        a1, b1 = socket.socketpair()
+        a2, b2 = socket.socketpair()
+        c1, c2 = FakeCon(a1), FakeCon(a2)
+        server.register(c1)
+        server.register(c2)
+        # Only the ready connection is processed.
+        b1.send("Hello")
+        server.process(0.1)
+        self.assertEquals(c1.received, ["Hello"])
+        self.assertEquals(c2.nCalls, 0)
+        server.process(0)
+        self.assertEquals(c1.nCalls, 1)
+        # Closed connections are removed.
+        b2.close()
+        server.process(0.1)
+        self.assertEquals(server.connections.keys(), [c1.fileno()])
+        server.remove(c1)
+        self.assertEquals(server.connections, {})
+        self.assertEquals(server.state, {})
+        a1.close()
+        b1.close()
+
     def _testBlockingTransmission(self):
         server, listener, packetsIn, keyid = _getMMTPServer()
         self.listener = listener
@@ -4060,6 +4757,29 @@ class MMTPTests(TestCase):
         self.failUnless(packetsIn == packets)
         self.assertEquals(1, server.nJunkPackets)
 
+        # Several batches at once, one of which will fail.
+        del packetsIn[:]
+        sent = []
+        badRouting = IPV4Info("127.0.0.1", TEST_PORT, "Z"*20)
+        batches = [ (routing, [packets[0]], sent.append),
+                    (badRouting, [packets[0]], None),
+                    (routing, [packets[1]], sent.append) ]
+        results = []
+        def sendAll(batches=batches, results=results):
+            results.extend(mixminion.MMTPClient.sendPacketsToMany(
+                batches, maxConnections=2))
+        t = threading.Thread(None, sendAll)
+        t.start()
+        while t.isAlive():
+            server.process(0.1)
+        t.join()
+        self.assertEquals(len(results), 3)
+        self.assertEquals(results[0], None)
+        self.failUnless(isinstance(results[1], MixProtocolError))
+        self.assertEquals(results[2], None)
+        self.assertEquals(sent, [0, 0])
+        self.assertUnorderedEq(packetsIn, packets)
+
         # Now, with bad keyid.
         routing = IPV4Info("127.0.0.1", TEST_PORT, "Z"*20)
         t = threading.Thread(None,
@@ -4194,6 +4914,58 @@ class MMTPTests(TestCase):
         self.assert_(deliv[0]._failed)
         self.assert_(deliv[1]._failed)
 
+    def _testKeepAliveTransmission(self):
+        server, listener, packetsIn, keyid = _getMMTPServer()
+        self.listener = listener
+        self.server = server
+
+        # Build a second server, with no listener, to send packets.
+        D = mixminion.Common.Duration
+        config = { 'Server' : { 'Timeout' : D(30) },
+                   'Outgoing/MMTP' : { 'IdleTimeout' : D(60),
+                                       'MaxIdleConnections' : 2 },
+                   'Incoming/MMTP' : { 'Port' : TEST_PORT+1 } }
+        sender = mixminion.server.MMTPServer.MMTPAsyncServer(
+            config, _getTLSContext(1))
+        self.assertEquals(sender.listeners, [])
+
+        packets = ["helloxxx"*4096, "helloyyy"*4096]
+        deliv = [FakeDeliverable(m) for m in packets]
+        def runUntil(fn, server=server, sender=sender):
+            for _ in xrange(200):
+                if fn(): return
+                server.process(0.05)
+                sender.process(0.05)
+
+        # Once the first packet is acknowledged, the connection stays open.
+        sender._sendPackets(socket.AF_INET, "127.0.0.1", TEST_PORT, keyid,
+                            [deliv[0]], "test")
+        runUntil(lambda d=deliv[0]: d._succeeded)
+        self.assert_(deliv[0]._succeeded)
+        clientcon = sender.clientConByAddr[("127.0.0.1", TEST_PORT, keyid)]
+        self.assert_(clientcon.isIdle())
+        self.assert_(clientcon.isActive())
+        self.assertNotEquals(clientcon.sock, None)
+
+        # A packet sent later goes out on the same connection.
+        sender._sendPackets(socket.AF_INET, "127.0.0.1", TEST_PORT, keyid,
+                            [deliv[1]], "test")
+        self.assert_(sender.clientConByAddr[("127.0.0.1", TEST_PORT, keyid)]
+                     is clientcon)
+        self.failIf(clientcon.isIdle())
+        runUntil(lambda d=deliv[1]: d._succeeded)
+        self.assert_(deliv[1]._succeeded)
+        self.assertEquals(packetsIn, packets)
+        self.assert_(clientcon.isIdle())
+
+        # Closing an idle connection shuts it down cleanly.
+        sender.closeIdleConnections(time.time()+120)
+        self.failIf(clientcon.isActive())
+        runUntil(lambda c=clientcon: c.sock is None)
+        self.assertEquals(clientcon.sock, None)
+        self.failIf(clientcon._isFailed)
+        self.assertEquals(sender.connections, {})
+
     def _testTimeout(self):
         if 1:
             return #XXXX007 make this test work again.
@@ -6105,6 +6877,138 @@ Free to hide no more.
             undoReplacedAttributes()
             clearReplacedFunctionCallLog()
 
+    def testSMTPConnectionPool(self):
+        Modules = mixminion.server.Modules
+        events = []
+        nConnections = [0]
+        class FakeSMTP:
+            pipelining = 0
+            # Reply codes for the next pipelined MAIL and RCPT commands.
+            replyCodes = []
+            def __init__(self, server, events=events,
+                         nConnections=nConnections, timeout=None):
+                self.n = nConnections[0]
+                nConnections[0] += 1
+                self.events = events
+                self.timeout = timeout
+                self.closed = 0
+                events.append(('connect', server, self.n))
+            def ehlo(self):
+                return 250, "hi"
+            def has_extn(self, ext):
+                return ext == 'pipelining' and self.pipelining
+            def sendmail(self, fromAddr, toList, msg):
+                if self.closed:
+                    raise smtplib.SMTPServerDisconnected("gone")
+                self.events.append(('send', self.n, fromAddr, toList, msg))
+            def send(self, s):
+                self.events.append(('cmds', self.n, s))
+            def getreply(self):
+                return self.replyCodes.pop(0), "reply"
+            def data(self, msg):
+                self.events.append(('data', self.n, msg))
+                return 250, "ok"
+            def rset(self):
+                self.events.append(('rset', self.n))
+            def quit(self):
+                self.events.append(('quit', self.n))
+            def close(self):
+                self.closed = 1
+        replaceAttribute(smtplib, 'SMTP', FakeSMTP)
+        try:
+            pool = Modules.SMTPConnectionPool("mta.example.com", 60)
+            OK = Modules.DELIVER_OK
+            # Two messages in a row use the same connection.
+            self.assertEquals(OK, pool.sendMessage(["a@b"], "me@x", "m1"))
+            self.assertEquals(OK, pool.sendMessage(["c@d"], "me@x", "m2"))
+            self.assertEquals(events, [
+                ('connect', "mta.example.com", 0),
+                ('send', 0, "me@x", ["a@b"], "m1"),
+                ('send', 0, "me@x", ["c@d"], "m2") ])
+            # We don't wait forever for a stalled MTA.
+            if sys.version_info[:2] >= (2,6):
+                self.assertEquals(pool.idle[0][1].timeout,
+                                  Modules.SMTP_TIMEOUT)
+            # If the MTA drops an idle connection, we reconnect.
+            pool.idle[0][1].closed = 1
+            del events[:]
+            self.assertEquals(OK, pool.sendMessage(["e@f"], "me@x", "m3"))
+            self.assertEquals(events, [
+                ('connect', "mta.example.com", 1),
+                ('send', 1, "me@x", ["e@f"], "m3") ])
+            # Old idle connections get closed.
+            del events[:]
+            pool.closeIdle(time.time()+30)
+            self.assertEquals(events, [])
+            pool.closeIdle(time.time()+61)
+            self.assertEquals(events, [('quit', 1)])
+            self.assertEquals(pool.idle, [])
+            # With no idle timeout, we close every connection.
+            pool = Modules.SMTPConnectionPool("mta.example.com", 0)
+            del events[:]
+            self.assertEquals(OK, pool.sendMessage(["a@b"], "me@x", "m1"))
+            self.assertEquals(events[-1], ('quit', 2))
+            self.assertEquals(pool.idle, [])
+
+            # With PIPELINING, we send MAIL and every RCPT at once, and then
+            # read the replies.
+            FakeSMTP.pipelining = 1
+            RETRY = Modules.DELIVER_FAIL_RETRY
+            pool = Modules.SMTPConnectionPool("mta.example.com", 60)
+            del events[:]
+            FakeSMTP.replyCodes[:] = [250, 250, 251]
+            self.assertEquals(OK, pool.sendMessage(["a@b", "c@d"], "me@x",
+                                                   "m4"))
+            self.assertEquals(events, [
+                ('connect', "mta.example.com", 3),
+                ('cmds', 3, "MAIL FROM:<me@x>\r\nRCPT TO:<a@b>\r\n"
+                            "RCPT TO:<c@d>\r\n"),
+                ('data', 3, "m4") ])
+            self.assertEquals(FakeSMTP.replyCodes, [])
+            # If only some recipients are refused, the rest still get it.
+            del events[:]
+            FakeSMTP.replyCodes[:] = [250, 550, 250]
+            self.assertEquals(OK, pool.sendMessage(["a@b", "c@d"], "me@x",
+                                                   "m5"))
+            self.assertEquals(events, [
+                ('cmds', 3, "MAIL FROM:<me@x>\r\nRCPT TO:<a@b>\r\n"
+                            "RCPT TO:<c@d>\r\n"),
+                ('data', 3, "m5") ])
+            self.assertEquals(len(pool.idle), 1)
+            # If the sender is refused, we reset, drop the connection, and
+            # try again later.
+            del events[:]
+            FakeSMTP.replyCodes[:] = [553, 250]
+            suspendLog()
+            try:
+                self.assertEquals(RETRY, pool.sendMessage(["a@b"], "me@x",
+                                                          "m6"))
+            finally:
+                s = resumeLog()
+            self.assert_(s.find("Unsuccessful SMTP connection") >= 0)
+            self.assertEquals(events, [
+                ('cmds', 3, "MAIL FROM:<me@x>\r\nRCPT TO:<a@b>\r\n"),
+                ('rset', 3) ])
+            self.assertEquals(pool.idle, [])
+            # Likewise if every recipient is refused.
+            del events[:]
+            FakeSMTP.replyCodes[:] = [250, 550, 551]
+            suspendLog()
+            try:
+                self.assertEquals(RETRY, pool.sendMessage(["a@b", "c@d"],
+                                                          "me@x", "m7"))
+            finally:
+                resumeLog()
+            self.assertEquals(events, [
+                ('connect', "mta.example.com", 4),
+                ('cmds', 4, "MAIL FROM:<me@x>\r\nRCPT TO:<a@b>\r\n"
+                            "RCPT TO:<c@d>\r\n"),
+                ('rset', 4) ])
+            self.assertEquals(FakeSMTP.replyCodes, [])
+            self.assertEquals(pool.idle, [])
+        finally:
+            undoReplacedAttributes()
+
     def testMBOX(self):
         """Check out the MBOX module. (We temporarily replace sendSMTPMessage
            with a stub function so that we don't actually send anything.)"""
@@ -6581,6 +7485,20 @@ class ServerMainTests(TestCase):
 
         s.processEvents(tm+5)
         self.assertEquals(["c", "d", "b", "c" ], lst)
+        self.assertEquals(s.firstEventTime(), tm+3.5)
+
+        # Background events have no known time while they're running.
+        s = _Scheduler()
+        jobs = []
+        ev = mixminion.ScheduleUtils.RecurringComplexBackgroundEvent(
+            tm+1, jobs.append, lambda tm=tm: tm+10)
+        s.scheduleEvent(ev)
+        s.scheduleOnce(tm+20, "A", a)
+        s.processEvents(tm+2)
+        self.assertEquals(1, len(jobs))
+        self.assertEquals(s.firstEventTime(), tm+20)
+        jobs[0]()
+        self.assertEquals(s.firstEventTime(), tm+10)
 
     def testMixPool(self):
         ServerConfig = mixminion.server.ServerConfig.ServerConfig
@@ -7960,12 +8878,7 @@ wanted to play with the new experimental built-in pinger code.]"""
         log.connected(id0,now=t+90)
         log.gotPing("\x00Z"*10, now=t+130)
         log.gotPing("BN"*10, now=t+150)
-        suspendLog()
-        try:
-            log.gotPing("BL"*10, now=t+160) #Never sent.
-        finally:
-            s = resumeLog()
-        self.assertEndsWith(s, "Received ping with no record of its hash\n")
+        log.gotPing("BL"*10, now=t+160) #Never sent; ignored.
         log.gotPing("''"*10, now=t+161.1)
         log.rotate(t-15*24*60*60,t-15*24*60*60)
         log.heartbeat(t+200)
@@ -8002,9 +8915,202 @@ wanted to play with the new experimental built-in pinger code.]"""
         env = {}
         execfile(statusFile,env)
 
+        # Now try it in the background.
+        os.unlink(statusFile)
+        log._interestingChains = {}
+        th = mixminion.ThreadUtils.ProcessingThread("ping statistics thread")
+        th.start()
+        log.calculateAllInBackground(th, statusFile, now=t+300)
+        # We don't start a second computation while the first is running.
+        log.calculateAllInBackground(th, statusFile, now=t+300)
+        th.shutdown(flush=0)
+        th.join()
+        self.assert_(not log._calculating)
+        env2 = {}
+        execfile(statusFile,env2)
+        self.assertEquals(env['INTERESTING_CHAINS'],
+                          env2['INTERESTING_CHAINS'])
+        self.assertEquals(len(log._interestingChains),
+                          len(env2['INTERESTING_CHAINS']))
+
         log.rotate(t+15*24*60*60,t+30*24*60*60)
         log.close()
 
+    def testPingLogBatching(self):
+        P = mixminion.server.Pinger
+        if not P.canRunPinger():
+            return
+        id0 = "Premature optimizati"
+        d = mix_mktemp()
+        os.mkdir(d,0700)
+        loc = os.path.join(d, "db")
+        def count(table, loc=loc):
+            con = P.sqlite3.connect(loc)
+            try:
+                cur = con.execute("SELECT count(*) FROM %s"%table)
+                return cur.fetchone()[0]
+            finally:
+                con.close()
+        t = previousMidnight(time.time())+3600
+        log = P.openPingLog(None,location=loc)
+        journalMode = log._db.getCursor().execute(
+            "PRAGMA journal_mode").fetchone()[0]
+        self.assert_(journalMode.lower() in ("wal", "delete"))
+        # Events are buffered until we flush them.
+        log.startup(now=t)
+        log.connected(id0,now=t+1)
+        log.connectFailed(id0,now=t+2)
+        log.queuedPing("\x00Z"*10, [id0], now=t+3)
+        self.assertEquals(count("connectionAttempt"), 0)
+        self.assertEquals(count("ping"), 0)
+        log.flush()
+        self.assertEquals(count("myLifespan"), 1)
+        self.assertEquals(count("connectionAttempt"), 2)
+        self.assertEquals(count("ping"), 1)
+        # A full buffer gets flushed on its own.
+        replaceAttribute(P, 'MAX_PENDING_EVENTS', 5)
+        try:
+            for i in xrange(4):
+                log.connected(id0,now=t+10+i)
+            self.assertEquals(count("connectionAttempt"), 2)
+            log.connected(id0,now=t+20)
+            self.assertEquals(count("connectionAttempt"), 7)
+        finally:
+            undoReplacedAttributes()
+        # Receiving a ping is buffered too, and is written after the ping
+        # was queued.
+        log.queuedPing("BN"*10, [id0], now=t+30)
+        log.gotPing("BN"*10, now=t+40)
+        self.assertEquals(count("ping WHERE received = %d"%(t+40)), 0)
+        log.flush()
+        self.assertEquals(count("ping WHERE received = %d"%(t+40)), 1)
+        # Shutting down and closing write everything.
+        log.heartbeat(now=t+50)
+        log.connected(id0,now=t+51)
+        log.shutdown(now=t+60)
+        self.assertEquals(count("myLifespan WHERE shutdown = %d"%(t+60)), 1)
+        log.connected(id0,now=t+70)
+        log.close()
+        self.assertEquals(count("connectionAttempt"), 9)
+
+    def testChainStatus(self):
+        P = mixminion.server.Pinger
+        if not P.canRunPinger():
+            return
+        idA = "Premature optimizati"
+        idB = "on is the root of al"
+        d = mix_mktemp()
+        os.mkdir(d,0700)
+        loc = os.path.join(d, "db")
+        t = previousMidnight(time.time())+3600
+        log = P.openPingLog(None,location=loc)
+        hexA = log._db.encodeIdentity(idA)
+        hexB = log._db.encodeIdentity(idB)
+        log.startup(now=t)
+        # A always delivers one-hop pings; B delivers half of them.
+        intervalID = log._getIntervalID(previousMidnight(t),
+                                        succeedingMidnight(t))
+        log._setOneHop((log._getServerID(idA), intervalID),
+                       (1, 1, 0, 1.0, 1.0, 1.0))
+        log._setOneHop((log._getServerID(idB), intervalID),
+                       (2, 1, 0, 1.0, 0.5, 0.5))
+        n = [0]
+        def ping(path, received, log=log, t=t, n=n):
+            n[0] += 1
+            h = "%020d"%n[0]
+            log.queuedPing(h, path, now=t+n[0])
+            if received:
+                log.gotPing(h, now=t+n[0]+60)
+        # A,B: expect 5 of 10; got 1.  That's broken.
+        for i in xrange(10):
+            ping([idA,idB], i==0)
+        # B,A: expect 2 of 4; got 3.  That's fine.
+        for i in xrange(4):
+            ping([idB,idA], i!=0)
+        # A,A: only one ping, and we lost it.  That's interesting.
+        ping([idA,idA], 0)
+        # B,B: no pings at all.  That's interesting too.
+        log.calculateChainStatus(now=t+3600)
+
+        cur = log._db.getCursor()
+        cur.execute("SELECT S1.identity, S2.identity, nSent, nReceived, "
+                    "broken, interesting FROM echolotCurrentTwoHopResult, "
+                    "server AS S1, server AS S2 "
+                    "WHERE S1.id = server1 AND S2.id = server2")
+        self.assertUnorderedEq(cur.fetchall(),
+                               [ (hexA, hexB, 10, 1, 1, 1),
+                                 (hexB, hexA, 4, 3, 0, 0),
+                                 (hexA, hexA, 1, 0, 0, 1),
+                                 (hexB, hexB, 0, 0, 0, 1) ])
+        self.assertEquals(log._brokenChains, { "%s,%s"%(hexA,hexB) : 1 })
+        interesting = log._interestingChains
+        # Reloading from the database gives the same chains.
+        log._loadServers()
+        self.assertEquals(log._interestingChains, interesting)
+        self.assertUnorderedEq(interesting.keys(),
+                               [ "%s,%s"%(hexA,hexB), "%s,%s"%(hexA,hexA),
+                                 "%s,%s"%(hexB,hexB) ])
+        log.close()
+
+    def testFinishedIntervals(self):
+        P = mixminion.server.Pinger
+        if not P.canRunPinger():
+            return
+        ONE_DAY = P.ONE_DAY
+        id0 = "Premature optimizati"
+        d = mix_mktemp()
+        os.mkdir(d,0700)
+        loc = os.path.join(d, "db")
+        now = previousMidnight(time.time())+3600
+        log = P.openPingLog(None,location=loc)
+        log.startup(now=now-5*ONE_DAY)
+        # Ping once an hour for five days; lose every third ping.
+        for h in xrange(5*24):
+            t = now - 5*ONE_DAY + h*3600 + 60
+            log.connected(id0, success=(h%7 != 0), now=t)
+            log.queuedPing("%020d"%h, [id0], now=t)
+            if h % 3:
+                log.gotPing("%020d"%h, now=t+60+h)
+        log.calculateUptimes(now-12*ONE_DAY, now, now=now)
+        log.calculateOneHopResult(now)
+
+        cur = log._db.getCursor()
+        def results(cur=cur, now=now):
+            cur.execute("SELECT startAt, server, uptime "
+                        "FROM uptime, statsInterval "
+                        "WHERE interval = statsInterval.id "
+                        "ORDER BY startAt, server")
+            ups = cur.fetchall()
+            cur.execute("SELECT startAt, nSent, nReceived, latency, "
+                        "reliability FROM echolotOneHopResult, statsInterval "
+                        "WHERE interval = statsInterval.id ORDER BY startAt")
+            hops = cur.fetchall()
+            cur.execute("SELECT latency, reliability "
+                        "FROM echolotCurrentOneHopResult")
+            return ups, hops, cur.fetchall()
+        ups, hops, current = results()
+        # Everything that ended a day ago or more is final.
+        cur.execute("SELECT kind, count() FROM finishedInterval "
+                    "GROUP BY kind ORDER BY kind")
+        self.assertEquals(cur.fetchall(), [ ("onehop", 11), ("uptime", 11) ])
+        cur.execute("SELECT SUM(n) FROM echolotOneHopLatency")
+        self.assertEquals(cur.fetchone()[0], 63)
+
+        # Now throw away the raw data for the finished intervals.  Our
+        # old results shouldn't change, and neither should the current
+        # latency.
+        cutoff = previousMidnight(now) - 2*ONE_DAY
+        cur.execute("DELETE FROM ping WHERE sentat < ?", (cutoff,))
+        cur.execute("DELETE FROM connectionAttempt WHERE at < ?", (cutoff,))
+        log.calculateUptimes(now-12*ONE_DAY, now, now=now)
+        log.calculateOneHopResult(now)
+        ups2, hops2, current2 = results()
+        self.assertEquals(ups, ups2)
+        self.assertEquals(hops[:-2], hops2[:-2])
+        self.assertEquals(current[0][0], current2[0][0])
+        self.assertFloatEq(current[0][1], current2[0][1])
+        log.close()
+
 #----------------------------------------------------------------------
 
 def initializeGlobals():